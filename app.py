@@ -1,13 +1,18 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, send_from_directory, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, abort, send_from_directory, jsonify, session, make_response
 from dotenv import load_dotenv
 import os
+import pathlib
 import functools
 import jinja2
 import asyncio
+import atexit
+import queue
+import time
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import nest_asyncio
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, load_only, scoped_session, selectinload
 import hashlib
 import json
 import datetime
@@ -15,26 +20,34 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import timedelta
 from pytz import timezone, utc
 
+# Часовой пояс создаём один раз: timezone() перечитывает tzdata при каждом вызове
+MSK_TZ = timezone('Europe/Moscow')
+
 from models.db_init import init_db, SessionLocal
 from models.user_models import User
 from models.ticket_models import (
     Ticket, Attachment, Message, DashboardMessage,
-    DashboardAttachment, TicketCategory, AuditLog
+    DashboardAttachment, TicketCategory, AuditLog, strict_load
 )
 from models.department_models import Department
 from models.position_models import Position
 from models.office_models import Office
-from sqlalchemy import func, desc
+from sqlalchemy import func, desc, select, insert, update, delete, case, bindparam
+from sqlalchemy.sql import lambda_stmt
 from werkzeug.utils import secure_filename
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 import uuid
 
 # Import bot notification function
-from bot.bot import sync_send_notification
+from bot.bot import sync_send_notification, invalidate_categories, invalidate_user
 
 # Load environment variables
 load_dotenv()
 
+# Пул для фоновой отправки Telegram-уведомлений: вызов Bot API занимает 100-500 мс
+# и не должен блокировать WSGI-воркер внутри запроса
+notification_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='tg-notify')
+
 def admin_required(f):
     @functools.wraps(f)
     def decorated_function(*args, **kwargs):
@@ -48,6 +61,14 @@ def admin_required(f):
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "your-secret-key-here")
 
+# Сессия БД, привязанная к жизненному циклу запроса: все обращения внутри одного
+# запроса разделяют одну сессию/соединение вместо отдельного SessionLocal() на каждое
+db_session = scoped_session(SessionLocal)
+
+@app.teardown_appcontext
+def shutdown_db_session(exception=None):
+    db_session.remove()
+
 # Добавляем фильтр datetime
 @app.template_filter('datetime')
 def format_datetime(value):
@@ -60,8 +81,12 @@ base_dir = os.path.abspath(os.path.dirname(__file__))
 app.config['UPLOAD_FOLDER'] = os.path.join(base_dir, 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5 MB max upload
 
+# Готовые pathlib-пути, чтобы не пересобирать их и не обращаться к app.config в каждом запросе
+UPLOAD_ROOT = pathlib.Path(app.config['UPLOAD_FOLDER'])
+DASHBOARD_UPLOAD_DIR = UPLOAD_ROOT / 'dashboard'
+
 # Ensure uploads folder exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+UPLOAD_ROOT.mkdir(parents=True, exist_ok=True)
 
 # Setup Flask-Login
 login_manager = LoginManager()
@@ -70,10 +95,9 @@ login_manager.login_view = 'login'
 
 @login_manager.user_loader
 def load_user(user_id):
-    db = SessionLocal()
-    user = db.get(User, int(user_id))
-    db.close()
-    return user
+    # Не закрываем сессию здесь: current_user остаётся привязанным к ней до конца
+    # запроса, уборка происходит в teardown_appcontext
+    return db_session().get(User, int(user_id))
 
 # Apply asyncio compatibility
 nest_asyncio.apply()
@@ -83,7 +107,7 @@ init_db()
 
 # Проверяем наличие необходимых таблиц и при необходимости запускаем миграцию
 def check_required_tables():
-    ticket_db = SessionLocal()
+    ticket_db = db_session()
     try:
         from sqlalchemy import inspect
         inspector = inspect(ticket_db.bind)
@@ -142,7 +166,7 @@ def log_user_action(user_id, action_type, description):
         action_type: Тип действия
         description: Описание действия
     """
-    db = SessionLocal()
+    db = db_session()
     try:
         user = db.get(User, user_id)
         if not user:
@@ -199,15 +223,31 @@ def login_required_role(role=None):
         return decorated_view
     return wrapper
 
+def _send_ticket_notification(chat_id, message):
+    """Рабочая функция фонового пула: собственно отправка и логирование результата"""
+    try:
+        result = sync_send_notification(chat_id, message)
+        if result:
+            logging.info(f"Уведомление успешно отправлено пользователю {chat_id}")
+        else:
+            logging.warning(f"Не удалось отправить уведомление пользователю {chat_id}")
+        return result
+    except Exception as e:
+        logging.error(f"Ошибка при отправке уведомления пользователю {chat_id}: {str(e)}")
+        return False
+
 # Добавляем функцию уведомления для обновления заявки
-def notify_ticket_update(ticket, message, db, notification_type="update"):
+def notify_ticket_update(ticket, message, db=None, notification_type="update"):
     """
-    Отправляет уведомление пользователю о изменении статуса заявки или новом сообщении.
+    Ставит уведомление пользователю об изменении заявки в фоновую очередь отправки.
+
+    Вызывать после commit: в пул передаются только простые значения (chat_id и текст),
+    поэтому состояние ORM-сессии для отправки не нужно.
 
     Args:
         ticket: Объект заявки
         message: Текст сообщения для отправки
-        db: Сессия БД
+        db: Не используется, сохранён для совместимости вызовов
         notification_type: Тип уведомления (update, message, etc.)
     """
     # Проверяем наличие chat_id
@@ -215,20 +255,106 @@ def notify_ticket_update(ticket, message, db, notification_type="update"):
         logging.warning(f"Невозможно отправить уведомление: creator_chat_id отсутствует для заявки #{ticket.id}")
         return False
 
+    notification_executor.submit(_send_ticket_notification, ticket.creator_chat_id, message)
+    return True
+
+# Константные описания для журнала аудита (без интерполяции, собираются один раз)
+AUDIT_DESC_DASHBOARD_MESSAGE = "Отправлено сообщение в командный чат"
+
+# Словари для отображения действий в истории (константы, не пересобираем на каждый запрос)
+ACTION_TYPE_LABELS = {
+    'approve_registration': 'Подтверждение регистрации',
+    'reject_registration': 'Отклонение регистрации',
+    'activate_user': 'Активация пользователя',
+    'deactivate_user': 'Деактивация пользователя'
+}
+
+ACTION_TYPE_COLORS = {
+    'approve_registration': 'success',
+    'reject_registration': 'danger',
+    'activate_user': 'success',
+    'deactivate_user': 'warning'
+}
+
+# Очередь записей аудита: INSERT уходит из критического пути запроса,
+# фоновый поток сбрасывает накопившиеся строки одним executemany
+AUDIT_LOG_QUEUE = queue.Queue()
+_AUDIT_FLUSH_BATCH = 500
+
+def _drain_audit_queue(block):
+    rows = []
     try:
-        # Отправляем уведомление
-        result = sync_send_notification(ticket.creator_chat_id, message)
-
-        # Логируем результат
-        if result:
-            logging.info(f"Уведомление успешно отправлено пользователю {ticket.creator_chat_id}")
-            return True
-        else:
-            logging.warning(f"Не удалось отправить уведомление пользователю {ticket.creator_chat_id}")
-            return False
+        rows.append(AUDIT_LOG_QUEUE.get(block=block, timeout=1 if block else None))
+        while len(rows) < _AUDIT_FLUSH_BATCH:
+            rows.append(AUDIT_LOG_QUEUE.get_nowait())
+    except queue.Empty:
+        pass
+    return rows
+
+def _flush_audit_rows(rows):
+    if not rows:
+        return
+    session = SessionLocal()
+    try:
+        session.execute(insert(AuditLog), rows)
+        session.commit()
     except Exception as e:
-        logging.error(f"Ошибка при отправке уведомления пользователю {ticket.creator_chat_id}: {str(e)}")
-        return False
+        session.rollback()
+        logging.error(f"Ошибка при записи журнала аудита: {str(e)}")
+    finally:
+        session.close()
+
+def _audit_log_flusher():
+    while True:
+        _flush_audit_rows(_drain_audit_queue(block=True))
+
+threading.Thread(target=_audit_log_flusher, daemon=True, name='audit-flusher').start()
+
+# При остановке процесса дописываем всё, что осталось в очереди
+atexit.register(lambda: _flush_audit_rows(_drain_audit_queue(block=False)))
+
+def queue_audit_log(**row):
+    """Ставит запись аудита в очередь фонового сброса (timestamp фиксируем сразу)"""
+    row.setdefault('timestamp', datetime.datetime.utcnow())
+    AUDIT_LOG_QUEUE.put(row)
+
+# Предкомпилированные операторы для горячих обработчиков закрепления: lambda_stmt
+# кэширует построение и компиляцию SQL, повторные вызовы только подставляют параметры
+_PIN_CHAT_MESSAGE_STMT = lambda_stmt(lambda: update(Message)
+    .where(Message.ticket_id == bindparam('tid'),
+           Message.is_internal == bindparam('internal'))
+    .values(is_pinned=case((Message.id == bindparam('mid'), True), else_=False)))
+
+_UNPIN_CHAT_MESSAGE_STMT = lambda_stmt(lambda: update(Message)
+    .where(Message.id == bindparam('mid'), Message.ticket_id == bindparam('tid'))
+    .values(is_pinned=False))
+
+# rowcount у массового UPDATE считает все затронутые сообщения чата и потому
+# не говорит, существует ли само закрепляемое сообщение — его наличие
+# проверяется отдельным точечным SELECT до изменения данных
+_CHAT_MESSAGE_EXISTS_STMT = lambda_stmt(lambda: select(Message.id)
+    .where(Message.id == bindparam('mid'),
+           Message.ticket_id == bindparam('tid'),
+           Message.is_internal == bindparam('internal')))
+
+def _parse_form_date(value):
+    """Преобразует строку формы 'YYYY-MM-DD' в datetime (или None при пустом значении)"""
+    if not value:
+        return None
+    return datetime.datetime.combine(datetime.date.fromisoformat(value), datetime.time.min)
+
+def _compute_is_active(active_from, active_to):
+    """Python-аналог is_currently_active моделей справочников для bulk-вставок без ORM-объектов"""
+    today = datetime.date.today()
+    date_from = active_from.date() if active_from else None
+    date_to = active_to.date() if active_to else None
+    if date_from and date_to:
+        return date_from <= today <= date_to
+    if date_from:
+        return date_from <= today
+    if date_to:
+        return today <= date_to
+    return True
 
 # Вместо load_json_list('statuses.json') используем справочник статусов:
 STATUSES = [
@@ -242,12 +368,12 @@ STATUSES = [
 @app.route('/create_ticket', methods=['GET', 'POST'])
 @login_required_role()
 def create_ticket():
-    ticket_db = SessionLocal()
+    ticket_db = db_session()
     import sqlalchemy
     is_staff = getattr(current_user, 'role', None) in ["admin", "curator"]
     users = None
     if is_staff:
-        user_db = SessionLocal()
+        user_db = db_session()
         users = user_db.query(User).options(
             sqlalchemy.orm.joinedload(User.position),
             sqlalchemy.orm.joinedload(User.department)
@@ -297,7 +423,7 @@ def registration_approval():
         flash('У вас нет прав для доступа к этой странице', 'danger')
         return redirect(url_for('index'))
     
-    db = SessionLocal()
+    db = db_session()
     try:
         if request.method == 'POST':
             user_id = request.form.get('user_id')
@@ -345,8 +471,11 @@ def registration_approval():
                 )
                 
                 flash('Регистрация отклонена', 'success')
-            
+
             db.commit()
+            # Сбрасываем кэш пользователя в боте, чтобы новый статус
+            # подтверждения увидели сразу, не дожидаясь истечения TTL
+            invalidate_user(user.chat_id)
             return redirect(url_for('registration_approval'))
         
         # Получаем списки пользователей
@@ -364,7 +493,7 @@ def registration_approval():
 @app.route('/edit_user/<int:user_id>', methods=['GET', 'POST'])
 @login_required_role(['admin', 'curator'])
 def edit_user(user_id):
-    db = SessionLocal()
+    db = db_session()
     try:
         user = db.get(User, user_id)
         if not user:
@@ -396,8 +525,8 @@ def edit_user(user_id):
             archived_at = None
             if archived_at_str:
                 try:
-                    archived_at = datetime.datetime.strptime(archived_at_str, '%Y-%m-%d').date()
-                except Exception:
+                    archived_at = datetime.date.fromisoformat(archived_at_str)
+                except ValueError:
                     archived_at = None
             
             # Логика увольнения и активности
@@ -446,7 +575,9 @@ def edit_user(user_id):
             
             try:
                 db.commit()
-                
+                # Изменение активности/увольнения должно сразу попасть в бот
+                invalidate_user(user.chat_id)
+
                 # Логируем изменения, если они были
                 if changes:
                     log_user_action(
@@ -474,8 +605,8 @@ def edit_user(user_id):
 @app.route('/edit_category/<int:category_id>', methods=['GET', 'POST'])
 @login_required_role(['curator'])
 def edit_category(category_id):
-    db = SessionLocal()
-    category = db.query(TicketCategory).get(category_id)
+    db = db_session()
+    category = db.get(TicketCategory, category_id)
     if not category:
         db.close()
         abort(404)
@@ -485,6 +616,8 @@ def edit_category(category_id):
         category.is_active   = 'is_active' in request.form
         db.commit()
         db.close()
+        _bump_dictionaries_cache()
+        invalidate_categories()
         flash('Категория обновлена', 'success')
         return redirect(url_for('dictionaries'))
     db.close()
@@ -493,7 +626,7 @@ def edit_category(category_id):
 @app.route('/categories', methods=['GET'])
 @login_required_role()
 def get_categories_json():
-    db = SessionLocal()
+    db = db_session()
     categories = db.query(TicketCategory).filter(TicketCategory.is_active == True).all()
     result = [{"id": cat.id, "name": cat.name} for cat in categories]
     db.close()
@@ -502,10 +635,10 @@ def get_categories_json():
 @app.route('/ticket/<int:ticket_id>/change_category', methods=['POST'])
 @login_required_role()
 def change_ticket_category(ticket_id):
-    db = SessionLocal()
+    db = db_session()
 
     try:
-        ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
+        ticket = db.get(Ticket, ticket_id)
         if not ticket:
             return jsonify({"success": False, "error": "Заявка не найдена"}), 404
 
@@ -513,13 +646,13 @@ def change_ticket_category(ticket_id):
         if not category_id:
             return jsonify({"success": False, "error": "Категория не указана"}), 400
 
-        category = db.query(TicketCategory).filter(TicketCategory.id == category_id).first()
+        category = db.get(TicketCategory, category_id)
         if not category:
             return jsonify({"success": False, "error": "Категория не найдена"}), 404
 
         old_category_name = "Не указана"
         if ticket.category_id:
-            old_category = db.query(TicketCategory).filter(TicketCategory.id == ticket.category_id).first()
+            old_category = db.get(TicketCategory, ticket.category_id)
             if old_category:
                 old_category_name = old_category.name
 
@@ -558,10 +691,10 @@ def change_ticket_category(ticket_id):
 @app.route('/ticket/<int:ticket_id>/change_priority', methods=['POST'])
 @login_required_role()
 def change_ticket_priority(ticket_id):
-    db = SessionLocal()
+    db = db_session()
 
     try:
-        ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
+        ticket = db.get(Ticket, ticket_id)
         if not ticket:
             return jsonify({"success": False, "error": "Заявка не найдена"}), 404
 
@@ -609,9 +742,12 @@ def change_ticket_priority(ticket_id):
 @app.route('/ticket/<int:ticket_id>/change_status', methods=['POST'])
 @login_required_role()
 def change_ticket_status(ticket_id):
-    db = SessionLocal()
+    db = db_session()
     try:
-        ticket = Ticket.query.get_or_404(ticket_id)
+        ticket = db.get(Ticket, ticket_id)
+        if not ticket:
+            flash('Заявка не найдена', 'danger')
+            return redirect(url_for('tickets'))
         new_status = request.form.get('status')
         
         if not new_status:
@@ -664,7 +800,7 @@ def login():
             flash('Пожалуйста, введите имя пользователя и пароль', 'error')
             return redirect(url_for('login'))
         
-        db = SessionLocal()
+        db = db_session()
         try:
             user = db.query(User).filter(User.username == username).first()
             
@@ -672,6 +808,12 @@ def login():
                 if hasattr(user, 'is_fired') and user.is_fired:
                     flash('Ваша учетная запись деактивирована. Обратитесь к администратору.', 'error')
                     return redirect(url_for('login'))
+                # verify_password мог перехешировать пароль со старыми
+                # параметрами — фиксируем до закрытия сессии, иначе
+                # обновлённый хеш теряется и перехеш повторяется при
+                # каждом входе
+                if db.dirty:
+                    db.commit()
                 login_user(user)
                 flash('Вы успешно вошли в систему', 'success')
                 return redirect(url_for('dashboard'))
@@ -692,12 +834,12 @@ def logout():
 @app.route('/dashboard')
 @login_required_role()
 def dashboard():
-    ticket_db = SessionLocal()
-    user_db = SessionLocal()
+    ticket_db = db_session()
+    user_db = db_session()
     statuses = STATUSES
     statuses_dict = {s['id']: s['name'] for s in statuses}
 
-    user = user_db.query(User).filter(User.id == current_user.id).first()
+    user = user_db.get(User, current_user.id)
 
     if not user:
         user_db.close()
@@ -720,7 +862,7 @@ def dashboard():
     ).scalar()
 
     twelve_hours_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=12)
-    recent_tickets = ticket_db.query(Ticket).filter(
+    recent_tickets = ticket_db.query(Ticket).options(*strict_load()).filter(
         Ticket.created_at >= twelve_hours_ago
     ).order_by(desc(Ticket.created_at)).all()
 
@@ -740,14 +882,11 @@ def dashboard():
             'description': description
         })
 
+    # Вложения подгружаются пакетно (lazy="selectin" на модели) —
+    # отдельный SELECT на каждое сообщение больше не нужен
     dashboard_messages = ticket_db.query(DashboardMessage).order_by(DashboardMessage.created_at).all()
 
-    for message in dashboard_messages:
-        message.attachments = ticket_db.query(DashboardAttachment).filter(DashboardAttachment.message_id == message.id).all()
-
     pinned_message = ticket_db.query(DashboardMessage).filter(DashboardMessage.is_pinned == True).first()
-    if pinned_message:
-        pinned_message.attachments = ticket_db.query(DashboardAttachment).filter(DashboardAttachment.message_id == pinned_message.id).all()
 
     staff = user_db.query(User).filter(User.role.in_(['admin', 'curator'])).all()
 
@@ -771,7 +910,7 @@ def dashboard():
 @app.route('/send_dashboard_message', methods=['POST'])
 @login_required_role()
 def send_dashboard_message():
-    ticket_db = SessionLocal()
+    ticket_db = db_session()
 
     try:
         message_content = request.form.get('message', '').strip()
@@ -794,21 +933,18 @@ def send_dashboard_message():
 
             allowed_extensions = {'jpg', 'jpeg', 'png', 'gif', 'pdf', 'doc', 'docx', 'xls', 'xlsx', 'txt', 'ods', 'odt', 'csv', 'odp'}
             if '.' in image_file.filename and image_file.filename.rsplit('.', 1)[1].lower() in allowed_extensions:
-                attachments_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'dashboard')
-                if not os.path.exists(attachments_dir):
-                    os.makedirs(attachments_dir)
+                DASHBOARD_UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
                 filename = secure_filename(image_file.filename)
                 filename = f"{datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{filename}"
 
-                file_path = os.path.join(attachments_dir, filename)
-                image_file.save(file_path)
+                image_file.save(str(DASHBOARD_UPLOAD_DIR / filename))
 
                 file_type = image_file.content_type if hasattr(image_file, 'content_type') else None
 
                 new_attachment = DashboardAttachment(
                     message_id=new_message.id,
-                    file_path=os.path.join('dashboard', filename),
+                    file_path=f"dashboard/{filename}",
                     file_name=image_file.filename,
                     file_type=file_type
                 )
@@ -822,7 +958,7 @@ def send_dashboard_message():
             actor_id=str(current_user.id),
             actor_name=current_user.full_name,
             action_type="send_dashboard_message",
-            description=f"Отправлено сообщение в командный чат",
+            description=AUDIT_DESC_DASHBOARD_MESSAGE,
             entity_type="dashboard_message",
             entity_id=str(new_message.id),
             is_pdn_related=False,
@@ -856,15 +992,19 @@ def ticket_attachment(filename):
 @app.route('/pin_dashboard_message/<int:message_id>', methods=['POST'])
 @login_required_role(role=['curator', 'admin'])
 def pin_dashboard_message(message_id):
-    ticket_db = SessionLocal()
+    ticket_db = db_session()
 
     try:
-        ticket_db.query(DashboardMessage).filter(DashboardMessage.is_pinned == True).update({'is_pinned': False})
-
-        message = ticket_db.query(DashboardMessage).filter(DashboardMessage.id == message_id).first()
-        if message:
-            message.is_pinned = True
+        # synchronize_session=False: в сессии нет загруженных объектов, которые нужно догонять
+        ticket_db.query(DashboardMessage).filter(DashboardMessage.is_pinned == True).update(
+            {'is_pinned': False}, synchronize_session=False
+        )
 
+        # Обновляем по id без загрузки ORM-объекта; rowcount говорит, нашлось ли сообщение
+        pinned = ticket_db.execute(
+            update(DashboardMessage).where(DashboardMessage.id == message_id).values(is_pinned=True)
+        ).rowcount
+        if pinned:
             audit_log = AuditLog(
                 actor_id=str(current_user.id),
                 actor_name=current_user.full_name,
@@ -894,13 +1034,13 @@ def pin_dashboard_message(message_id):
 @app.route('/unpin_dashboard_message/<int:message_id>', methods=['POST'])
 @login_required_role(role=['curator', 'admin'])
 def unpin_dashboard_message(message_id):
-    ticket_db = SessionLocal()
+    ticket_db = db_session()
 
     try:
-        message = ticket_db.query(DashboardMessage).filter(DashboardMessage.id == message_id).first()
-        if message:
-            message.is_pinned = False
-
+        unpinned = ticket_db.execute(
+            update(DashboardMessage).where(DashboardMessage.id == message_id).values(is_pinned=False)
+        ).rowcount
+        if unpinned:
             audit_log = AuditLog(
                 actor_id=str(current_user.id),
                 actor_name=current_user.full_name,
@@ -930,36 +1070,37 @@ def unpin_dashboard_message(message_id):
 @app.route('/delete_dashboard_message/<int:message_id>', methods=['POST'])
 @login_required_role()
 def delete_dashboard_message(message_id):
-    ticket_db = SessionLocal()
+    ticket_db = db_session()
 
     try:
-        message = ticket_db.query(DashboardMessage).filter(DashboardMessage.id == message_id).first()
+        # Загружаем только нужные для проверки прав колонки, без гидратации всего объекта
+        row = ticket_db.execute(
+            select(DashboardMessage.sender_id, DashboardMessage.sender_name)
+            .where(DashboardMessage.id == message_id)
+        ).first()
 
-        if not message:
+        if not row:
             flash('Сообщение не найдено', 'error')
             return redirect(url_for('dashboard'))
 
+        sender_id, sender_name = row
+
         # Проверяем права доступа: пользователь может удалить свое сообщение или если он админ/куратор
-        if str(message.sender_id) != str(current_user.id) and current_user.role not in ['admin', 'curator']:
+        if str(sender_id) != str(current_user.id) and current_user.role not in ['admin', 'curator']:
             flash('У вас нет прав на удаление этого сообщения', 'error')
             return redirect(url_for('dashboard'))
 
-        message_info = {
-            'id': message.id,
-            'sender_id': message.sender_id,
-            'sender_name': message.sender_name,
-            'content': message.content[:50] + ('...' if len(message.content) > 50 else '')
-        }
-
-        ticket_db.delete(message)
+        # Каскад на вложения в модели объявлен на уровне ORM, поэтому удаляем их явно
+        ticket_db.execute(delete(DashboardAttachment).where(DashboardAttachment.message_id == message_id))
+        ticket_db.execute(delete(DashboardMessage).where(DashboardMessage.id == message_id))
 
         audit_log = AuditLog(
             actor_id=str(current_user.id),
             actor_name=current_user.full_name,
             action_type="delete_dashboard_message",
-            description=f"Удалено сообщение из командного чата (ID: {message_info['id']}, отправитель: {message_info['sender_name']})",
+            description=f"Удалено сообщение из командного чата (ID: {message_id}, отправитель: {sender_name})",
             entity_type="dashboard_message",
-            entity_id=str(message_info['id']),
+            entity_id=str(message_id),
             is_pdn_related=False,
             timestamp=datetime.datetime.utcnow()
         )
@@ -981,7 +1122,7 @@ def delete_dashboard_message(message_id):
 @app.route('/create_category', methods=['GET', 'POST'])
 @login_required_role(['curator'])
 def create_category():
-    db = SessionLocal()
+    db = db_session()
     if request.method == 'POST':
         name = request.form.get('name', '').strip()
         if not name:
@@ -991,6 +1132,8 @@ def create_category():
         new_cat = TicketCategory(name=name)
         db.add(new_cat)
         db.commit()
+        _bump_dictionaries_cache()
+        invalidate_categories()
         flash(f'Категория "{name}" создана', 'success')
         db.close()
         return redirect(url_for('dictionaries'))
@@ -1000,7 +1143,7 @@ def create_category():
 @app.route('/send_chat_message', methods=['POST'])
 @login_required_role()
 def send_chat_message():
-    db = SessionLocal()
+    db = db_session()
     try:
         ticket_id = request.form.get('ticket_id')
         message_text = request.form.get('message')
@@ -1009,7 +1152,7 @@ def send_chat_message():
         if not ticket_id or not message_text:
             return jsonify({"success": False, "error": "Необходимо указать ID заявки и текст сообщения"}), 400
 
-        ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
+        ticket = db.get(Ticket, ticket_id)
         if not ticket:
             return jsonify({"success": False, "error": "Заявка не найдена"}), 404
 
@@ -1036,12 +1179,13 @@ def send_chat_message():
             for file in files:
                 if file.filename:
                     filename = secure_filename(file.filename)
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                    file_path = str(UPLOAD_ROOT / filename)
                     file.save(file_path)
 
-                    # Определяем тип файла
-                    file_type = file.content_type
-                    is_image = file_type.startswith('image/')
+                    # Определяем тип файла (content_type может отсутствовать в multipart-части)
+                    file_type = file.content_type or 'application/octet-stream'
+                    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+                    is_image = file_type.startswith('image/') or ext in {'jpg', 'jpeg', 'png', 'gif'}
 
                     # Создаем запись о вложении
                     attachment = Attachment(
@@ -1058,13 +1202,19 @@ def send_chat_message():
         ticket.updated_at = datetime.datetime.utcnow()
         db.commit()
 
-        # Отправляем уведомление в Telegram
-        notification_text = f"💬 <b>Новое сообщение в заявке #{ticket_id}</b>\n\n"
-        notification_text += f"От: <b>{current_user.full_name}</b>\n"
-        notification_text += f"Заявка: <b>{ticket.title}</b>\n"
-        notification_text += f"Сообщение: {message_text}"
+        # Отправляем уведомление в Telegram (одна f-строка вместо цепочки конкатенаций)
+        notification_text = (
+            f"💬 <b>Новое сообщение в заявке #{ticket_id}</b>\n\n"
+            f"От: <b>{current_user.full_name}</b>\n"
+            f"Заявка: <b>{ticket.title}</b>\n"
+            f"Сообщение: {message_text}"
+        )
 
-        notify_ticket_update(ticket, notification_text, db, "new_message")
+        # Отправляем в фоне уже после коммита: в пул уходят только простые значения,
+        # чтобы не трогать ORM-объекты из другого потока
+        creator_chat_id = ticket.creator_chat_id
+        if creator_chat_id:
+            notification_executor.submit(sync_send_notification, creator_chat_id, notification_text)
 
         return jsonify({
             "success": True,
@@ -1087,8 +1237,8 @@ def send_chat_message():
 @app.route('/tickets')
 @login_required_role()
 def tickets():
-    ticket_db = SessionLocal()
-    user_db = SessionLocal()
+    ticket_db = db_session()
+    user_db = db_session()
     statuses = STATUSES
     statuses_dict = {s['id']: s['name'] for s in statuses}
     status = request.args.get('status', 'all')
@@ -1124,12 +1274,12 @@ def tickets():
             query = query.filter(Ticket.assignee_id == assignee)
 
     if date_from:
-        date_from_obj = datetime.datetime.strptime(date_from, '%Y-%m-%d')
+        # date.fromisoformat реализован на C и заметно быстрее strptime
+        date_from_obj = datetime.datetime.combine(datetime.date.fromisoformat(date_from), datetime.time.min)
         query = query.filter(Ticket.created_at >= date_from_obj)
 
     if date_to:
-        date_to_obj = datetime.datetime.strptime(date_to, '%Y-%m-%d')
-        date_to_obj = date_to_obj.replace(hour=23, minute=59, second=59)
+        date_to_obj = datetime.datetime.combine(datetime.date.fromisoformat(date_to), datetime.time.max)
         query = query.filter(Ticket.created_at <= date_to_obj)
 
     categories = {cat.id: cat.name for cat in ticket_db.query(TicketCategory).all()}
@@ -1142,7 +1292,13 @@ def tickets():
     elif page > total_pages and total_pages > 0:
         page = total_pages
 
-    tickets_query = query.order_by(desc(Ticket.created_at)).offset((page - 1) * per_page).limit(per_page).all()
+    # Список использует только эти колонки — не тащим из БД объёмный description
+    # strict_load: список собирается по словарям имён, связи ему не нужны —
+    # их ленивые и eager-загрузки отключены, случайное обращение даст ошибку
+    tickets_query = query.options(*strict_load(load_only(
+        Ticket.id, Ticket.title, Ticket.creator_chat_id, Ticket.assignee_id,
+        Ticket.category_id, Ticket.status, Ticket.priority, Ticket.created_at
+    ))).order_by(desc(Ticket.created_at)).offset((page - 1) * per_page).limit(per_page).all()
 
     all_staff = user_db.query(User).all()
     staff_map = {str(staff.id): staff.full_name for staff in all_staff}
@@ -1192,8 +1348,8 @@ def tickets():
 @app.route('/tickets/fragment', methods=['POST'])
 @login_required_role()
 def tickets_fragment():
-    ticket_db = SessionLocal()
-    user_db = SessionLocal()
+    ticket_db = db_session()
+    user_db = db_session()
     statuses = STATUSES
     statuses_dict = {s['id']: s['name'] for s in statuses}
     status = request.form.get('status', 'all')
@@ -1229,12 +1385,12 @@ def tickets_fragment():
             query = query.filter(Ticket.assignee_id == assignee)
 
     if date_from:
-        date_from_obj = datetime.datetime.strptime(date_from, '%Y-%m-%d')
+        # date.fromisoformat реализован на C и заметно быстрее strptime
+        date_from_obj = datetime.datetime.combine(datetime.date.fromisoformat(date_from), datetime.time.min)
         query = query.filter(Ticket.created_at >= date_from_obj)
 
     if date_to:
-        date_to_obj = datetime.datetime.strptime(date_to, '%Y-%m-%d')
-        date_to_obj = date_to_obj.replace(hour=23, minute=59, second=59)
+        date_to_obj = datetime.datetime.combine(datetime.date.fromisoformat(date_to), datetime.time.max)
         query = query.filter(Ticket.created_at <= date_to_obj)
 
     categories = {cat.id: cat.name for cat in ticket_db.query(TicketCategory).all()}
@@ -1247,7 +1403,13 @@ def tickets_fragment():
     elif page > total_pages and total_pages > 0:
         page = total_pages
 
-    tickets_query = query.order_by(desc(Ticket.created_at)).offset((page - 1) * per_page).limit(per_page).all()
+    # Список использует только эти колонки — не тащим из БД объёмный description
+    # strict_load: список собирается по словарям имён, связи ему не нужны —
+    # их ленивые и eager-загрузки отключены, случайное обращение даст ошибку
+    tickets_query = query.options(*strict_load(load_only(
+        Ticket.id, Ticket.title, Ticket.creator_chat_id, Ticket.assignee_id,
+        Ticket.category_id, Ticket.status, Ticket.priority, Ticket.created_at
+    ))).order_by(desc(Ticket.created_at)).offset((page - 1) * per_page).limit(per_page).all()
 
     all_staff = user_db.query(User).all()
     staff_map = {str(staff.id): staff.full_name for staff in all_staff}
@@ -1289,8 +1451,8 @@ def users():
         flash('У вас нет доступа к этой странице', 'error')
         return redirect(url_for('index'))
     
-    db = SessionLocal()
-    ticket_db = SessionLocal()
+    db = db_session()
+    ticket_db = db_session()
     try:
         if request.method == 'POST':
             user_id = request.form.get('user_id', type=int)
@@ -1325,6 +1487,8 @@ def users():
                 
                 db.commit()
                 ticket_db.commit()
+                # Блокировка/активация должна сразу попасть в кэш бота
+                invalidate_user(user.chat_id)
                 return redirect(url_for('users'))
         
         # Получаем всех пользователей
@@ -1349,41 +1513,26 @@ def users():
         if action_type:
             actions_query = actions_query.filter(AuditLog.action_type == action_type)
         if date_from:
-            from_dt = datetime.datetime.strptime(date_from, '%Y-%m-%d')
+            from_dt = datetime.datetime.combine(datetime.date.fromisoformat(date_from), datetime.time.min)
             actions_query = actions_query.filter(AuditLog.timestamp >= from_dt)
         if date_to:
-            to_dt = datetime.datetime.strptime(date_to, '%Y-%m-%d')
-            to_dt = to_dt.replace(hour=23, minute=59, second=59)
+            to_dt = datetime.datetime.combine(datetime.date.fromisoformat(date_to), datetime.time.max)
             actions_query = actions_query.filter(AuditLog.timestamp <= to_dt)
         
         actions = actions_query.order_by(AuditLog.timestamp.desc()).limit(200).all()
         
-        # Для фильтров
-        all_actors = ticket_db.query(AuditLog.actor_id, AuditLog.actor_name).distinct().all()
-        all_action_types = [row[0] for row in ticket_db.query(AuditLog.action_type).distinct().all()]
-        
-        # Словари для отображения действий
-        action_type_labels = {
-            'approve_registration': 'Подтверждение регистрации',
-            'reject_registration': 'Отклонение регистрации',
-            'activate_user': 'Активация пользователя',
-            'deactivate_user': 'Деактивация пользователя'
-        }
-        
-        action_type_colors = {
-            'approve_registration': 'success',
-            'reject_registration': 'danger',
-            'activate_user': 'success',
-            'deactivate_user': 'warning'
-        }
+        # Для фильтров: actor_id в журнале — это str(user.id), так что список акторов
+        # строим из уже загруженных пользователей вместо DISTINCT по всему журналу
+        all_actors = [(str(u.id), u.full_name) for u in users]
+        all_action_types = list(ACTION_TYPE_LABELS)
         
         return render_template('users.html',
                              users=users,
                              actions=actions,
                              all_actors=all_actors,
                              all_action_types=all_action_types,
-                             action_type_labels=action_type_labels,
-                             action_type_colors=action_type_colors,
+                             action_type_labels=ACTION_TYPE_LABELS,
+                             action_type_colors=ACTION_TYPE_COLORS,
                              filter_params={
                                  'actor_id': actor_id,
                                  'action_type': action_type,
@@ -1397,7 +1546,7 @@ def users():
 @app.route('/create_user', methods=['GET', 'POST'])
 @login_required_role(['curator'])
 def create_user():
-    db = SessionLocal()
+    db = db_session()
     try:
         # Получаем данные для выпадающих списков
         departments = db.query(Department).all()
@@ -1456,13 +1605,15 @@ def create_user():
 @app.route('/ticket/<int:ticket_id>')
 @login_required_role()
 def ticket_detail(ticket_id):
-    db = SessionLocal()
+    db = db_session()
     statuses = STATUSES
     statuses_dict = {s['id']: s['name'] for s in statuses}
+    # selectinload вместо joinedload: два JOIN по коллекциям давали
+    # произведение строк (сообщения × вложения) в одном результате
     ticket = db.query(Ticket)\
         .options(
-            joinedload(Ticket.attachments),
-            joinedload(Ticket.messages)
+            selectinload(Ticket.attachments),
+            selectinload(Ticket.messages)
         )\
         .filter(Ticket.id == ticket_id).first()
     if not ticket:
@@ -1470,8 +1621,8 @@ def ticket_detail(ticket_id):
         flash('Заявка не найдена', 'error')
         return redirect(url_for('tickets'))
     creator = db.query(User).filter(User.chat_id == ticket.creator_chat_id).first()
-    assignee = db.query(User).filter(User.id == ticket.assignee_id).first() if ticket.assignee_id else None
-    category = db.query(TicketCategory).filter(TicketCategory.id == ticket.category_id).first() if ticket.category_id else None
+    assignee = db.get(User, ticket.assignee_id) if ticket.assignee_id else None
+    category = db.get(TicketCategory, ticket.category_id) if ticket.category_id else None
     staff = db.query(User).filter(User.role.in_(['admin', 'curator'])).all()
 
     # Разделяем сообщения на внешние и внутренние и сортируем их
@@ -1505,8 +1656,8 @@ def ticket_detail(ticket_id):
 @app.route('/ticket/<int:ticket_id>/assign', methods=['POST'])
 @login_required_role()
 def assign_ticket(ticket_id):
-    db = SessionLocal()
-    ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
+    db = db_session()
+    ticket = db.get(Ticket, ticket_id)
     if not ticket:
         db.close()
         flash('Заявка не найдена', 'error')
@@ -1522,8 +1673,8 @@ def assign_ticket(ticket_id):
 @app.route('/ticket/<int:ticket_id>/resolve', methods=['POST'])
 @login_required_role()
 def resolve_ticket(ticket_id):
-    db = SessionLocal()
-    ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
+    db = db_session()
+    ticket = db.get(Ticket, ticket_id)
     if not ticket:
         db.close()
         flash('Заявка не найдена', 'error')
@@ -1540,8 +1691,8 @@ def resolve_ticket(ticket_id):
 @app.route('/ticket/<int:ticket_id>/reopen', methods=['POST'])
 @login_required_role()
 def reopen_ticket(ticket_id):
-    db = SessionLocal()
-    ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
+    db = db_session()
+    ticket = db.get(Ticket, ticket_id)
     if not ticket:
         db.close()
         flash('Заявка не найдена', 'error')
@@ -1558,8 +1709,8 @@ def reopen_ticket(ticket_id):
 @app.route('/ticket/<int:ticket_id>/irrelevant', methods=['POST'])
 @login_required_role()
 def mark_irrelevant(ticket_id):
-    db = SessionLocal()
-    ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
+    db = db_session()
+    ticket = db.get(Ticket, ticket_id)
     if not ticket:
         db.close()
         flash('Заявка не найдена', 'error')
@@ -1576,32 +1727,28 @@ def mark_irrelevant(ticket_id):
 @app.route('/ticket/<int:ticket_id>/message/<int:message_id>/pin/<chat_type>', methods=['POST'])
 @login_required_role()
 def pin_message(ticket_id, message_id, chat_type):
-    db = SessionLocal()
+    # Раньше любое значение, кроме 'external', молча трактовалось как внутренний чат
+    if chat_type not in ('external', 'internal'):
+        abort(400)
+
+    db = db_session()
     try:
-        # Сначала открепляем все сообщения в этом чате
-        if chat_type == 'external':
-            db.query(Message).filter(
-                Message.ticket_id == ticket_id,
-                Message.is_internal == False
-            ).update({'is_pinned': False})
+        params = {
+            'tid': ticket_id,
+            'internal': chat_type == 'internal',
+            'mid': message_id,
+        }
+        # Сначала убеждаемся, что сообщение существует в этом чате: массовый
+        # UPDATE ниже затрагивает весь чат, и его rowcount не отличает
+        # «закрепили» от «открепили всё по несуществующему id»
+        if db.execute(_CHAT_MESSAGE_EXISTS_STMT, params).first() is None:
+            flash('Сообщение не найдено', 'error')
         else:
-            db.query(Message).filter(
-                Message.ticket_id == ticket_id,
-                Message.is_internal == True
-            ).update({'is_pinned': False})
-
-        # Закрепляем выбранное сообщение
-        message = db.query(Message).filter(
-            Message.id == message_id,
-            Message.ticket_id == ticket_id
-        ).first()
-
-        if message:
-            message.is_pinned = True
+            # Один UPDATE: закрепляем выбранное сообщение и одновременно
+            # открепляем остальные в этом чате (is_pinned = (id == message_id))
+            db.execute(_PIN_CHAT_MESSAGE_STMT, params)
             db.commit()
             flash('Сообщение закреплено', 'success')
-        else:
-            flash('Сообщение не найдено', 'error')
 
     except Exception as e:
         db.rollback()
@@ -1614,19 +1761,25 @@ def pin_message(ticket_id, message_id, chat_type):
 @app.route('/ticket/<int:ticket_id>/message/<int:message_id>/unpin/<chat_type>', methods=['POST'])
 @login_required_role()
 def unpin_message(ticket_id, message_id, chat_type):
-    db = SessionLocal()
-    try:
-        message = db.query(Message).filter(
-            Message.id == message_id,
-            Message.ticket_id == ticket_id
-        ).first()
+    if chat_type not in ('external', 'internal'):
+        abort(400)
 
-        if message:
-            message.is_pinned = False
+    db = db_session()
+    try:
+        params = {
+            'tid': ticket_id,
+            'internal': chat_type == 'internal',
+            'mid': message_id,
+        }
+        # Та же проверка существования, что и при закреплении: заодно ловит
+        # message_id из другого чата (chat_type не совпадает с is_internal)
+        if db.execute(_CHAT_MESSAGE_EXISTS_STMT, params).first() is None:
+            flash('Сообщение не найдено', 'error')
+        else:
+            db.execute(_UNPIN_CHAT_MESSAGE_STMT,
+                       {'mid': message_id, 'tid': ticket_id})
             db.commit()
             flash('Сообщение откреплено', 'success')
-        else:
-            flash('Сообщение не найдено', 'error')
 
     except Exception as e:
         db.rollback()
@@ -1640,9 +1793,9 @@ def unpin_message(ticket_id, message_id, chat_type):
 @app.route('/api/ticket/<int:ticket_id>/update', methods=['POST'])
 @login_required_role()
 def update_ticket_field(ticket_id):
-    db = SessionLocal()
+    db = db_session()
     try:
-        ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
+        ticket = db.get(Ticket, ticket_id)
         if not ticket:
             return jsonify({'success': False, 'message': 'Заявка не найдена'}), 404
 
@@ -1666,7 +1819,7 @@ def update_ticket_field(ticket_id):
 
         elif field == 'assignee':
             if value:
-                user = db.query(User).filter(User.id == value).first()
+                user = db.get(User, value)
                 if not user:
                     return jsonify({'success': False, 'message': 'Пользователь не найден'}), 400
                 ticket.assignee_id = value
@@ -1679,8 +1832,8 @@ def update_ticket_field(ticket_id):
         ticket.updated_at = datetime.datetime.utcnow()
         db.commit()
 
-        # Логируем изменение
-        log_entry = AuditLog(
+        # Запись аудита уходит в фоновую очередь, INSERT не задерживает ответ
+        queue_audit_log(
             actor_id=current_user.chat_id,
             actor_name=current_user.full_name,
             action_type='update',
@@ -1688,8 +1841,6 @@ def update_ticket_field(ticket_id):
             entity_type='ticket',
             entity_id=str(ticket_id)
         )
-        db.add(log_entry)
-        db.commit()
 
         return jsonify({'success': True, 'message': 'Поле обновлено'})
 
@@ -1702,9 +1853,11 @@ def update_ticket_field(ticket_id):
 @app.route('/api/ticket/<int:ticket_id>/status', methods=['POST'])
 @login_required_role()
 def change_ticket_status_api(ticket_id):
-    db = SessionLocal()
+    db = db_session()
     try:
-        ticket = Ticket.query.get_or_404(ticket_id)
+        ticket = db.get(Ticket, ticket_id)
+        if not ticket:
+            return jsonify({"success": False, "error": "Заявка не найдена"}), 404
         data = request.get_json()
         
         if not data or 'status' not in data:
@@ -1722,28 +1875,26 @@ def change_ticket_status_api(ticket_id):
         ticket.updated_at = datetime.datetime.utcnow()
         
         try:
-            # Если добавили причину, добавляем сообщение в чат
+            # Если добавили причину, добавляем оба сообщения (внутреннее для
+            # администраторов и внешнее для пользователя) одним executemany
             if reason:
-                # Внутреннее сообщение для администраторов
-                new_message = Message(
-                    ticket_id=ticket_id,
-                    sender_id=str(current_user.id),
-                    sender_name=current_user.full_name,
-                    content=f"Статус изменен на '{new_status}'\nПричина: {reason}",
-                    is_internal=True
-                )
-                db.add(new_message)
-                
-                # Внешнее сообщение для пользователя
-                user_message = Message(
-                    ticket_id=ticket_id,
-                    sender_id=str(current_user.id),
-                    sender_name=current_user.full_name,
-                    content=f"Статус заявки изменен на '{new_status}'\nКомментарий: {reason}",
-                    is_internal=False
-                )
-                db.add(user_message)
-            
+                db.execute(insert(Message), [
+                    {
+                        "ticket_id": ticket_id,
+                        "sender_id": str(current_user.id),
+                        "sender_name": current_user.full_name,
+                        "content": f"Статус изменен на '{new_status}'\nПричина: {reason}",
+                        "is_internal": True,
+                    },
+                    {
+                        "ticket_id": ticket_id,
+                        "sender_id": str(current_user.id),
+                        "sender_name": current_user.full_name,
+                        "content": f"Статус заявки изменен на '{new_status}'\nКомментарий: {reason}",
+                        "is_internal": False,
+                    },
+                ])
+
             db.commit()
             
             # Логируем изменение статуса
@@ -1754,9 +1905,11 @@ def change_ticket_status_api(ticket_id):
             )
             
             # Отправляем уведомление
-            notification_text = f"🔔 <b>Изменен статус заявки #{ticket_id}</b>\n\n"
-            notification_text += f"Заявка: <b>{ticket.title}</b>\n"
-            notification_text += f"Статус: <b>{new_status}</b>\n"
+            notification_text = (
+                f"🔔 <b>Изменен статус заявки #{ticket_id}</b>\n\n"
+                f"Заявка: <b>{ticket.title}</b>\n"
+                f"Статус: <b>{new_status}</b>\n"
+            )
             if reason:
                 notification_text += f"Комментарий: {reason}\n"
             
@@ -1776,14 +1929,57 @@ def utility_processor():
         'now': datetime.datetime.utcnow
     }
 
+# --- Кэш данных справочников ---
+# Справочники меняются редко, поэтому результаты выборок держим в памяти.
+# Кэшируются именно данные, а не отрендеренный HTML: страница содержит
+# имя и меню текущего пользователя и flash-сообщения, общий HTML отдал бы
+# их чужим пользователям. Версия растёт при любом изменении справочников,
+# что сразу инвалидирует и ETag, и накопленные выборки.
+_DICTIONARIES_CACHE_TTL = 60  # секунд
+_dictionaries_cache_lock = threading.Lock()
+_dictionaries_cache_version = 0
+_dictionaries_data_cache = {}  # ключ фильтров -> (данные для шаблона, время выборки)
+
+def _bump_dictionaries_cache():
+    """Инвалидирует кэш данных справочников после изменения данных"""
+    global _dictionaries_cache_version
+    with _dictionaries_cache_lock:
+        _dictionaries_cache_version += 1
+        _dictionaries_data_cache.clear()
+
 @app.route('/dictionaries')
 @login_required_role()
 def dictionaries():
-    db = SessionLocal()
+    cache_key = tuple(sorted(request.args.items()))
+    # ETag включает пользователя (страница персонализирована) и не
+    # участвует, пока есть непоказанные flash-сообщения — иначе 304
+    # «съел» бы их или отдал чужому пользователю
+    flash_pending = bool(session.get('_flashes'))
+    etag = hashlib.md5(
+        f"{_dictionaries_cache_version}:{cache_key}:{current_user.get_id()}".encode()
+    ).hexdigest()
+    # Браузер уже видел актуальную версию — отвечаем без рендера и запросов к БД
+    if not flash_pending and request.if_none_match.contains(etag):
+        return '', 304
+
+    with _dictionaries_cache_lock:
+        cached = _dictionaries_data_cache.get(cache_key)
+    if cached and time.monotonic() - cached[1] < _DICTIONARIES_CACHE_TTL:
+        response = make_response(render_template('dictionaries.html', **cached[0]))
+        if not flash_pending:
+            response.set_etag(etag)
+        return response
+
+    db = db_session()
     try:
         # --- Фильтрация отделений ---
         dep_search = request.args.get('dep_search', '').strip()
-        dep_query = db.query(Department)
+        # Шаблон читает только id/name/даты — не материализуем лишние
+        # колонки; is_active вычисляется hybrid-свойством из дат
+        dep_query = db.query(Department).options(load_only(
+            Department.id, Department.name, Department.active_from,
+            Department.active_to
+        ))
         if dep_search:
             dep_query = dep_query.filter(Department.name.ilike(f'%{dep_search}%'))
         departments = dep_query.all()
@@ -1791,40 +1987,53 @@ def dictionaries():
         # --- Фильтрация кабинетов ---
         office_search = request.args.get('office_search', '').strip()
         office_dep_filter = request.args.get('office_dep_filter', '').strip()
-        office_query = db.query(Office)
+        # Отделения подгружаем сразу одним JOIN вместо отдельного SELECT на каждый кабинет
+        office_query = db.query(Office).options(
+            load_only(Office.id, Office.name, Office.active_from,
+                      Office.active_to, Office.is_active),
+            joinedload(Office.department).load_only(Department.id, Department.name)
+        )
         if office_search:
             office_query = office_query.filter(Office.name.ilike(f'%{office_search}%'))
         if office_dep_filter:
             office_query = office_query.filter(Office.department_id == int(office_dep_filter))
         offices = office_query.all()
-        
-        # Загружаем связанные объекты для всех кабинетов
-        for office in offices:
-            if office.department_id:
-                office.department = db.query(Department).get(office.department_id)
-        
+
         all_departments = db.query(Department).all()
 
         # --- Фильтрация должностей ---
         pos_search = request.args.get('pos_search', '').strip()
-        pos_query = db.query(Position)
+        pos_query = db.query(Position).options(load_only(
+            Position.id, Position.name, Position.active_from,
+            Position.active_to
+        ))
         if pos_search:
             pos_query = pos_query.filter(Position.name.ilike(f'%{pos_search}%'))
         positions = pos_query.all()
 
         # --- Фильтрация категорий ---
         cat_search = request.args.get('cat_search', '').strip()
-        cat_query = db.query(TicketCategory)
+        cat_query = db.query(TicketCategory).options(load_only(
+            TicketCategory.id, TicketCategory.name, TicketCategory.description,
+            TicketCategory.created_at, TicketCategory.is_active
+        ))
         if cat_search:
             cat_query = cat_query.filter(TicketCategory.name.ilike(f'%{cat_search}%'))
         categories = cat_query.all()
 
-        return render_template('dictionaries.html',
-                             departments=departments,
-                             offices=offices,
-                             positions=positions,
-                             categories=categories,
-                             all_departments=all_departments)
+        data = {
+            'departments': departments,
+            'offices': offices,
+            'positions': positions,
+            'categories': categories,
+            'all_departments': all_departments,
+        }
+        with _dictionaries_cache_lock:
+            _dictionaries_data_cache[cache_key] = (data, time.monotonic())
+        response = make_response(render_template('dictionaries.html', **data))
+        if not flash_pending:
+            response.set_etag(etag)
+        return response
     finally:
         db.close()
 
@@ -1835,25 +2044,15 @@ def add_department():
         name = request.form.get('name', '').strip()
         
         # Преобразуем строковые даты в объекты datetime
-        active_from = request.form.get('active_from')
-        active_to = request.form.get('active_to')
-        
-        if active_from:
-            active_from = datetime.datetime.strptime(active_from, '%Y-%m-%d')
-        else:
-            active_from = None
-            
-        if active_to:
-            active_to = datetime.datetime.strptime(active_to, '%Y-%m-%d')
-        else:
-            active_to = None
-            
-        db = SessionLocal()
+        active_from = _parse_form_date(request.form.get('active_from'))
+        active_to = _parse_form_date(request.form.get('active_to'))
+
+        db = db_session()
         dep = Department(name=name, active_from=active_from, active_to=active_to)
-        dep.update_active_status()  # Обновляем статус активности
         db.add(dep)
         db.commit()
         db.close()
+        _bump_dictionaries_cache()
         flash('Отделение добавлено', 'success')
         return redirect(url_for('dictionaries'))
     return render_template('edit_department.html', dep=None)
@@ -1861,8 +2060,8 @@ def add_department():
 @app.route('/edit_department/<int:dep_id>', methods=['GET', 'POST'])
 @login_required_role()
 def edit_department(dep_id):
-    db = SessionLocal()
-    dep = db.query(Department).get(dep_id)
+    db = db_session()
+    dep = db.get(Department, dep_id)
     if not dep:
         db.close()
         abort(404)
@@ -1870,22 +2069,12 @@ def edit_department(dep_id):
         dep.name = request.form.get('name', '').strip()
         
         # Преобразуем строковые даты в объекты datetime
-        active_from = request.form.get('active_from')
-        active_to = request.form.get('active_to')
-        
-        if active_from:
-            dep.active_from = datetime.datetime.strptime(active_from, '%Y-%m-%d')
-        else:
-            dep.active_from = None
-            
-        if active_to:
-            dep.active_to = datetime.datetime.strptime(active_to, '%Y-%m-%d')
-        else:
-            dep.active_to = None
-            
-        dep.update_active_status()  # Обновляем статус активности
+        dep.active_from = _parse_form_date(request.form.get('active_from'))
+        dep.active_to = _parse_form_date(request.form.get('active_to'))
+
         db.commit()
         db.close()
+        _bump_dictionaries_cache()
         flash('Отделение обновлено', 'success')
         return redirect(url_for('dictionaries'))
     db.close()
@@ -1894,38 +2083,30 @@ def edit_department(dep_id):
 @app.route('/delete_department/<int:dep_id>')
 @login_required_role()
 def delete_department(dep_id):
-    db = SessionLocal()
-    dep = db.query(Department).get(dep_id)
-    if dep:
-        db.delete(dep)
-        db.commit()
+    db = db_session()
+    # Снимаем ссылки у зависимых записей и удаляем одним DELETE без предварительного SELECT
+    db.execute(update(User).where(User.department_id == dep_id).values(department_id=None))
+    db.execute(update(Office).where(Office.department_id == dep_id).values(department_id=None))
+    result = db.execute(delete(Department).where(Department.id == dep_id))
+    db.commit()
+    _bump_dictionaries_cache()
+    if result.rowcount:
         flash('Отделение удалено', 'success')
-    db.close()
     return redirect(url_for('dictionaries'))
 
 @app.route('/add_office', methods=['GET', 'POST'])
 @login_required_role()
 def add_office():
-    db = SessionLocal()
+    db = db_session()
     departments = db.query(Department).all()
     if request.method == 'POST':
         name = request.form.get('name', '').strip()
         department_id = request.form.get('department_id')
         
         # Преобразуем строковые даты в объекты datetime
-        active_from = request.form.get('active_from')
-        active_to = request.form.get('active_to')
-        
-        if active_from:
-            active_from = datetime.datetime.strptime(active_from, '%Y-%m-%d')
-        else:
-            active_from = None
-            
-        if active_to:
-            active_to = datetime.datetime.strptime(active_to, '%Y-%m-%d')
-        else:
-            active_to = None
-            
+        active_from = _parse_form_date(request.form.get('active_from'))
+        active_to = _parse_form_date(request.form.get('active_to'))
+
         office = Office(
             name=name,
             department_id=department_id if department_id else None,
@@ -1936,6 +2117,7 @@ def add_office():
         db.add(office)
         db.commit()
         db.close()
+        _bump_dictionaries_cache()
         flash('Кабинет добавлен', 'success')
         return redirect(url_for('dictionaries'))
     db.close()
@@ -1944,8 +2126,8 @@ def add_office():
 @app.route('/edit_office/<int:office_id>', methods=['GET', 'POST'])
 @login_required_role()
 def edit_office(office_id):
-    db = SessionLocal()
-    office = db.query(Office).get(office_id)
+    db = db_session()
+    office = db.get(Office, office_id)
     if not office:
         db.close()
         abort(404)
@@ -1955,22 +2137,13 @@ def edit_office(office_id):
         office.department_id = request.form.get('department_id')
         
         # Преобразуем строковые даты в объекты datetime
-        active_from = request.form.get('active_from')
-        active_to = request.form.get('active_to')
-        
-        if active_from:
-            office.active_from = datetime.datetime.strptime(active_from, '%Y-%m-%d')
-        else:
-            office.active_from = None
-            
-        if active_to:
-            office.active_to = datetime.datetime.strptime(active_to, '%Y-%m-%d')
-        else:
-            office.active_to = None
-            
+        office.active_from = _parse_form_date(request.form.get('active_from'))
+        office.active_to = _parse_form_date(request.form.get('active_to'))
+
         office.update_active_status()  # Обновляем статус активности
         db.commit()
         db.close()
+        _bump_dictionaries_cache()
         flash('Кабинет обновлен', 'success')
         return redirect(url_for('dictionaries'))
     db.close()
@@ -1979,13 +2152,13 @@ def edit_office(office_id):
 @app.route('/delete_office/<int:office_id>')
 @login_required_role()
 def delete_office(office_id):
-    db = SessionLocal()
-    office = db.query(Office).get(office_id)
-    if office:
-        db.delete(office)
-        db.commit()
+    db = db_session()
+    db.execute(update(User).where(User.office_id == office_id).values(office_id=None))
+    result = db.execute(delete(Office).where(Office.id == office_id))
+    db.commit()
+    _bump_dictionaries_cache()
+    if result.rowcount:
         flash('Кабинет удалён', 'success')
-    db.close()
     return redirect(url_for('dictionaries'))
 
 @app.route('/add_position', methods=['GET', 'POST'])
@@ -1995,25 +2168,15 @@ def add_position():
         name = request.form.get('name', '').strip()
         
         # Преобразуем строковые даты в объекты datetime
-        active_from = request.form.get('active_from')
-        active_to = request.form.get('active_to')
-        
-        if active_from:
-            active_from = datetime.datetime.strptime(active_from, '%Y-%m-%d')
-        else:
-            active_from = None
-            
-        if active_to:
-            active_to = datetime.datetime.strptime(active_to, '%Y-%m-%d')
-        else:
-            active_to = None
-            
-        db = SessionLocal()
+        active_from = _parse_form_date(request.form.get('active_from'))
+        active_to = _parse_form_date(request.form.get('active_to'))
+
+        db = db_session()
         pos = Position(name=name, active_from=active_from, active_to=active_to)
-        pos.update_active_status()  # Обновляем статус активности
         db.add(pos)
         db.commit()
         db.close()
+        _bump_dictionaries_cache()
         flash('Должность добавлена', 'success')
         return redirect(url_for('dictionaries'))
     return render_template('edit_position.html', pos=None)
@@ -2021,8 +2184,8 @@ def add_position():
 @app.route('/edit_position/<int:pos_id>', methods=['GET', 'POST'])
 @login_required_role()
 def edit_position(pos_id):
-    db = SessionLocal()
-    pos = db.query(Position).get(pos_id)
+    db = db_session()
+    pos = db.get(Position, pos_id)
     if not pos:
         db.close()
         abort(404)
@@ -2030,22 +2193,12 @@ def edit_position(pos_id):
         pos.name = request.form.get('name', '').strip()
         
         # Преобразуем строковые даты в объекты datetime
-        active_from = request.form.get('active_from')
-        active_to = request.form.get('active_to')
-        
-        if active_from:
-            pos.active_from = datetime.datetime.strptime(active_from, '%Y-%m-%d')
-        else:
-            pos.active_from = None
-            
-        if active_to:
-            pos.active_to = datetime.datetime.strptime(active_to, '%Y-%m-%d')
-        else:
-            pos.active_to = None
-            
-        pos.update_active_status()  # Обновляем статус активности
+        pos.active_from = _parse_form_date(request.form.get('active_from'))
+        pos.active_to = _parse_form_date(request.form.get('active_to'))
+
         db.commit()
         db.close()
+        _bump_dictionaries_cache()
         flash('Должность обновлена', 'success')
         return redirect(url_for('dictionaries'))
     db.close()
@@ -2054,27 +2207,82 @@ def edit_position(pos_id):
 @app.route('/delete_position/<int:pos_id>')
 @login_required_role()
 def delete_position(pos_id):
-    db = SessionLocal()
-    pos = db.query(Position).get(pos_id)
-    if pos:
-        db.delete(pos)
-        db.commit()
+    db = db_session()
+    db.execute(update(User).where(User.position_id == pos_id).values(position_id=None))
+    result = db.execute(delete(Position).where(Position.id == pos_id))
+    db.commit()
+    _bump_dictionaries_cache()
+    if result.rowcount:
         flash('Должность удалена', 'success')
-    db.close()
     return redirect(url_for('dictionaries'))
 
 @app.route('/delete_category/<int:category_id>')
 @login_required_role(['curator'])
 def delete_category(category_id):
-    db = SessionLocal()
-    category = db.query(TicketCategory).get(category_id)
-    if category:
-        db.delete(category)
-        db.commit()
+    db = db_session()
+    db.execute(update(Ticket).where(Ticket.category_id == category_id).values(category_id=None))
+    result = db.execute(delete(TicketCategory).where(TicketCategory.id == category_id))
+    db.commit()
+    _bump_dictionaries_cache()
+    invalidate_categories()
+    if result.rowcount:
         flash('Категория удалена', 'success')
-    db.close()
     return redirect(url_for('dictionaries'))
 
+def _bulk_add_dictionary(model):
+    """Пакетное добавление записей справочника: один executemany и один commit
+    вместо цикла add+commit по записи."""
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        return jsonify({"success": False, "error": "Ожидается непустой JSON-массив"}), 400
+
+    # У Department/Position активность выводится из дат (hybrid-свойство),
+    # хранимая колонка is_active осталась только у Office
+    stores_is_active = 'is_active' in model.__table__.c
+
+    rows = []
+    for item in items:
+        name = (item.get('name') or '').strip()
+        if not name:
+            return jsonify({"success": False, "error": "У каждой записи должно быть указано название"}), 400
+        active_from = _parse_form_date(item.get('active_from'))
+        active_to = _parse_form_date(item.get('active_to'))
+        row = {
+            'name': name,
+            'active_from': active_from,
+            'active_to': active_to,
+        }
+        if stores_is_active:
+            row['is_active'] = _compute_is_active(active_from, active_to)
+        if model is Office:
+            row['department_id'] = item.get('department_id') or None
+        rows.append(row)
+
+    db = db_session()
+    try:
+        db.execute(insert(model), rows)
+        db.commit()
+        _bump_dictionaries_cache()
+        return jsonify({"success": True, "created": len(rows)})
+    except Exception as e:
+        db.rollback()
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/bulk_add_department', methods=['POST'])
+@login_required_role()
+def bulk_add_department():
+    return _bulk_add_dictionary(Department)
+
+@app.route('/bulk_add_office', methods=['POST'])
+@login_required_role()
+def bulk_add_office():
+    return _bulk_add_dictionary(Office)
+
+@app.route('/bulk_add_position', methods=['POST'])
+@login_required_role()
+def bulk_add_position():
+    return _bulk_add_dictionary(Position)
+
 @app.template_filter('datetime_msk')
 def format_datetime_msk(value, fmt='%d.%m.%Y %H:%M'):
     if value is None:
@@ -2082,8 +2290,7 @@ def format_datetime_msk(value, fmt='%d.%m.%Y %H:%M'):
     # Если value — naive datetime, делаем его aware в UTC
     if value.tzinfo is None:
         value = utc.localize(value)
-    msk = timezone('Europe/Moscow')
-    return value.astimezone(msk).strftime(fmt)
+    return value.astimezone(MSK_TZ).strftime(fmt)
 
 if __name__ == '__main__':
     debug_mode = os.getenv("DEBUG", "False").lower() in ("true", "1", "t")
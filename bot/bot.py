@@ -1,24 +1,37 @@
+import hashlib
+import heapq
+import html
 import logging
 import os
 import re
+import traceback
+from collections import OrderedDict
 import nest_asyncio
 import asyncio.exceptions
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
 from aiogram.filters import Command, CommandObject
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, InputFile, FSInputFile
-from sqlalchemy.orm import Session
+from sqlalchemy import func, or_, and_, case, insert
+from sqlalchemy.orm import Session, selectinload
 from typing import List, Optional
 import sys
 import datetime
+import time
+import threading
 import asyncio
-from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
-from models.db_init import SessionLocal
+import aiofiles
+from models.db_init import SessionLocal, session_scope
 import json
 from pytz import timezone, utc
 
@@ -39,12 +52,106 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Initialization flag
 _DEPENDENCIES_LOADED = True
 
+# Предкомпилированный шаблон очистки HTML-тегов для повторной отправки без разметки
+_HTML_TAG_RE = re.compile(r'<[^>]*>')
+
+# ФИО: только буквы (включая кириллицу) и пробелы между словами
+_FULLNAME_RE = re.compile(r'^[^\W\d_]+(?:\s+[^\W\d_]+)*$', re.UNICODE)
+
+# Отображаемые названия статусов заявки
+_STATUS_RU = {
+    "new": "Новая",
+    "in_progress": "В работе",
+    "resolved": "Решена",
+    "irrelevant": "Неактуальна",
+    "closed": "Закрыта",
+}
+
 # Initialize bot and dispatcher
 API_TOKEN = os.getenv("TELEGRAM_API_TOKEN", "")
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+# Одна aiohttp-сессия на всё время жизни бота с увеличенным пулом
+# keep-alive соединений к api.telegram.org — без неё каждый запрос
+# заново проходил бы TCP/TLS-рукопожатие при всплесках рассылок
+bot = Bot(token=API_TOKEN, session=AiohttpSession(limit=50))
+
+# FSM-хранилище: при заданном REDIS_URL состояния живут в Redis — это
+# позволяет запускать несколько воркеров за webhook и автоматически
+# чистит устаревшие сессии по TTL (в Redis проверка неактивности через
+# dp.storage.data не работает, её заменяет TTL). Без Redis — MemoryStorage.
+_redis_url = os.getenv("REDIS_URL")
+if _redis_url:
+    from aiogram.fsm.storage.redis import RedisStorage
+    storage = RedisStorage.from_url(_redis_url, state_ttl=86400, data_ttl=86400)
+else:
+    storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
+# Вторичный индекс активности в Redis (sorted set user_id -> epoch):
+# позволяет выбирать просроченных пользователей одним ZRANGEBYSCORE
+# вместо обхода всех состояний
+_USING_REDIS_STORAGE = bool(_redis_url)
+_ACTIVITY_ZSET_KEY = "helpdesk:last_activity"
+
+# Тайм-аут неактивности, после которого сбрасывается активная заявка
+_INACTIVITY_TIMEOUT = 3 * 3600
+
+# Очередь дедлайнов неактивности для MemoryStorage: (deadline, user_id).
+# Событие будит задачу зачистки при новой активности, чтобы она
+# пересчитала время сна до ближайшего дедлайна
+_expiry_heap = []
+_sweep_wake = asyncio.Event()
+
+class DBSessionMiddleware(BaseMiddleware):
+    """Одна сессия БД на апдейт.
+
+    Сессия открывается на входе и передаётся обработчику через data["db"];
+    при успехе — commit, при исключении — rollback. Обработчикам больше
+    не нужно открывать и закрывать SessionLocal() самостоятельно.
+    """
+    async def __call__(self, handler, event, data):
+        session = SessionLocal()
+        data["db"] = session
+        try:
+            result = await handler(event, data)
+            session.commit()
+            return result
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+dp.update.middleware(DBSessionMiddleware())
+
+# Цикл событий бота: заполняется в start_bot, чтобы синхронные вызовы
+# из веб-части могли отправлять сообщения через общую aiohttp-сессию бота
+BOT_LOOP = None
+
+def _run_on_bot_loop(coro):
+    """Выполняет корутину в цикле бота из синхронного кода.
+
+    Returns:
+        bool | None: результат корутины, либо None если цикл бота не запущен
+        (в этом случае вызывающий код использует прямой HTTP-запрос).
+    """
+    if BOT_LOOP is not None and BOT_LOOP.is_running():
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is BOT_LOOP:
+            # Вызов из самого цикла бота: ожидание результата заблокировало бы
+            # обработку всех апдейтов, поэтому планируем отправку в фоне
+            asyncio.ensure_future(coro)
+            return True
+        try:
+            return asyncio.run_coroutine_threadsafe(coro, BOT_LOOP).result(15)
+        except Exception as e:
+            logging.error(f"Ошибка при отправке через цикл бота: {str(e)}")
+            return False
+    coro.close()
+    return None
+
 class RegistrationStates(StatesGroup):
     waiting_for_gdpr_consent = State()
     waiting_for_fullname = State()
@@ -69,9 +176,33 @@ class TicketSelectStates(StatesGroup):
 class ActiveTicketStates(StatesGroup):
     chatting = State()
 
+# TTL-кэш пользователей по chat_id: каждый апдейт Telegram начинается
+# с одного и того же SELECT по users, кэш снимает его с горячего пути.
+# Устаревание профиля ограничено временем жизни записи.
+_USER_CACHE_TTL = 60  # секунд
+_USER_CACHE_MAX = 10_000
+_USER_CACHE = {}  # chat_id -> (User, время записи)
+
+def invalidate_user(chat_id):
+    """Сбрасывает кэш пользователя после регистрации или изменения профиля"""
+    _USER_CACHE.pop(str(chat_id), None)
+
 # Helper function to check if user exists
 def get_user_by_chat_id(chat_id: str, db: Session) -> Optional[User]:
-    return db.query(User).filter(User.chat_id == str(chat_id)).first()
+    key = str(chat_id)
+    cached = _USER_CACHE.get(key)
+    if cached is not None:
+        user, stored_at = cached
+        if time.monotonic() - stored_at < _USER_CACHE_TTL:
+            # Прикрепляем отсоединённый объект к текущей сессии без SELECT
+            return db.merge(user, load=False)
+        del _USER_CACHE[key]
+    user = db.query(User).filter(User.chat_id == key).first()
+    if user is not None:
+        if len(_USER_CACHE) >= _USER_CACHE_MAX:
+            _USER_CACHE.clear()
+        _USER_CACHE[key] = (user, time.monotonic())
+    return user
 
 # Helper function to check user status
 async def check_user_status(chat_id: str, db: Session):
@@ -104,6 +235,77 @@ async def check_user_status(chat_id: str, db: Session):
     # Все проверки пройдены
     return True, None, user
 
+# Общая HTTP-сессия к Telegram API: переиспользуем TCP/TLS-соединения
+# вместо нового рукопожатия на каждый вызов sync_send_*
+_TG_SESSION = requests.Session()
+_TG_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# Простейший circuit breaker вокруг HTTP-запросов к Telegram: после серии
+# инфраструктурных ошибок (429/5xx/сеть) временно перестаём ходить в API,
+# чтобы не раскручивать каскад повторов. Retry-After и экспоненциальный
+# backoff на уровне отдельных запросов обеспечивает Retry в _TG_SESSION.
+_BREAKER_FAIL_MAX = 20
+_BREAKER_RESET_TIMEOUT = 30  # секунд
+_breaker_lock = threading.Lock()
+_breaker_failures = 0
+_breaker_opened_at = None
+
+def _breaker_allows():
+    global _breaker_failures, _breaker_opened_at
+    with _breaker_lock:
+        if _breaker_opened_at is None:
+            return True
+        if time.monotonic() - _breaker_opened_at >= _BREAKER_RESET_TIMEOUT:
+            # Полуоткрытое состояние: пробуем снова
+            _breaker_opened_at = None
+            _breaker_failures = 0
+            return True
+        return False
+
+def _breaker_record(success):
+    global _breaker_failures, _breaker_opened_at
+    with _breaker_lock:
+        if success:
+            _breaker_failures = 0
+        elif _breaker_opened_at is None:
+            _breaker_failures += 1
+            if _breaker_failures >= _BREAKER_FAIL_MAX:
+                _breaker_opened_at = time.monotonic()
+                logging.error(
+                    f"Telegram API: {_breaker_failures} ошибок подряд, "
+                    f"приостанавливаем отправку на {_BREAKER_RESET_TIMEOUT} с"
+                )
+
+def _tg_post(api_url, **kwargs):
+    """POST к Telegram API с учётом circuit breaker.
+
+    Returns:
+        Response | None: None, если цепь разомкнута и запрос не выполнялся.
+    """
+    if not _breaker_allows():
+        logging.warning("Отправка в Telegram пропущена: circuit breaker открыт")
+        return None
+    try:
+        response = _TG_SESSION.post(api_url, **kwargs)
+    except Exception:
+        _breaker_record(False)
+        raise
+    # Ошибкой инфраструктуры считаем только 429 и 5xx; 4xx вроде плохого
+    # HTML — проблема конкретного сообщения, цепь из-за них не размыкаем
+    _breaker_record(response.status_code != 429 and response.status_code < 500)
+    return response
+
+# Префиксы chat_id, по которым отправка невозможна (учётки без Telegram);
+# один вызов startswith с кортежем проверяет все разом
+_BLOCKED_CHAT_PREFIXES = ('manual_',)
+
+def _is_blocked_chat_id(chat_id):
+    return isinstance(chat_id, str) and chat_id.startswith(_BLOCKED_CHAT_PREFIXES)
+
 # Функция для отправки уведомлений (синхронная)
 def sync_send_notification(chat_id, message):
     if not chat_id:
@@ -111,7 +313,7 @@ def sync_send_notification(chat_id, message):
         return False
 
     # Check for manually created users
-    if isinstance(chat_id, str) and chat_id.startswith('manual_'):
+    if _is_blocked_chat_id(chat_id):
         logging.warning(f"Попытка отправки сообщения вручную созданному пользователю: {chat_id}")
         return False
 
@@ -119,7 +321,12 @@ def sync_send_notification(chat_id, message):
     chat_id_str = str(chat_id).strip()
     logging.info(f"Отправка сообщения пользователю {chat_id_str}: {message[:50]}...")
 
-    # Prepare the API request
+    # Если цикл бота запущен, отправляем через его aiohttp-сессию
+    delegated = _run_on_bot_loop(send_notification(chat_id_str, message))
+    if delegated is not None:
+        return delegated
+
+    # Бот не запущен (например, веб-часть работает отдельно) — прямой HTTP-запрос
     api_url = f"https://api.telegram.org/bot{API_TOKEN}/sendMessage"
 
     try:
@@ -130,24 +337,31 @@ def sync_send_notification(chat_id, message):
             'parse_mode': 'HTML'
         }
 
-        response = requests.post(api_url, json=payload, timeout=10)
+        # stream=True: тело ответа на успехе не нужно, не буферизуем его
+        response = _tg_post(api_url, json=payload, timeout=10, stream=True)
+        if response is None:
+            return False
 
         if response.status_code == 200:
+            response.close()
             logging.info(f"Сообщение успешно отправлено пользователю {chat_id_str}")
             return True
 
         # If HTML parsing fails, try without HTML
         logging.warning(f"Ошибка при отправке сообщения: {response.text}. Пробуем без парсинга HTML...")
-        clean_message = re.sub(r'<[^>]*>', '', message)
+        clean_message = _HTML_TAG_RE.sub('', message)
 
         payload = {
             'chat_id': chat_id_str,
             'text': clean_message
         }
 
-        response = requests.post(api_url, json=payload, timeout=10)
+        response = _tg_post(api_url, json=payload, timeout=10, stream=True)
+        if response is None:
+            return False
 
         if response.status_code == 200:
+            response.close()
             logging.info(f"Сообщение успешно отправлено пользователю {chat_id_str} (без HTML)")
             return True
         else:
@@ -162,7 +376,6 @@ def sync_send_notification(chat_id, message):
             logging.error(f"Тип ошибки: {error_type}")
 
             if hasattr(e, '__traceback__'):
-                import traceback
                 error_trace = ''.join(traceback.format_tb(e.__traceback__))
                 logging.error(f"Трассировка: {error_trace}")
         except:
@@ -188,7 +401,7 @@ def sync_send_photo(chat_id, photo_path, caption=None):
         return False
 
     # Check for manually created users
-    if isinstance(chat_id, str) and chat_id.startswith('manual_'):
+    if _is_blocked_chat_id(chat_id):
         logging.warning(f"Попытка отправки фото вручную созданному пользователю: {chat_id}")
         return False
 
@@ -200,12 +413,16 @@ def sync_send_photo(chat_id, photo_path, caption=None):
         logging.error("Telegram bot token is not configured")
         return False
 
+    # Если цикл бота запущен, отправляем через его aiohttp-сессию
+    delegated = _run_on_bot_loop(send_photo_notification(chat_id_str, photo_path, caption))
+    if delegated is not None:
+        return delegated
+
     try:
         # Prepare API URL for sendPhoto
         api_url = f"https://api.telegram.org/bot{API_TOKEN}/sendPhoto"
 
         # Prepare request data
-        files = {'photo': open(photo_path, 'rb')}
         data = {'chat_id': chat_id_str}
 
         # Add caption if provided
@@ -213,10 +430,14 @@ def sync_send_photo(chat_id, photo_path, caption=None):
             data['caption'] = caption
             data['parse_mode'] = 'HTML'
 
-        # Send the request
-        response = requests.post(api_url, files=files, data=data, timeout=30)
+        # Send the request: with гарантирует закрытие дескриптора и при ошибке
+        with open(photo_path, 'rb') as photo_file:
+            response = _tg_post(api_url, files={'photo': photo_file}, data=data, timeout=30, stream=True)
+        if response is None:
+            return False
 
         if response.status_code == 200:
+            response.close()
             logging.info(f"Фото успешно отправлено пользователю {chat_id_str}")
             return True
         else:
@@ -227,7 +448,6 @@ def sync_send_photo(chat_id, photo_path, caption=None):
     except Exception as e:
         logging.error(f"Ошибка при отправке фото пользователю {chat_id}: {str(e)}")
         if hasattr(e, '__traceback__'):
-            import traceback
             error_trace = ''.join(traceback.format_tb(e.__traceback__))
             logging.error(f"Трассировка: {error_trace}")
         return False
@@ -241,21 +461,34 @@ def sync_send_document(chat_id, document_path, caption=None, original_filename=N
         logging.error(f"Невозможно отправить документ: chat_id отсутствует")
         return False
 
+    if _is_blocked_chat_id(chat_id):
+        logging.warning(f"Попытка отправки документа вручную созданному пользователю: {chat_id}")
+        return False
+
     chat_id_str = str(chat_id).strip()
+
+    # Если цикл бота запущен, отправляем через его aiohttp-сессию
+    delegated = _run_on_bot_loop(send_document_notification(chat_id_str, document_path, caption, original_filename))
+    if delegated is not None:
+        return delegated
+
     api_url = f"https://api.telegram.org/bot{API_TOKEN}/sendDocument"
 
     try:
         # Если передано оригинальное имя файла, используем его, иначе берём имя файла из пути
         if original_filename is None:
-            import os
             original_filename = os.path.basename(document_path)
-        files = {'document': (original_filename, open(document_path, 'rb'))}
         data = {'chat_id': chat_id_str}
         if caption:
             data['caption'] = caption
             data['parse_mode'] = 'HTML'
-        response = requests.post(api_url, files=files, data=data, timeout=30)
+        # with гарантирует закрытие дескриптора и при ошибке
+        with open(document_path, 'rb') as document_file:
+            response = _tg_post(api_url, files={'document': (original_filename, document_file)}, data=data, timeout=30, stream=True)
+        if response is None:
+            return False
         if response.status_code == 200:
+            response.close()
             logging.info(f"Документ успешно отправлен пользователю {chat_id_str}")
             return True
         else:
@@ -272,6 +505,14 @@ async def send_notification(chat_id, message):
     try:
         await bot.send_message(chat_id=chat_id, text=message, parse_mode="HTML")
         return True
+    except TelegramBadRequest:
+        # Не распарсился HTML — повторяем без разметки
+        try:
+            await bot.send_message(chat_id=chat_id, text=_HTML_TAG_RE.sub('', message))
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка при отправке уведомления пользователю {chat_id}: {str(e)}")
+            return False
     except TelegramForbiddenError:
         logging.warning(f"Пользователь {chat_id} заблокировал бота")
         return False
@@ -279,35 +520,143 @@ async def send_notification(chat_id, message):
         logging.error(f"Ошибка при отправке уведомления пользователю {chat_id}: {str(e)}")
         return False
 
+async def send_photo_notification(chat_id, photo_path, caption=None):
+    """Отправляет фото через aiohttp-сессию бота (файл стримится с диска)"""
+    try:
+        await bot.send_photo(
+            chat_id=chat_id,
+            photo=FSInputFile(photo_path),
+            caption=caption,
+            parse_mode="HTML" if caption else None
+        )
+        return True
+    except TelegramForbiddenError:
+        logging.warning(f"Пользователь {chat_id} заблокировал бота")
+        return False
+    except Exception as e:
+        logging.error(f"Ошибка при отправке фото пользователю {chat_id}: {str(e)}")
+        return False
+
+async def send_document_notification(chat_id, document_path, caption=None, original_filename=None):
+    """Отправляет документ через aiohttp-сессию бота (файл стримится с диска)"""
+    try:
+        document = FSInputFile(document_path, filename=original_filename or os.path.basename(document_path))
+        await bot.send_document(
+            chat_id=chat_id,
+            document=document,
+            caption=caption,
+            parse_mode="HTML" if caption else None
+        )
+        return True
+    except TelegramForbiddenError:
+        logging.warning(f"Пользователь {chat_id} заблокировал бота")
+        return False
+    except Exception as e:
+        logging.error(f"Ошибка при отправке документа пользователю {chat_id}: {str(e)}")
+        return False
+
+# Кэш активных категорий заявок: справочник меняется редко, поэтому
+# держим лёгкие кортежи (id, name) и обновляем не чаще раза в 5 минут
+_CATEGORY_CACHE_TTL = 300  # секунд
+_CATEGORY_CACHE = None  # (время записи, [(id, name), ...])
+
+def invalidate_categories():
+    """Сбрасывает кэш категорий после изменения справочника"""
+    global _CATEGORY_CACHE
+    _CATEGORY_CACHE = None
+
+def get_active_categories(db):
+    """Возвращает [(id, name)] активных категорий с кэшированием"""
+    global _CATEGORY_CACHE
+    now = time.monotonic()
+    if _CATEGORY_CACHE is not None and now - _CATEGORY_CACHE[0] < _CATEGORY_CACHE_TTL:
+        return _CATEGORY_CACHE[1]
+    rows = db.query(TicketCategory.id, TicketCategory.name)\
+        .filter(TicketCategory.is_active == True).all()
+    _CATEGORY_CACHE = (now, rows)
+    return rows
+
+# Глобальный лимит Telegram — 30 сообщений в секунду на бота
+_BROADCAST_SEMAPHORE = asyncio.Semaphore(30)
+
+async def _send_one_notification(chat_id, message):
+    async with _BROADCAST_SEMAPHORE:
+        return await send_notification(chat_id, message)
+
+async def send_notification_bulk(chat_ids, message):
+    """Рассылает одно сообщение списку чатов параллельно.
+
+    Вместо последовательных await (N × RTT) все отправки уходят через
+    asyncio.gather; семафор не даёт превысить лимит Telegram.
+
+    Returns:
+        dict: chat_id -> True/False по результату отправки
+    """
+    chat_ids = list(chat_ids)
+    results = await asyncio.gather(*(_send_one_notification(cid, message) for cid in chat_ids))
+    return dict(zip(chat_ids, results))
+
+# Прототипы навигационных кнопок: при рендере клонируются
+# с подменой callback_data вместо создания с нуля
+_NAV_BACK_BTN = InlineKeyboardButton(text="◀️ Назад", callback_data="page:0")
+_NAV_FORWARD_BTN = InlineKeyboardButton(text="Вперед ▶️", callback_data="page:0")
+
+# Кэш собранных клавиатур списка заявок: {(chat_id, page): (ts, markup)}.
+# Короткий TTL покрывает быстрое листание страниц без похода в БД;
+# при создании заявки кэш чата сбрасывается явно
+_TICKETS_KB_CACHE = {}
+_TICKETS_KB_TTL = 30
+_TICKETS_KB_MAX = 512
+
+
+def invalidate_tickets_keyboard(chat_id):
+    """Сбрасывает кэш клавиатур списка заявок для чата"""
+    chat_id_str = str(chat_id)
+    for key in [k for k in _TICKETS_KB_CACHE if k[0] == chat_id_str]:
+        del _TICKETS_KB_CACHE[key]
+
+
 # Function to create inline keyboard for tickets
-async def create_tickets_keyboard(tickets, page=0, items_per_page=3):
+async def create_tickets_keyboard(db, chat_id, page=0, items_per_page=3):
+    """Строит клавиатуру страницы заявок пользователя.
+
+    Пагинация выполняется на уровне SQL (LIMIT/OFFSET), выбираются только
+    колонки, нужные для кнопок — полный список заявок не материализуется.
+    Готовая разметка кэшируется на _TICKETS_KB_TTL секунд.
+    """
+    chat_id_str = str(chat_id)
+    cache_key = (chat_id_str, page)
+    cached = _TICKETS_KB_CACHE.get(cache_key)
+    if cached and time.monotonic() - cached[0] < _TICKETS_KB_TTL:
+        return cached[1]
+    total = db.query(func.count(Ticket.id))\
+        .filter(Ticket.creator_chat_id == chat_id_str).scalar() or 0
+    page_tickets = db.query(Ticket.id, Ticket.title, Ticket.status, Ticket.created_at)\
+        .filter(Ticket.creator_chat_id == chat_id_str)\
+        .order_by(Ticket.created_at.desc())\
+        .limit(items_per_page)\
+        .offset(page * items_per_page)\
+        .all()
+
     builder = InlineKeyboardBuilder()
-    start_idx = page * items_per_page
-    end_idx = start_idx + items_per_page
-    current_page_tickets = tickets[start_idx:end_idx]
-
-    for ticket in current_page_tickets:
-        status_text = "Новая" if ticket.status == "new" else \
-                    "В работе" if ticket.status == "in_progress" else \
-                    "Решена" if ticket.status == "resolved" else \
-                    "Неактуальна" if ticket.status == "irrelevant" else "Закрыта"
-        created_date = to_msk(ticket.created_at).strftime('%d.%m.%Y')
-        title_display = ticket.title
+    for ticket_id, title, status, created_at in page_tickets:
+        status_text = _STATUS_RU.get(status, "Закрыта")
+        created_date = to_msk(created_at).strftime('%d.%m.%Y')
+        title_display = title
         if len(title_display) > 25:
             title_display = title_display[:22] + "..."
         button_text = f"📅 {created_date} | {status_text}\n📝 {title_display}"
         builder.row(InlineKeyboardButton(
             text=button_text,
-            callback_data=f"select_ticket:{ticket.id}"
+            callback_data=f"select_ticket:{ticket_id}"
         ))
 
     navigation_buttons = []
-    page_count = (len(tickets) + items_per_page - 1) // items_per_page
+    page_count = max(1, (total + items_per_page - 1) // items_per_page)
     # Кнопка "Назад" (если не на первой странице)
     if page > 0:
-        navigation_buttons.append(InlineKeyboardButton(
-            text="◀️ Назад",
-            callback_data=f"page:{page-1}"
+        navigation_buttons.append(_NAV_BACK_BTN.model_copy(
+            update={"callback_data": f"page:{page-1}"}
         ))
     # Кнопка с номером страницы (неактивная)
     navigation_buttons.append(InlineKeyboardButton(
@@ -315,39 +664,52 @@ async def create_tickets_keyboard(tickets, page=0, items_per_page=3):
         callback_data="page_info"
     ))
     # Кнопка "Вперед" (если не на последней странице)
-    if (page + 1) * items_per_page < len(tickets):
-        navigation_buttons.append(InlineKeyboardButton(
-            text="Вперед ▶️",
-            callback_data=f"page:{page+1}"
+    if (page + 1) * items_per_page < total:
+        navigation_buttons.append(_NAV_FORWARD_BTN.model_copy(
+            update={"callback_data": f"page:{page+1}"}
         ))
     builder.row(*navigation_buttons)
-    return builder.as_markup()
+    markup = builder.as_markup()
+    if len(_TICKETS_KB_CACHE) >= _TICKETS_KB_MAX:
+        _TICKETS_KB_CACHE.pop(next(iter(_TICKETS_KB_CACHE)))
+    _TICKETS_KB_CACHE[cache_key] = (time.monotonic(), markup)
+    return markup
 
 # Function to update user's last activity timestamp
 async def update_user_activity(user_id, state: FSMContext):
-    """Update the user's last activity timestamp in their state data"""
-    current_time = datetime.datetime.now().isoformat()
+    """Update the user's last activity timestamp in their state data
+
+    Хранится как float-секунды (time.time()): дешевле ISO-строки на каждом
+    сообщении и компактнее в FSM-хранилище; в строку форматируем только при выводе.
+    """
+    current_time = time.time()
     await state.update_data(last_activity=current_time)
+    if _USING_REDIS_STORAGE:
+        try:
+            await storage.redis.zadd(_ACTIVITY_ZSET_KEY, {str(user_id): current_time})
+        except Exception as e:
+            logging.error(f"Не удалось обновить индекс активности в Redis: {e}")
+    else:
+        # Планируем проверку неактивности на момент истечения тайм-аута
+        # и будим задачу зачистки, чтобы она пересчитала ближайший дедлайн
+        heapq.heappush(_expiry_heap, (current_time + _INACTIVITY_TIMEOUT, int(user_id)))
+        _sweep_wake.set()
     logging.debug(f"Updated last activity for user {user_id} to {current_time}")
 
 # Start command handler
 @dp.message(Command("start"))
-async def send_welcome(message: types.Message, state: FSMContext):
+async def send_welcome(message: types.Message, state: FSMContext, db: Session):
     """Обрабатывает команду /start"""
     try:
         # Проверяем, зарегистрирован ли пользователь
-        user_db = SessionLocal()
-        try:
-            existing_user = get_user_by_chat_id(str(message.chat.id), user_db)
-            if existing_user:
-                await message.answer(
-                    f"С возвращением, {existing_user.full_name}! 👋\n\n"
-                    "Используйте /help для просмотра доступных команд."
-                )
-                await update_user_activity(message.chat.id, state)
-                return
-        finally:
-            user_db.close()
+        existing_user = get_user_by_chat_id(str(message.chat.id), db)
+        if existing_user:
+            await message.answer(
+                f"С возвращением, {existing_user.full_name}! 👋\n\n"
+                "Используйте /help для просмотра доступных команд."
+            )
+            await update_user_activity(message.chat.id, state)
+            return
 
         # Если пользователь не зарегистрирован, начинаем процесс регистрации
         gdpr_text = (
@@ -403,7 +765,7 @@ async def process_gdpr_consent(callback: CallbackQuery, state: FSMContext):
 # Process fullname input
 @dp.message(RegistrationStates.waiting_for_fullname)
 async def process_fullname(message: types.Message, state: FSMContext):
-    if not all(c.isalpha() or c.isspace() for c in message.text):
+    if not _FULLNAME_RE.match(message.text):
         await message.answer("ФИО должно содержать только буквы и пробелы. Пожалуйста, попробуйте снова:")
         return
 
@@ -445,15 +807,10 @@ async def process_department_callback(callback: CallbackQuery, state: FSMContext
 # Process office input and continue registration (ask for phone)
 @dp.message(RegistrationStates.waiting_for_office)
 async def process_office(message: types.Message, state: FSMContext):
-    user_db = SessionLocal()
-
-    try:
-        await state.update_data(office=message.text)
-        await message.answer("Спасибо! Теперь введите ваш номер телефона (можно пропустить, отправив '-'):")
-        await state.set_state(RegistrationStates.waiting_for_phone)
-        await update_user_activity(message.chat.id, state)
-    finally:
-        user_db.close()
+    await state.update_data(office=message.text)
+    await message.answer("Спасибо! Теперь введите ваш номер телефона (можно пропустить, отправив '-'):")
+    await state.set_state(RegistrationStates.waiting_for_phone)
+    await update_user_activity(message.chat.id, state)
 
 # Process phone input
 @dp.message(RegistrationStates.waiting_for_phone)
@@ -470,20 +827,34 @@ async def process_phone(message: types.Message, state: FSMContext):
 
 # Process email input and complete registration
 @dp.message(RegistrationStates.waiting_for_email)
-async def process_email(message: types.Message, state: FSMContext):
+async def process_email(message: types.Message, state: FSMContext, db: Session):
     """Обрабатывает ввод email и завершает регистрацию"""
     email = message.text.strip()
-    
+
     # Проверяем формат email
     if not re.match(r"[^@]+@[^@]+\.[^@]+", email):
         await message.answer("Пожалуйста, введите корректный email адрес.")
         return
-    
+
     # Получаем все данные из состояния
     data = await state.get_data()
-    
+
+    # Проверка занятости chat_id/email: лёгкий запрос по id через индексы,
+    # полная строка пользователя для ветвления не нужна
+    taken = db.query(User.id).filter(
+        or_(
+            User.chat_id == str(message.chat.id),
+            and_(User.email == email, User.email.isnot(None))
+        )
+    ).first() is not None
+    if taken:
+        await message.answer(
+            "Пользователь с таким Telegram или email уже зарегистрирован. "
+            "Используйте /profile для просмотра своего профиля."
+        )
+        return
+
     # Создаем нового пользователя
-    user_db = SessionLocal()
     try:
         new_user = User(
             chat_id=str(message.chat.id),
@@ -501,9 +872,10 @@ async def process_email(message: types.Message, state: FSMContext):
             role='user'
         )
         
-        user_db.add(new_user)
-        user_db.commit()
-        
+        db.add(new_user)
+        db.commit()
+        invalidate_user(message.chat.id)
+
         await message.answer(
             "✅ Регистрация успешно завершена!\n\n"
             "Ваш аккаунт ожидает подтверждения администратором. "
@@ -511,21 +883,22 @@ async def process_email(message: types.Message, state: FSMContext):
             "Используйте /help для просмотра доступных команд."
         )
         
-        # Отправляем уведомление администраторам
-        admin_users = user_db.query(User).filter(User.role == 'admin').all()
-        for admin in admin_users:
-            notification_sent = await send_notification(
-                admin.chat_id,
-                f"🆕 Новая регистрация!\n\n"
-                f"👤 ФИО: {new_user.full_name}\n"
-                f"🏢 Должность: {new_user.position}\n"
-                f"🏥 Отделение: {new_user.department}\n"
-                f"🚪 Кабинет: {new_user.office}\n"
-                f"📱 Телефон: {new_user.phone}\n"
-                f"📧 Email: {new_user.email}"
-            )
+        # Отправляем уведомление администраторам одной параллельной рассылкой
+        admin_users = db.query(User).filter(User.role == 'admin').all()
+        admin_chat_ids = [admin.chat_id for admin in admin_users if admin.chat_id]
+        results = await send_notification_bulk(
+            admin_chat_ids,
+            f"🆕 Новая регистрация!\n\n"
+            f"👤 ФИО: {new_user.full_name}\n"
+            f"🏢 Должность: {new_user.position}\n"
+            f"🏥 Отделение: {new_user.department}\n"
+            f"🚪 Кабинет: {new_user.office}\n"
+            f"📱 Телефон: {new_user.phone}\n"
+            f"📧 Email: {new_user.email}"
+        )
+        for admin_chat_id, notification_sent in results.items():
             if not notification_sent:
-                logging.warning(f"Не удалось отправить уведомление администратору {admin.chat_id}")
+                logging.warning(f"Не удалось отправить уведомление администратору {admin_chat_id}")
         
         await state.clear()
         
@@ -534,76 +907,60 @@ async def process_email(message: types.Message, state: FSMContext):
         await message.answer(
             "❌ Произошла ошибка при регистрации. Пожалуйста, попробуйте позже или обратитесь к администратору."
         )
-    finally:
-        user_db.close()
 
 @dp.message(Command("new_ticket"))
-async def new_ticket(message: types.Message, state: FSMContext):
-    user_db = SessionLocal()
-    ticket_db = SessionLocal()
+async def new_ticket(message: types.Message, state: FSMContext, db: Session):
+    # Проверка статуса пользователя
+    status, error_msg, user = await check_user_status(message.chat.id, db)
+    if not status:
+        await message.answer(error_msg)
+        return
 
-    try:
-        # Проверка статуса пользователя
-        status, error_msg, user = await check_user_status(message.chat.id, user_db)
-        if not status:
-            await message.answer(error_msg)
-            return
+    # Получаем список активных категорий (из кэша, клавиатуре нужны только id и name)
+    categories = get_active_categories(db)
 
-        # Получаем список активных категорий
-        categories = ticket_db.query(TicketCategory).filter(TicketCategory.is_active == True).all()
+    if not categories:
+        await message.answer("К сожалению, в системе не настроены категории заявок. Обратитесь к администратору.")
+        return
 
-        if not categories:
-            await message.answer("К сожалению, в системе не настроены категории заявок. Обратитесь к администратору.")
-            return
+    # Создаем клавиатуру с категориями
+    keyboard = InlineKeyboardBuilder()
+    for category_id, category_name in categories:
+        keyboard.add(InlineKeyboardButton(
+            text=category_name,
+            callback_data=f"category:{category_id}"
+        ))
+    keyboard.adjust(1)  # По одной кнопке в строке
 
-        # Создаем клавиатуру с категориями
-        keyboard = InlineKeyboardBuilder()
-        for category in categories:
-            keyboard.add(InlineKeyboardButton(
-                text=category.name,
-                callback_data=f"category:{category.id}"
-            ))
-        keyboard.adjust(1)  # По одной кнопке в строке
-
-        await message.answer("Создание новой заявки. Пожалуйста, выберите категорию заявки:",
-                           reply_markup=keyboard.as_markup())
-        await state.set_state(TicketStates.waiting_for_category)
-        await update_user_activity(message.chat.id, state)  # Update user activity
-    finally:
-        user_db.close()
-        ticket_db.close()
+    await message.answer("Создание новой заявки. Пожалуйста, выберите категорию заявки:",
+                       reply_markup=keyboard.as_markup())
+    await state.set_state(TicketStates.waiting_for_category)
+    await update_user_activity(message.chat.id, state)  # Update user activity
 
 # Handle category selection callback
 @dp.callback_query(F.data.startswith("category:"))
-async def process_category_selection(callback: CallbackQuery, state: FSMContext):
-    user_db = SessionLocal()
-    ticket_db = SessionLocal()
-
-    try:
-        # Extract category ID from callback data
-        category_id = callback.data.split(":")[1]
-
-        # Get the category name
-        category = ticket_db.query(TicketCategory).filter(TicketCategory.id == category_id).first()
-        if not category:
-            await callback.message.answer("Ошибка: выбранная категория не найдена.")
-            await callback.answer()
-            return
+async def process_category_selection(callback: CallbackQuery, state: FSMContext, db: Session):
+    # Extract category ID from callback data
+    category_id = callback.data.split(":")[1]
+
+    # Get the category name
+    category = db.query(TicketCategory).filter(TicketCategory.id == category_id).first()
+    if not category:
+        await callback.message.answer("Ошибка: выбранная категория не найдена.")
+        await callback.answer()
+        return
 
-        # Save category selection to state
-        await state.update_data(category_id=category_id, category_name=category.name)
+    # Save category selection to state
+    await state.update_data(category_id=category_id, category_name=category.name)
 
-        # Ask for ticket title
-        await callback.message.answer(f"Вы выбрали категорию: <b>{category.name}</b>.\n\nТеперь введите заголовок заявки:", parse_mode="HTML")
-        await state.set_state(TicketStates.waiting_for_title)
+    # Ask for ticket title
+    await callback.message.answer(f"Вы выбрали категорию: <b>{category.name}</b>.\n\nТеперь введите заголовок заявки:", parse_mode="HTML")
+    await state.set_state(TicketStates.waiting_for_title)
 
-        # Check user status
-        status, _, user = await check_user_status(callback.message.chat.id, user_db)
-        await callback.answer()
-        await update_user_activity(callback.message.chat.id, state)
-    finally:
-        user_db.close()
-        ticket_db.close()
+    # Check user status
+    status, _, user = await check_user_status(callback.message.chat.id, db)
+    await callback.answer()
+    await update_user_activity(callback.message.chat.id, state)
 
 # --- Ticket Title Handler ---
 @dp.message(TicketStates.waiting_for_title)
@@ -671,6 +1028,29 @@ async def handle_document(message: types.Message, state: FSMContext):
             "используйте команду /new_ticket, а затем прикрепите файл на этапе вложений."
         )
 
+# Каталоги, существование которых уже проверено: убирает os.path.exists/
+# os.makedirs из цикла обработки каждого вложения
+_ENSURED_DIRS = set()
+
+
+def _ensure_dir(path):
+    if path not in _ENSURED_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _ENSURED_DIRS.add(path)
+
+
+async def _download_telegram_file_streaming(file_path, local_path):
+    """Качает файл с серверов Telegram сразу на диск кусками по 64 КБ.
+
+    Файл не буферизуется целиком в памяти: чтение из сети и запись через
+    aiofiles перекрываются, пиковое потребление — один чанк на загрузку.
+    """
+    url = bot.session.api.file_url(bot.token, file_path)
+    async with aiofiles.open(local_path, "wb") as f:
+        async for chunk in bot.session.stream_content(url, chunk_size=65536):
+            await f.write(chunk)
+
+
 # Function to download file from Telegram
 async def download_telegram_file(file_id, destination_dir, custom_filename=None):
     try:
@@ -678,8 +1058,7 @@ async def download_telegram_file(file_id, destination_dir, custom_filename=None)
         file_path = file_info.file_path
 
         # Create directory if it doesn't exist
-        if not os.path.exists(destination_dir):
-            os.makedirs(destination_dir)
+        _ensure_dir(destination_dir)
 
         # Define destination path
         if custom_filename:
@@ -691,12 +1070,30 @@ async def download_telegram_file(file_id, destination_dir, custom_filename=None)
             destination = os.path.join(destination_dir, f"{timestamp}_{original_filename}")
 
         # Download the file
-        await bot.download_file(file_path, destination)
+        await _download_telegram_file_streaming(file_path, destination)
         return destination
     except Exception as e:
         logging.error(f"Error downloading file from Telegram: {e}")
         return None
 
+# Расширения, считающиеся изображениями: признак вычисляется один раз
+# при сохранении вложения и хранится в колонке is_image, чтобы при
+# показе истории не распознавать тип файла заново
+_IMAGE_EXTENSIONS = frozenset({"jpg", "jpeg", "png", "webp", "gif"})
+
+
+def _is_image_file(file_type, file_name):
+    """Определяет, является ли вложение изображением"""
+    if file_type == "photo":
+        return True
+    if file_name and "." in file_name:
+        return file_name.rsplit(".", 1)[-1].lower() in _IMAGE_EXTENSIONS
+    return False
+
+
+# Слова, завершающие этап прикрепления файлов
+_DONE_WORDS = frozenset({"готово", "done", "готов", "end", "finish"})
+
 # --- Collect Attachments Handler ---
 MAX_ATTACHMENTS = 5
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5 MB
@@ -746,10 +1143,9 @@ async def collect_attachments(message: types.Message, state: FSMContext):
         file = await bot.get_file(file_id)
         file_path = file.file_path
         local_dir = "uploads"
-        if not os.path.exists(local_dir):
-            os.makedirs(local_dir)
+        _ensure_dir(local_dir)
         local_path = os.path.join(local_dir, file_name)
-        await bot.download_file(file_path, destination=local_path)
+        await _download_telegram_file_streaming(file_path, local_path)
     except Exception as e:
         logging.error(f"Ошибка загрузки файла: {e}")
         await message.answer("Не удалось сохранить файл. Попробуйте еще раз или отправьте другой файл.")
@@ -769,158 +1165,217 @@ async def collect_attachments(message: types.Message, state: FSMContext):
         await message.answer("Вы достигли лимита файлов. Нажмите 'Готово' для продолжения.")
 
 @dp.message(TicketStates.collecting_attachments)
-async def handle_text_in_attachments(message: types.Message, state: FSMContext):
+async def handle_text_in_attachments(message: types.Message, state: FSMContext, db: Session):
     # User can type "Готово" or "готово" to finish
-    if message.text and message.text.strip().lower() in {"готово", "done", "готов", "end", "finish"}:
-        await finish_attachments(message, state)
+    txt = message.text and message.text.strip().lower()
+    if txt in _DONE_WORDS:
+        await finish_attachments(message, state, db)
     else:
         await message.answer("Пожалуйста, прикрепите файл или нажмите 'Готово', когда закончите.")
 
 @dp.callback_query(F.data == "attachments_done")
-async def finish_attachments_callback(callback: CallbackQuery, state: FSMContext):
-    await finish_attachments(callback.message, state)
+async def finish_attachments_callback(callback: CallbackQuery, state: FSMContext, db: Session):
+    await finish_attachments(callback.message, state, db)
     await callback.answer()
 
-async def finish_attachments(message: types.Message, state: FSMContext):
+async def finish_attachments(message: types.Message, state: FSMContext, db: Session):
     data = await state.get_data()
     attachments = data.get("attachments", [])
     await message.answer("Спасибо! Ваша заявка будет сохранена и отправлена на рассмотрение.")
-    # Save ticket to DB
-    user_db = SessionLocal()
-    ticket_db = SessionLocal()
-    try:
-        status, _, user = await check_user_status(message.chat.id, user_db)
-        if not status or not user:
-            await message.answer("Ошибка: не удалось определить пользователя.")
-            return
-        ticket = Ticket(
-            title=data.get("title"),
-            description=data.get("description"),
-            category_id=data.get("category_id"),
-            creator_chat_id=str(message.chat.id),
-            status="new",
-            priority="normal",  # При создании из ТГ всегда средний приоритет
-            created_at=datetime.datetime.utcnow(),
-            updated_at=datetime.datetime.utcnow()
-        )
-        ticket_db.add(ticket)
-        ticket_db.commit()
-        ticket_db.refresh(ticket)
-
-        # Save attachments
-        for att in attachments:
-            attachment = Attachment(
-                ticket_id=ticket.id,
-                file_name=att["file_name"],
-                file_path=att["file_path"],
-                file_type=att["file_type"]
-            )
-            ticket_db.add(attachment)
-        ticket_db.commit()
-
-        await message.answer(f"Заявка <b>#{ticket.id}</b> успешно создана!\n\n"
-                             f"Заголовок: <b>{ticket.title}</b>\n"
-                             f"Категория: <b>{data.get('category_name')}</b>\n"
-                             f"Статус: Новая\n"
-                             f"Прикреплено файлов: {len(attachments)}",
-                             parse_mode="HTML")
-        await state.clear()
-    finally:
-        user_db.close()
-        ticket_db.close()
+    # Save ticket to DB — сессия апдейта передана из middleware
+    status, _, user = await check_user_status(message.chat.id, db)
+    if not status or not user:
+        await message.answer("Ошибка: не удалось определить пользователя.")
+        return
+    now = datetime.datetime.utcnow()
+    ticket = Ticket(
+        title=data.get("title"),
+        description=data.get("description"),
+        category_id=data.get("category_id"),
+        creator_chat_id=str(message.chat.id),
+        status="new",
+        priority="normal",  # При создании из ТГ всегда средний приоритет
+        created_at=now,
+        updated_at=now
+    )
+    db.add(ticket)
+    # flush выполняет INSERT и возвращает id — отдельный SELECT
+    # через refresh после commit не нужен
+    db.flush()
+    ticket_id, ticket_title = ticket.id, ticket.title
+    db.commit()
+
+    # Save attachments: одна multi-row вставка вместо N INSERT через unit of work
+    if attachments:
+        db.execute(insert(Attachment), [
+            {
+                "ticket_id": ticket_id,
+                "file_name": att["file_name"],
+                "file_path": att["file_path"],
+                "file_type": att["file_type"],
+                "is_image": _is_image_file(att["file_type"], att["file_name"]),
+            }
+            for att in attachments
+        ])
+        db.commit()
+
+    # Список заявок пользователя изменился — кэш клавиатур устарел
+    invalidate_tickets_keyboard(message.chat.id)
+
+    await message.answer(f"Заявка <b>#{ticket_id}</b> успешно создана!\n\n"
+                         f"Заголовок: <b>{ticket_title}</b>\n"
+                         f"Категория: <b>{data.get('category_name')}</b>\n"
+                         f"Статус: Новая\n"
+                         f"Прикреплено файлов: {len(attachments)}",
+                         parse_mode="HTML")
+    await state.clear()
 
 # Команда для выбора заявки
 @dp.message(Command("tickets")) # Changed from "ticket" to "tickets"
-async def select_ticket(message: types.Message, state: FSMContext):
+async def select_ticket(message: types.Message, state: FSMContext, db: Session):
     logging.info(f"User {message.from_user.id} triggered /tickets command") # Added logging
-    user_db = SessionLocal()
-    ticket_db = SessionLocal()
 
-    try:
-        # Проверка статуса пользователя
-        status, error_msg, user = await check_user_status(message.chat.id, user_db)
-        if not status:
-            await message.answer(error_msg)
-            return
+    # Проверка статуса пользователя
+    status, error_msg, user = await check_user_status(message.chat.id, db)
+    if not status:
+        await message.answer(error_msg)
+        return
 
-        # Получаем все заявки пользователя, отсортированные по дате создания (новые сверху)
-        tickets = ticket_db.query(Ticket).filter(
-            Ticket.creator_chat_id == str(message.chat.id)
-        ).order_by(Ticket.created_at.desc()).all()
+    # Счётчики считаем одним SQL-агрегатом, полный список заявок не
+    # загружаем — страницы выбирает сама клавиатура через LIMIT/OFFSET
+    chat_id_str = str(message.chat.id)
+    total_tickets, active_tickets = db.query(
+        func.count(Ticket.id),
+        func.coalesce(func.sum(
+            case((Ticket.status.in_(["new", "in_progress"]), 1), else_=0)
+        ), 0)
+    ).filter(Ticket.creator_chat_id == chat_id_str).one()
+
+    if not total_tickets:
+        await message.answer("У вас нет заявок. Используйте /new_ticket для создания новой заявки.")
+        return
 
-        if not tickets:
-            await message.answer("У вас нет заявок. Используйте /new_ticket для создания новой заявки.")
-            return
+    await state.update_data(current_page=0)
 
-        # Сохраняем все заявки в состоянии пользователя для дальнейшей пагинации
-        ticket_data = [{
-            "id": t.id,
-            "title": t.title,
-            "status": t.status,
-            "created_at": to_msk(t.created_at).isoformat(),
-            "resolved_at": to_msk(t.updated_at).isoformat() if t.status in ["resolved", "irrelevant", "closed"] else None
-        } for t in tickets]
-        await state.update_data(tickets=ticket_data, current_page=0)
-
-        # Создаем клавиатуру с пагинацией
-        keyboard = await create_tickets_keyboard(tickets, page=0)
-
-        # Формируем информативное сообщение
-        total_tickets = len(tickets)
-        active_tickets = sum(1 for t in tickets if t.status in ["new", "in_progress"])
-
-        message_text = (
-            f"<b>Ваши заявки ({total_tickets})</b>\n"
-            f"Активных заявок: {active_tickets}\n\n"
-            f"Выберите заявку из списка ниже:"
-        )
+    # Создаем клавиатуру с пагинацией
+    keyboard = await create_tickets_keyboard(db, message.chat.id, page=0)
 
-        await message.answer(message_text, reply_markup=keyboard, parse_mode="HTML")
-        await update_user_activity(message.chat.id, state)  # Update user activity
+    message_text = (
+        f"<b>Ваши заявки ({total_tickets})</b>\n"
+        f"Активных заявок: {active_tickets}\n\n"
+        f"Выберите заявку из списка ниже:"
+    )
+
+    await message.answer(message_text, reply_markup=keyboard, parse_mode="HTML")
+    await update_user_activity(message.chat.id, state)  # Update user activity
 
-    finally:
-        user_db.close()
-        ticket_db.close()
 
 # Callback handler for selecting a ticket from the inline keyboard
 @dp.callback_query(F.data.startswith("select_ticket:"))
-async def process_select_ticket(callback: CallbackQuery, state: FSMContext):
-    ticket_db = SessionLocal()
-    user_db = SessionLocal()
-    try:
-        ticket_id = int(callback.data.split(":")[1])
-        status, error_msg, user = await check_user_status(callback.from_user.id, user_db)
-        if not status:
-            await callback.answer(error_msg, show_alert=True)
-            return
+async def process_select_ticket(callback: CallbackQuery, state: FSMContext, db: Session):
+    ticket_id = int(callback.data.split(":")[1])
+    status, error_msg, user = await check_user_status(callback.from_user.id, db)
+    if not status:
+        await callback.answer(error_msg, show_alert=True)
+        return
 
-        ticket = ticket_db.query(Ticket).filter(Ticket.id == ticket_id, Ticket.creator_chat_id == str(callback.from_user.id)).first()
-        if not ticket:
-            await callback.answer("Заявка не найдена или у вас нет к ней доступа.", show_alert=True)
-            return
+    ticket = db.query(Ticket).filter(Ticket.id == ticket_id, Ticket.creator_chat_id == str(callback.from_user.id)).first()
+    if not ticket:
+        await callback.answer("Заявка не найдена или у вас нет к ней доступа.", show_alert=True)
+        return
 
-        await callback.message.answer(f"Вы выбрали заявку: <b>#{ticket.id} - {ticket.title}</b>.\nТеперь ваши сообщения будут направляться в этот чат.", parse_mode="HTML")
-        await clear_user_chat(callback.from_user.id, bot)
-        await display_last_10_messages(ticket_id, callback.from_user.id, bot, ticket_db, state)
-        await state.update_data(active_ticket_id=ticket_id)
-        await state.set_state(ActiveTicketStates.chatting)
-        await callback.answer()
-    finally:
-        ticket_db.close()
-        user_db.close()
+    await callback.message.answer(f"Вы выбрали заявку: <b>#{ticket.id} - {ticket.title}</b>.\nТеперь ваши сообщения будут направляться в этот чат.", parse_mode="HTML")
+    await clear_user_chat(callback.from_user.id, bot)
+    await display_last_10_messages(ticket_id, callback.from_user.id, bot, db, state)
+    await state.update_data(active_ticket_id=ticket_id)
+    await state.set_state(ActiveTicketStates.chatting)
+    await callback.answer()
 
-# 1. Глобальный словарь для времени последнего уведомления
-LAST_NOTIFICATION = {}  # {(chat_id, ticket_id): timestamp}
+# 1. Глобальный словарь для времени последнего уведомления.
+# Записи протухают через час (окно повторного уведомления), устаревшие
+# выметаются фоновой зачисткой при обращении — словарь не растёт бесконечно
+LAST_NOTIFICATION = {}  # {(chat_id, ticket_id): time.monotonic()}
+_LAST_NOTIFICATION_TTL = 3600
+_last_notification_sweep = 0.0
+
+
+def _notification_allowed(chat_id, ticket_id):
+    """True, если по паре (чат, заявка) не было уведомления за последний час."""
+    global _last_notification_sweep
+    now = time.monotonic()
+    if now - _last_notification_sweep > _LAST_NOTIFICATION_TTL:
+        expired = [k for k, ts in LAST_NOTIFICATION.items()
+                   if now - ts > _LAST_NOTIFICATION_TTL]
+        for k in expired:
+            del LAST_NOTIFICATION[k]
+        _last_notification_sweep = now
+    key = (chat_id, ticket_id)
+    ts = LAST_NOTIFICATION.get(key)
+    if ts is not None and now - ts < _LAST_NOTIFICATION_TTL:
+        return False
+    LAST_NOTIFICATION[key] = now
+    return True
 
 # 2. Исправить функцию очистки чата
 async def clear_user_chat(user_id, bot):
     try:
-        await bot.send_message(chat_id=user_id, text="---")
-        await bot.send_message(chat_id=user_id, text="---")
+        # Оба разделителя уходят параллельно по keep-alive соединениям пула
+        await asyncio.gather(
+            bot.send_message(chat_id=user_id, text="---"),
+            bot.send_message(chat_id=user_id, text="---"),
+        )
     except Exception as e:
-        import logging
         logging.error(f"Ошибка при очистке чата пользователя {user_id}: {e}")
 
+# Кэш подготовленной истории переписки: {ticket_id: (last_message_id, plan)}.
+# План инвалидируется сам собой, как только в заявке появляется новое
+# сообщение (меняется id последнего), поэтому TTL не нужен
+_HISTORY_PLAN_CACHE = {}
+_HISTORY_PLAN_CACHE_MAX = 128
+
+
+def _build_history_plan(ticket_db, ticket_id, messages):
+    """Готовит список отправок для истории заявки.
+
+    Элементы плана: ('text', текст) либо ('photo'/'document', путь, имя
+    файла, подпись). Форматирование и запросы выполняются один раз, сами
+    отправки делает display_last_10_messages.
+    """
+    plan = []
+    for msg in messages:
+        # Ручное форматирование вместо strftime: без locale-машинерии C
+        dt = to_msk(msg.created_at)
+        timestamp = f"{dt.day:02}.{dt.month:02}.{dt.year} {dt.hour:02}:{dt.minute:02}"
+        if msg.is_from_user:
+            prefix = "Ваше сообщение:"
+        else:
+            prefix = "Сообщение администратора:"
+        if msg.content:
+            # Экранируем текст: содержимое не должно ломать HTML-разметку
+            text = f"<b>{prefix}</b> ({timestamp})\n{html.escape(msg.content)}"
+        else:
+            text = f"<b>{prefix}</b> ({timestamp})"
+        if msg.attachments:
+            for att in msg.attachments:
+                file_path = att.full_path
+                kind = 'photo' if att.is_image else 'document'
+                plan.append((kind, file_path, att.file_name, text))
+                text = None
+        else:
+            plan.append(('text', text))
+
+    # Файлы-вложения самой заявки (без привязки к сообщению) идут после истории
+    ticket_attachments = ticket_db.query(Attachment).filter(
+        Attachment.ticket_id == ticket_id,
+        Attachment.message_id == None
+    ).all()
+    for att in ticket_attachments:
+        file_path = att.full_path
+        kind = 'photo' if att.is_image else 'document'
+        plan.append((kind, file_path, att.file_name, "Вложение к заявке"))
+    return plan
+
+
 # 3. Исправить функцию display_last_10_messages
 async def display_last_10_messages(ticket_id, user_id, bot, ticket_db, state):
     # Получаем заявку для заголовка
@@ -929,8 +1384,10 @@ async def display_last_10_messages(ticket_id, user_id, bot, ticket_db, state):
     ticket_title = ticket.title if ticket else f"#{ticket_id}"
     await bot.send_message(chat_id=user_id, text=f"Вы выбрали заявку <b>{ticket_title}</b> активной, далее — история сообщений:", parse_mode="HTML")
 
-    # Получаем до 30 сообщений для заявки, сортировка по возрастанию (старые сверху)
+    # Получаем до 30 сообщений для заявки, сортировка по возрастанию (старые
+    # сверху); вложения подтягиваются одним IN-запросом через selectinload
     messages = ticket_db.query(Message)\
+        .options(selectinload(Message.attachments))\
         .filter(Message.ticket_id == ticket_id)\
         .order_by(Message.created_at)\
         .limit(30)\
@@ -941,162 +1398,190 @@ async def display_last_10_messages(ticket_id, user_id, bot, ticket_db, state):
             chat_id=user_id,
             text="В этой заявке пока нет сообщений."
         )
+        return
+
+    last_message_id = messages[-1].id
+    cached = _HISTORY_PLAN_CACHE.get(ticket_id)
+    if cached and cached[0] == last_message_id:
+        plan = cached[1]
     else:
-        msg_ids = [msg.id for msg in messages]
-        attachments = ticket_db.query(Attachment).filter(Attachment.message_id.in_(msg_ids)).all()
-        att_map = {}
-        for att in attachments:
-            att_map.setdefault(att.message_id, []).append(att)
-
-        for msg in messages:
-            timestamp = to_msk(msg.created_at).strftime('%d.%m.%Y %H:%M')
-            if msg.is_from_user:
-                prefix = "Ваше сообщение:"
-            else:
-                prefix = "Сообщение администратора:"
-            text = f"<b>{prefix}</b> ({timestamp})\n{msg.content}" if msg.content else f"<b>{prefix}</b> ({timestamp})"
-            msg_attachments = att_map.get(msg.id, [])
-            if msg_attachments:
-                for att in msg_attachments:
-                    file_path = os.path.join('uploads', att.file_path) if not att.file_path.startswith('uploads') else att.file_path
-                    if not os.path.exists(file_path):
-                        await bot.send_message(chat_id=user_id, text=f"Файл не найден: {att.file_name}")
-                        continue
-                    try:
-                        if att.is_image:
-                            await bot.send_photo(chat_id=user_id, photo=FSInputFile(file_path, filename=att.file_name), caption=text, parse_mode='HTML')
-                        else:
-                            await bot.send_document(chat_id=user_id, document=FSInputFile(file_path, filename=att.file_name), caption=text, parse_mode='HTML')
-                    except Exception as e:
-                        import logging
-                        logging.error(f"Ошибка отправки файла {file_path}: {e}")
-                        await bot.send_message(chat_id=user_id, text=f"[Ошибка отправки файла] {att.file_name}")
-                    text = None
-            else:
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=text,
-                    parse_mode='HTML'
-                )
-    # После сообщений пересылаем все файлы-заявки без message_id
-    ticket_attachments = ticket_db.query(Attachment).filter(
-        Attachment.ticket_id == ticket_id,
-        Attachment.message_id == None
-    ).all()
-    for att in ticket_attachments:
-        file_path = os.path.join('uploads', att.file_path) if not att.file_path.startswith('uploads') else att.file_path
-        if not os.path.exists(file_path):
-            await bot.send_message(chat_id=user_id, text=f"Файл не найден: {att.file_name}")
-            continue
-        try:
-            if att.is_image:
-                await bot.send_photo(chat_id=user_id, photo=FSInputFile(file_path, filename=att.file_name), caption="Вложение к заявке", parse_mode='HTML')
-            else:
-                await bot.send_document(chat_id=user_id, document=FSInputFile(file_path, filename=att.file_name), caption="Вложение к заявке", parse_mode='HTML')
-        except Exception as e:
-            import logging
-            logging.error(f"Ошибка отправки файла {file_path}: {e}")
-            await bot.send_message(chat_id=user_id, text=f"[Ошибка отправки файла] {att.file_name}")
+        plan = _build_history_plan(ticket_db, ticket_id, messages)
+        if len(_HISTORY_PLAN_CACHE) >= _HISTORY_PLAN_CACHE_MAX:
+            _HISTORY_PLAN_CACHE.pop(next(iter(_HISTORY_PLAN_CACHE)))
+        _HISTORY_PLAN_CACHE[ticket_id] = (last_message_id, plan)
+
+    # Отправляем элементы плана строго по одному: Telegram показывает
+    # сообщения в порядке доставки, и параллельные отправки перемешали бы
+    # хронологию истории. Выигрыш даёт готовый план (форматирование и
+    # запросы к БД выполняются один раз), а не конкуренция отправок
+    for item in plan:
+        await _send_history_item(user_id, item)
+
+
+async def _send_history_item(user_id, item):
+    """Отправляет один элемент плана истории (текст или файл)."""
+    if item[0] == 'text':
+        await bot.send_message(chat_id=user_id, text=item[1], parse_mode='HTML')
+        return
+    kind, file_path, file_name, caption = item
+    if not os.path.exists(file_path):
+        await bot.send_message(chat_id=user_id, text=f"Файл не найден: {file_name}")
+        return
+    try:
+        if kind == 'photo':
+            await bot.send_photo(chat_id=user_id, photo=FSInputFile(file_path, filename=file_name), caption=caption, parse_mode='HTML')
+        else:
+            await bot.send_document(chat_id=user_id, document=FSInputFile(file_path, filename=file_name), caption=caption, parse_mode='HTML')
+    except Exception as e:
+        logging.error(f"Ошибка отправки файла {file_path}: {e}")
+        await bot.send_message(chat_id=user_id, text=f"[Ошибка отправки файла] {file_name}")
 
 # 4. Исправить handle_new_message_from_site для уведомлений с инлайн-кнопкой и лимитом 1 час
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import time
 
 async def handle_new_message_from_site(ticket_id: int, sender_name: str, message_text: str, chat_id: str, timestamp_str: Optional[str] = None):
-    db = SessionLocal()
     try:
-        # Получаем заявку
-        ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
-        if not ticket:
-            return
+        # Вызывается не из aiogram-хэндлера, поэтому сессию открываем сами —
+        # но одну на весь вызов через session_scope, как и в остальном коде
+        with session_scope() as db:
+            # Получаем заявку
+            ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
+            if not ticket:
+                return
 
-        # Проверяем возможность комментирования
-        if not ticket.can_be_commented():
-            await bot.send_message(
-                chat_id=chat_id,
-                text=f"⚠️ Заявка находится в статусе '{ticket.get_status_display()}'. Комментирование недоступно."
+            # Проверяем возможность комментирования
+            if not ticket.can_be_commented():
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=f"⚠️ Заявка находится в статусе '{ticket.get_status_display()}'. Комментирование недоступно."
+                )
+                return
+
+            # Создаем новое сообщение
+            new_message = Message(
+                ticket_id=ticket_id,
+                sender_id=chat_id,
+                sender_name=sender_name,
+                content=message_text,
+                is_from_user=True
+            )
+            db.add(new_message)
+
+            # Обновляем время последнего обновления заявки
+            ticket.updated_at = datetime.utcnow()
+            db.commit()
+
+            # Отправляем уведомление администраторам одной параллельной
+            # рассылкой, не чаще раза в час по каждой паре (чат, заявка)
+            admin_users = db.query(User).filter(User.role.in_(['admin', 'curator'])).all()
+            admin_chat_ids = [admin.chat_id for admin in admin_users
+                              if admin.chat_id and _notification_allowed(admin.chat_id, ticket_id)]
+            await send_notification_bulk(
+                admin_chat_ids,
+                f"💬 <b>Новое сообщение в заявке #{ticket_id}</b>\n\n"
+                f"От: <b>{sender_name}</b>\n"
+                f"Заявка: <b>{ticket.title}</b>\n"
+                f"Сообщение: {message_text}"
             )
-            return
 
-        # Создаем новое сообщение
-        new_message = Message(
-            ticket_id=ticket_id,
-            sender_id=chat_id,
-            sender_name=sender_name,
-            content=message_text,
-            is_from_user=True
-        )
-        db.add(new_message)
+    except Exception as e:
+        logging.error(f"Error in handle_new_message_from_site: {str(e)}")
 
-        # Обновляем время последнего обновления заявки
-        ticket.updated_at = datetime.utcnow()
-        db.commit()
+async def _sweep_inactive_users_redis():
+    """Сбрасывает активные заявки пользователей, неактивных более 3 часов.
+
+    Работает только с RedisStorage: просроченные user_id выбираются одним
+    ZRANGEBYSCORE из вторичного индекса активности, затем точечно
+    обновляется состояние каждого из них.
+    """
+    cutoff = time.time() - _INACTIVITY_TIMEOUT
+    expired = await storage.redis.zrangebyscore(_ACTIVITY_ZSET_KEY, 0, cutoff)
+    for raw_uid in expired:
+        uid = int(raw_uid)
+        try:
+            key = StorageKey(bot_id=bot.id, chat_id=uid, user_id=uid)
+            state_data = await dp.storage.get_data(key)
+            if state_data.get('active_ticket_id'):
+                logging.info(f"User {uid} inactive for over 3 hours. Clearing active ticket.")
+                state_data['active_ticket_id'] = None
+                await dp.storage.set_data(key, state_data)
+                try:
+                    await clear_user_chat(uid, bot)
+                    await bot.send_message(
+                        chat_id=uid,
+                        text="Активная заявка сброшена из-за отсутствия активности. Выберите заявку снова через /tickets."
+                    )
+                except Exception as e:
+                    logging.error(f"Failed to notify user {uid} about chat clearing: {str(e)}")
+        finally:
+            await storage.redis.zrem(_ACTIVITY_ZSET_KEY, raw_uid)
 
-        # Отправляем уведомление администраторам
-        admin_users = db.query(User).filter(User.role.in_(['admin', 'curator'])).all()
-        for admin in admin_users:
-            if admin.chat_id:
-                await bot.send_message(
-                    chat_id=admin.chat_id,
-                    text=f"💬 <b>Новое сообщение в заявке #{ticket_id}</b>\n\n"
-                         f"От: <b>{sender_name}</b>\n"
-                         f"Заявка: <b>{ticket.title}</b>\n"
-                         f"Сообщение: {message_text}",
-                    parse_mode="HTML"
-                )
 
+async def _expire_user_if_inactive(user_id, now):
+    """Сбрасывает активную заявку пользователя, если тайм-аут действительно истёк.
+
+    Дедлайн из кучи может устареть: пользователь мог снова проявить
+    активность после постановки записи, поэтому сверяемся с актуальным
+    last_activity в хранилище состояний.
+    """
+    key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+    state_data = await dp.storage.get_data(key)
+    active_ticket_id = state_data.get('active_ticket_id')
+    last_activity = state_data.get('last_activity')
+    if not active_ticket_id or not last_activity:
+        return
+    try:
+        if now - float(last_activity) < _INACTIVITY_TIMEOUT:
+            return
+    except (ValueError, TypeError) as e:
+        logging.error(f"Error parsing last_activity for user {user_id}: {str(e)}")
+        return
+    logging.info(f"User {user_id} has been inactive for over {_INACTIVITY_TIMEOUT / 3600:.0f} hours. Clearing active ticket.")
+    state_data['active_ticket_id'] = None
+    await dp.storage.set_data(key, state_data)
+    try:
+        await clear_user_chat(user_id, bot)
+        await bot.send_message(
+            chat_id=user_id,
+            text="Активная заявка сброшена из-за отсутствия активности. Выберите заявку снова через /tickets."
+        )
     except Exception as e:
-        db.rollback()
-        logging.error(f"Error in handle_new_message_from_site: {str(e)}")
-    finally:
-        db.close()
+        logging.error(f"Failed to notify user {user_id} about chat clearing: {str(e)}")
 
-# 5. В check_inactive_users: если не было активности 3 часов, сбрасывать active_ticket_id и очищать чат
+
+# 5. Если не было активности 3 часов, сбрасывать active_ticket_id и очищать чат.
+# Задача не опрашивает всех пользователей по таймеру: она спит до ближайшего
+# дедлайна из кучи и просыпается сразу при новой активности
 async def check_inactive_users():
-    try:
-        while True:
-            logging.info("Checking for inactive users...")
+    while True:
+        try:
+            if _expiry_heap:
+                timeout = max(0.0, _expiry_heap[0][0] - time.time())
+            else:
+                timeout = 3600
             try:
-                if not hasattr(dp, 'storage') or not dp.storage:
-                    logging.warning("Storage is not properly initialized. Skipping inactive user check.")
-                    await asyncio.sleep(3600)
-                    continue
-                if hasattr(dp.storage, 'data') and dp.storage.data:
-                    states_data = dp.storage.data
-                    current_time = datetime.datetime.now()
-                    for user_id, user_data in states_data.items():
-                        if isinstance(user_data, dict) and 'data' in user_data:
-                            state_data = user_data['data']
-                            active_ticket_id = state_data.get('active_ticket_id')
-                            last_activity = state_data.get('last_activity')
-                            if active_ticket_id and last_activity:
-                                try:
-                                    last_activity_time = datetime.datetime.fromisoformat(last_activity)
-                                    inactive_hours = (current_time - last_activity_time).total_seconds() / 3600
-                                    if inactive_hours >= 3:
-                                        logging.info(f"User {user_id} has been inactive for {inactive_hours:.2f} hours. Clearing active ticket.")
-                                        state_data['active_ticket_id'] = None
-                                        try:
-                                            await clear_user_chat(user_id, bot)
-                                            await bot.send_message(
-                                                chat_id=user_id,
-                                                text="Активная заявка сброшена из-за отсутствия активности. Выберите заявку снова через /tickets."
-                                            )
-                                        except Exception as e:
-                                            logging.error(f"Failed to notify user {user_id} about chat clearing: {str(e)}")
-                                except (ValueError, TypeError) as e:
-                                    logging.error(f"Error parsing last_activity for user {user_id}: {str(e)}")
-                else:
-                    logging.warning("Storage doesn't have 'data' attribute or it's empty. Unable to check inactive users.")
-            except Exception as e:
-                logging.error(f"Error accessing storage data: {str(e)}")
-            await asyncio.sleep(3600)
-    except Exception as e:
-        logging.error(f"Error in inactive users check task: {str(e)}")
-        if hasattr(e, '__traceback__'):
-            import traceback
-            error_trace = ''.join(traceback.format_tb(e.__traceback__))
-            logging.error(f"Traceback: {error_trace}")
+                await asyncio.wait_for(_sweep_wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            _sweep_wake.clear()
+
+            if _USING_REDIS_STORAGE:
+                # Redis-путь: выбираем только просроченных по вторичному
+                # индексу — O(просроченных), а не обход всех состояний
+                await _sweep_inactive_users_redis()
+                continue
+
+            now = time.time()
+            while _expiry_heap and _expiry_heap[0][0] <= now:
+                _, user_id = heapq.heappop(_expiry_heap)
+                await _expire_user_if_inactive(user_id, now)
+        except Exception as e:
+            logging.error(f"Error in inactive users check task: {str(e)}")
+            if hasattr(e, '__traceback__'):
+                error_trace = ''.join(traceback.format_tb(e.__traceback__))
+                logging.error(f"Traceback: {error_trace}")
+            await asyncio.sleep(60)
 
 @dp.message(Command("my_tickets"))
 async def show_my_tickets(message: types.Message, state: FSMContext):
@@ -1122,147 +1607,150 @@ async def show_help(message: types.Message, state: FSMContext):
                       "активная заявка будет очищена, и вам потребуется выбрать её снова через команду /tickets.")
     await update_user_activity(message.chat.id, state)  # Update user activity
 
+def _load_pdn_policy_html():
+    """Читает и форматирует текст политики ПДн один раз при старте.
+
+    Файл не меняется за время жизни процесса, поэтому обработчик команды
+    отдаёт готовую строку без обращения к диску.
+    """
+    policy_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdn_policy.txt")
+    try:
+        with open(policy_file_path, "r", encoding="utf-8") as f:
+            policy_text = f.read()
+        lines = policy_text.split('\n')
+        if lines:
+            return f"<b>{lines[0]}</b>\n\n" + "\n".join(lines[1:])
+        return policy_text
+    except OSError:
+        # Если файл не найден, используем встроенный текст
+        logging.warning(f"Файл политики обработки ПДн не найден: {policy_file_path}")
+        return (
+            "<b>Политика обработки персональных данных</b>\n\n"
+            "В соответствии с требованиями Федерального закона от 27.07.2006 г. № 152-ФЗ «О персональных данных»:\n\n"
+            "1. Ваши персональные данные (ФИО, должность, отделение, номер кабинета, телефон, email) "
+            "хранятся в защищенной базе данных системы поддержки ОБУЗ КГКБСМП.\n\n"
+            "2. Данные используются исключительно для идентификации пользователей и обработки заявок в системе поддержки.\n\n"
+            "3. Мы не передаем ваши данные третьим лицам без вашего согласия, за исключением случаев, "
+            "предусмотренных законодательством РФ.\n\n"
+            "4. Вы имеете право на доступ к своим персональным данным, их обновление, удаление или ограничение обработки "
+            "по запросу к администратору системы.\n\n"
+            "5. Система хранит дату и время вашего согласия с политикой обработки персональных данных.\n\n"
+            "6. Политика может быть изменена в соответствии с требованиями законодательства. "
+            "В случае существенных изменений, вам будет предложено ознакомиться с обновленной версией.\n\n"
+            "7. По всем вопросам относительно обработки ваших персональных данных вы можете обратиться "
+            "к администратору системы поддержки.\n\n"
+            "Используя бота поддержки ОБУЗ КГКБСМП, вы подтверждаете своё согласие с данной политикой."
+        )
+
+
+_PDN_POLICY_HTML = _load_pdn_policy_html()
+
+
 # Команда для отображения политики обработки персональных данных
 @dp.message(Command("pdn_policy"))
 async def show_pdn_policy(message: types.Message, state: FSMContext):
     try:
-        # Путь к файлу с текстом политики
-        policy_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdn_policy.txt")
-
-        # Проверяем существование файла
-        if os.path.exists(policy_file_path):
-            # Читаем текст из файла
-            with open(policy_file_path, "r", encoding="utf-8") as f:
-                policy_text = f.read()
-
-            # Форматируем текст для Telegram (добавляем HTML-форматирование)
-            lines = policy_text.split('\n')
-            if lines:
-                formatted_text = f"<b>{lines[0]}</b>\n\n" + "\n".join(lines[1:])
-            else:
-                formatted_text = policy_text
-            await message.answer(formatted_text, parse_mode="HTML")
-        else:
-            # Если файл не найден, используем встроенный текст
-            gdpr_text = (
-                "<b>Политика обработки персональных данных</b>\n\n"
-                "В соответствии с требованиями Федерального закона от 27.07.2006 г. № 152-ФЗ «О персональных данных»:\n\n"
-                "1. Ваши персональные данные (ФИО, должность, отделение, номер кабинета, телефон, email) "
-                "хранятся в защищенной базе данных системы поддержки ОБУЗ КГКБСМП.\n\n"
-                "2. Данные используются исключительно для идентификации пользователей и обработки заявок в системе поддержки.\n\n"
-                "3. Мы не передаем ваши данные третьим лицам без вашего согласия, за исключением случаев, "
-                "предусмотренных законодательством РФ.\n\n"
-                "4. Вы имеете право на доступ к своим персональным данным, их обновление, удаление или ограничение обработки "
-                "по запросу к администратору системы.\n\n"
-                "5. Система хранит дату и время вашего согласия с политикой обработки персональных данных.\n\n"
-                "6. Политика может быть изменена в соответствии с требованиями законодательства. "
-                "В случае существенных изменений, вам будет предложено ознакомиться с обновленной версией.\n\n"
-                "7. По всем вопросам относительно обработки ваших персональных данных вы можете обратиться "
-                "к администратору системы поддержки.\n\n"
-                "Используя бота поддержки ОБУЗ КГКБСМП, вы подтверждаете своё согласие с данной политикой."
-            )
-            await message.answer(gdpr_text, parse_mode="HTML")
-
-            # Логируем ошибку
-            logging.warning(f"Файл политики обработки ПДн не найден: {policy_file_path}")
-
+        await message.answer(_PDN_POLICY_HTML, parse_mode="HTML")
     except Exception as e:
-        logging.error(f"Ошибка при чтении файла политики обработки ПДн: {str(e)}")
+        logging.error(f"Ошибка при отправке текста политики обработки ПДн: {str(e)}")
         await message.answer("Произошла ошибка при получении текста политики обработки ПДн. Попробуйте позднее.")
 
     await update_user_activity(message.chat.id, state)  # Update user activity
 
 # Profile command handler - показывает информацию о пользователе
 @dp.message(Command("profile"))
-async def show_profile(message: types.Message, state: FSMContext):
-    user_db = SessionLocal()
+async def show_profile(message: types.Message, state: FSMContext, db: Session):
+    # Проверяем, зарегистрирован ли пользователь (без проверки статуса)
+    user = get_user_by_chat_id(message.chat.id, db)
 
-    try:
-        # Проверяем, зарегистрирован ли пользователь (без проверки статуса)
-        user = get_user_by_chat_id(message.chat.id, user_db)
+    if not user:
+        await message.answer("Вы не зарегистрированы в системе. Используйте /start для регистрации.")
+        return
 
-        if not user:
-            await message.answer("Вы не зарегистрированы в системе. Используйте /start для регистрации.")
-            return
+    # Форматируем дату согласия
+    consent_date_str = to_msk(user.consent_date).strftime('%d.%m.%Y %H:%M') if user.consent_date else 'Не указана'
+
+    # Форматируем дату создания профиля
+    created_date_str = to_msk(user.created_at).strftime('%d.%m.%Y %H:%M')
+
+    # Получаем статусы активности и подтверждения
+    confirmation_status = "✅ Подтвержден" if user.is_confirmed else "❌ Ожидает подтверждения"
+    active_status = "✅ Активен" if user.is_active else "❌ Заблокирован"
+
+    # Форматируем телефон и email, если они есть
+    phone_str = user.phone if user.phone else "Не указан"
+    email_str = user.email if user.email else "Не указан"
+
+    # Формируем сообщение с информацией о профиле
+    profile_text = (
+        f"📋 <b>Ваш профиль</b>\n\n"
+        f"👤 <b>ФИО:</b> {user.full_name}\n"
+        f"🏢 <b>Должность:</b> {user.position}\n"
+        f"🏥 <b>Отделение:</b> {user.department}\n"
+        f"🚪 <b>Кабинет:</b> {user.office}\n"
+        f"📱 <b>Телефон:</b> {phone_str}\n"
+        f"📧 <b>Email:</b> {email_str}\n\n"
+        f"🔐 <b>Статус профиля:</b> {active_status}, {confirmation_status}\n"
+        f"📅 <b>Дата регистрации:</b> {created_date_str}\n"
+        f"✍️ <b>Согласие на обработку ПДн:</b> {'Получено' if user.privacy_consent else 'Не получено'}\n"
+        f"📆 <b>Дата согласия:</b> {consent_date_str}\n"
+        f"👑 <b>Роль:</b> {'Администратор' if user.role == 'admin' else 'Куратор' if user.role == 'curator' else 'Пользователь'}\n"
+    )
 
-        # Форматируем дату согласия
-        consent_date_str = to_msk(user.consent_date).strftime('%d.%m.%Y %H:%M') if user.consent_date else 'Не указана'
-
-        # Форматируем дату создания профиля
-        created_date_str = to_msk(user.created_at).strftime('%d.%m.%Y %H:%M')
-
-        # Получаем статусы активности и подтверждения
-        confirmation_status = "✅ Подтвержден" if user.is_confirmed else "❌ Ожидает подтверждения"
-        active_status = "✅ Активен" if user.is_active else "❌ Заблокирован"
-
-        # Форматируем телефон и email, если они есть
-        phone_str = user.phone if user.phone else "Не указан"
-        email_str = user.email if user.email else "Не указан"
-
-        # Формируем сообщение с информацией о профиле
-        profile_text = (
-            f"📋 <b>Ваш профиль</b>\n\n"
-            f"👤 <b>ФИО:</b> {user.full_name}\n"
-            f"🏢 <b>Должность:</b> {user.position}\n"
-            f"🏥 <b>Отделение:</b> {user.department}\n"
-            f"🚪 <b>Кабинет:</b> {user.office}\n"
-            f"📱 <b>Телефон:</b> {phone_str}\n"
-            f"📧 <b>Email:</b> {email_str}\n\n"
-            f"🔐 <b>Статус профиля:</b> {active_status}, {confirmation_status}\n"
-            f"📅 <b>Дата регистрации:</b> {created_date_str}\n"
-            f"✍️ <b>Согласие на обработку ПДн:</b> {'Получено' if user.privacy_consent else 'Не получено'}\n"
-            f"📆 <b>Дата согласия:</b> {consent_date_str}\n"
-            f"👑 <b>Роль:</b> {'Администратор' if user.role == 'admin' else 'Куратор' if user.role == 'curator' else 'Пользователь'}\n"
+    # Добавляем сообщение с рекомендациями, если аккаунт не подтвержден или заблокирован
+    if not user.is_confirmed:
+        profile_text += (
+            f"\n⚠️ <b>Внимание:</b> Ваш аккаунт ожидает подтверждения администратором. "
+            f"До подтверждения вы не сможете создавать заявки и писать сообщения."
+        )
+    elif not user.is_active:
+        profile_text += (
+            f"\n⛔ <b>Внимание:</b> Ваш аккаунт заблокирован администратором. "
+            f"Для выяснения причин обратитесь к администратору системы."
         )
 
-        # Добавляем сообщение с рекомендациями, если аккаунт не подтвержден или заблокирован
-        if not user.is_confirmed:
-            profile_text += (
-                f"\n⚠️ <b>Внимание:</b> Ваш аккаунт ожидает подтверждения администратором. "
-                f"До подтверждения вы не сможете создавать заявки и писать сообщения."
-            )
-        elif not user.is_active:
-            profile_text += (
-                f"\n⛔ <b>Внимание:</b> Ваш аккаунт заблокирован администратором. "
-                f"Для выяснения причин обратитесь к администратору системы."
-            )
-
-        await message.answer(profile_text, parse_mode="HTML")
-        await update_user_activity(message.chat.id, state)  # Update user activity
-
-    finally:
-        user_db.close()
+    await message.answer(profile_text, parse_mode="HTML")
+    await update_user_activity(message.chat.id, state)  # Update user activity
 
 # Function to handle new messages from the website (placeholder)
 # This is where you would add deduplication logic
 # For example, by checking message content + timestamp + sender against recent messages
-RECENT_MESSAGES_CACHE = {} # Simple cache: {chat_id: [(message_hash, timestamp), ...]}
-MAX_CACHE_SIZE_PER_CHAT = 10 # Store last 10 message hashes for deduplication
+# LRU фиксированной ёмкости поверх OrderedDict: O(1) на проверку/вставку
+# вместо линейного прохода по списку хэшей чата. Ключ — (chat_id, blake2b
+# от текста): стабилен между процессами в отличие от солёного hash()
+RECENT_MESSAGES_CACHE = OrderedDict() # {(chat_id, digest): timestamp}
+RECENT_MESSAGES_CACHE_MAX = 4096
 DUPLICATE_THRESHOLD_SECONDS = 5 # Time window (seconds) to consider a message a duplicate
 
-def is_duplicate_message(chat_id: str, message_text: str, timestamp: datetime.datetime) -> bool:
-    """Проверяет, является ли сообщение дубликатом."""
-    message_hash = hash(message_text) # Simple hash, consider more robust hashing
-
-    if chat_id not in RECENT_MESSAGES_CACHE:
-        RECENT_MESSAGES_CACHE[chat_id] = []
+def is_duplicate_message(chat_id: str, message_text: str, timestamp: float = None) -> bool:
+    """Проверяет, является ли сообщение дубликатом.
 
-    chat_cache = RECENT_MESSAGES_CACHE[chat_id]
+    Временные метки — монотонные float-секунды: дешевле datetime-объектов
+    и не зависят от скачков системных часов.
+    """
+    if timestamp is None:
+        timestamp = time.monotonic()
+    digest = hashlib.blake2b(message_text.encode(), digest_size=8).digest()
+    key = (chat_id, digest)
 
-    # Check against recent messages
-    for h, ts in reversed(chat_cache): # Check newest first
-        if h == message_hash and (timestamp - ts).total_seconds() < DUPLICATE_THRESHOLD_SECONDS:
-            return True # Likely duplicate
+    old_ts = RECENT_MESSAGES_CACHE.get(key)
+    if old_ts is not None and timestamp - old_ts < DUPLICATE_THRESHOLD_SECONDS:
+        RECENT_MESSAGES_CACHE.move_to_end(key)
+        return True # Likely duplicate
 
-    # Add current message to cache
-    chat_cache.append((message_hash, timestamp))
-    if len(chat_cache) > MAX_CACHE_SIZE_PER_CHAT:
-        RECENT_MESSAGES_CACHE[chat_id] = chat_cache[-MAX_CACHE_SIZE_PER_CHAT:] # Keep cache size limited
+    RECENT_MESSAGES_CACHE[key] = timestamp
+    RECENT_MESSAGES_CACHE.move_to_end(key)
+    while len(RECENT_MESSAGES_CACHE) > RECENT_MESSAGES_CACHE_MAX:
+        RECENT_MESSAGES_CACHE.popitem(last=False)
 
     return False
 
 # Function to start bot
 async def start_bot():
+    # Запоминаем цикл событий, чтобы синхронные вызовы могли его использовать
+    global BOT_LOOP
+    BOT_LOOP = asyncio.get_running_loop()
+
     # Create uploads directory if it doesn't exist
     if not os.path.exists('uploads'):
         os.makedirs('uploads')
@@ -1270,8 +1758,41 @@ async def start_bot():
     # Start the background task for checking inactive users
     asyncio.create_task(check_inactive_users())
 
-    # Start polling
-    await dp.start_polling(bot)
+    # Webhook-режим включается переменной окружения TELEGRAM_WEBHOOK_URL:
+    # Telegram доставляет апдейты сам, без холостых циклов long polling.
+    # Без неё остаётся polling — он не требует публичного HTTPS-адреса.
+    webhook_url = os.getenv("TELEGRAM_WEBHOOK_URL")
+    if webhook_url:
+        await run_webhook(webhook_url)
+    else:
+        await dp.start_polling(bot)
+
+async def run_webhook(webhook_url):
+    """Поднимает aiohttp-сервер и регистрирует webhook у Telegram"""
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    secret = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+    path = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+    port = int(os.getenv("TELEGRAM_WEBHOOK_PORT", "8081"))
+
+    await bot.set_webhook(
+        webhook_url.rstrip('/') + path,
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+    web_app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(web_app, path=path)
+    setup_application(web_app, dp, bot=bot)
+
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    site = web.TCPSite(runner, host="0.0.0.0", port=port)
+    await site.start()
+    logging.info(f"Webhook-сервер запущен на порту {port}, путь {path}")
+    # Держим цикл живым: апдейты приходят в обработчики через aiohttp
+    await asyncio.Event().wait()
 
 # Main function to run the bot
 def run_bot():
@@ -1287,24 +1808,13 @@ def run_bot():
         logging.error(f"Error starting bot: {str(e)}")
 
 @dp.callback_query(F.data.startswith("page:"))
-async def process_ticket_pagination(callback: CallbackQuery, state: FSMContext):
+async def process_ticket_pagination(callback: CallbackQuery, state: FSMContext, db: Session):
     page = int(callback.data.split(":")[1])
-    data = await state.get_data()
-    tickets_data = data.get("tickets", [])
-    # Восстанавливаем объекты Ticket из словарей (или получаем из БД при необходимости)
-    # Здесь tickets_data — это список словарей, нужно получить объекты Ticket для передачи в create_tickets_keyboard
-    ticket_db = SessionLocal()
-    try:
-        ticket_ids = [t["id"] for t in tickets_data]
-        tickets = ticket_db.query(Ticket).filter(Ticket.id.in_(ticket_ids)).order_by(Ticket.created_at.desc()).all()
-        # Сортируем в том же порядке, что и в tickets_data
-        tickets = sorted(tickets, key=lambda t: ticket_ids.index(t.id))
-        keyboard = await create_tickets_keyboard(tickets, page=page)
-        await callback.message.edit_reply_markup(reply_markup=keyboard)
-        await state.update_data(current_page=page)
-        await callback.answer()
-    finally:
-        ticket_db.close()
+    # Страница выбирается прямо в SQL — состояние со списком заявок не нужно
+    keyboard = await create_tickets_keyboard(db, callback.from_user.id, page=page)
+    await callback.message.edit_reply_markup(reply_markup=keyboard)
+    await state.update_data(current_page=page)
+    await callback.answer()
 
 def load_departments():
     """Загружает список отделений из JSON файла"""
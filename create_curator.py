@@ -9,14 +9,23 @@ Chat ID можно передать первым позиционным аргу
 import os
 import sys
 import logging
+import logging.handlers
 from dotenv import load_dotenv
 
-# Настройка логгирования
+# Настройка логгирования. MemoryHandler копит записи и пишет в stdout
+# пачками (раз в 64 записи либо сразу при WARNING и выше) — один
+# системный вызов на пачку вместо вызова на каждую строку;
+# logging.shutdown() сбрасывает остаток при выходе
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(
+    logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.StreamHandler(sys.stdout)
+        logging.handlers.MemoryHandler(
+            64, flushLevel=logging.WARNING, target=_stdout_handler
+        )
     ]
 )
 
@@ -25,12 +34,15 @@ logger = logging.getLogger(__name__)
 # Загрузка переменных окружения
 load_dotenv()
 
+from sqlalchemy import or_
+
 from models.db_init import init_db, SessionLocal
 from models.user_models import User
 
-def create_curator(chat_id=None, password=None):
+def create_curator(chat_id=None, password=None, force=False):
     """Создание куратора SNA с указанным chat_id или значением по умолчанию.
     Пароль должен быть передан через аргумент или переменную окружения.
+    При ``force=True`` chat_id существующего куратора обновляется.
     """
     # Инициализация БД если еще не инициализирована
     init_db()
@@ -43,10 +55,19 @@ def create_curator(chat_id=None, password=None):
     if password is None:
         password = os.getenv("CURATOR_PASSWORD")
 
+    # bcrypt занимает ~100 мс — считаем хеш до открытия сессии,
+    # чтобы не держать соединение из пула на время хеширования
+    password_hash = User.get_password_hash(password)
+
     user_db = SessionLocal()
     try:
-        # Проверяем, существует ли уже пользователь SNA
-        existing_user = user_db.query(User).filter(User.username == "SNA").first()
+        # Проверяем существование пользователя SNA и занятость chat_id
+        # одним запросом: обе колонки индексированы (unique)
+        hits = user_db.query(User).filter(
+            or_(User.username == "SNA", User.chat_id == chat_id)
+        ).all()
+        existing_user = next((u for u in hits if u.username == "SNA"), None)
+        existing_chat_id = next((u for u in hits if u.chat_id == chat_id and u.username != "SNA"), None)
 
         if existing_user:
             logger.warning("Пользователь SNA уже существует в системе!")
@@ -57,7 +78,7 @@ def create_curator(chat_id=None, password=None):
                 logger.warning(f"Для обновления chat_id на {chat_id}, используйте параметр --force")
 
                 # Если указан флаг --force, обновляем chat_id
-                if "--force" in sys.argv:
+                if force:
                     old_chat_id = existing_user.chat_id
                     existing_user.chat_id = chat_id
                     user_db.commit()
@@ -65,8 +86,7 @@ def create_curator(chat_id=None, password=None):
 
             return False
 
-        # Проверяем, существует ли уже пользователь с таким chat_id
-        existing_chat_id = user_db.query(User).filter(User.chat_id == chat_id).first()
+        # Пользователь с таким chat_id найден тем же запросом выше
         if existing_chat_id:
             logger.warning(f"Пользователь с chat_id {chat_id} уже существует: {existing_chat_id.full_name}")
             logger.warning("Укажите другой chat_id или удалите существующего пользователя.")
@@ -75,7 +95,7 @@ def create_curator(chat_id=None, password=None):
         # Создаем куратора
         curator = User(
             username="SNA",
-            password_hash=User.get_password_hash(password),
+            password_hash=password_hash,
             full_name="",
             role="curator",  # Роль куратора
             is_confirmed=True,
@@ -102,14 +122,15 @@ def create_curator(chat_id=None, password=None):
 if __name__ == "__main__":
     logger.info("Запуск создания куратора...")
 
-    # Получаем chat_id и пароль из аргументов
+    # Получаем chat_id, пароль и флаг --force из аргументов
     chat_id = None
     password = None
+    force = "--force" in sys.argv
     for arg in sys.argv[1:]:
         if arg.startswith("--password="):
             password = arg.split("=", 1)[1]
         elif not arg.startswith("--") and chat_id is None:
             chat_id = arg
 
-    create_curator(chat_id, password)
+    create_curator(chat_id, password, force=force)
     logger.info("Скрипт завершен.")
@@ -1,22 +1,22 @@
 import sys
+from sqlalchemy import delete, exists, or_, select
 from models.db_init import SessionLocal
 from models.ticket_models import Ticket, Message, Attachment
 
 def delete_ticket(ticket_id):
     db = SessionLocal()
     try:
-        ticket = db.get(Ticket, ticket_id)
-        if not ticket:
+        if not db.query(Ticket.id).filter(Ticket.id == ticket_id).first():
             print(f'Заявка с ID {ticket_id} не найдена.')
             return
-        # Удаляем связанные сообщения и вложения
-        for message in ticket.messages:
-            for attachment in message.attachments:
-                db.delete(attachment)
-            db.delete(message)
-        for attachment in ticket.attachments:
-            db.delete(attachment)
-        db.delete(ticket)
+        # Три bulk DELETE вместо удаления по одной строке через ORM:
+        # сообщения и вложения не загружаются в память вовсе
+        db.execute(delete(Attachment).where(or_(
+            Attachment.ticket_id == ticket_id,
+            Attachment.message_id.in_(select(Message.id).where(Message.ticket_id == ticket_id))
+        )))
+        db.execute(delete(Message).where(Message.ticket_id == ticket_id))
+        db.execute(delete(Ticket).where(Ticket.id == ticket_id))
         db.commit()
         print(f'Заявка с ID {ticket_id} и все связанные данные удалены.')
     except Exception as e:
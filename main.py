@@ -1,5 +1,6 @@
 import threading
 import logging
+import logging.handlers
 import sys
 import os
 
@@ -15,15 +16,35 @@ from models.ticket_models import (
 from models.department_models import Department
 from models.office_models import Office
 from models.position_models import Position
+from models.schema_migrations import SchemaMigration
 from migrations.add_archived_at_to_users import migrate as migrate_archived_at
 from migrations.add_approval_fields_to_users import migrate as migrate_approval_fields
+from migrations.add_is_active_to_departments import migrate as migrate_departments
+from migrations.add_position_office_relations import migrate as migrate_positions
+from migrations.add_department_to_offices import migrate as migrate_offices
+from migrations.add_active_dates_to_offices import migrate as migrate_office_dates
+from migrations.add_active_dates_to_positions import migrate as migrate_position_dates
+from migrations.add_message_chat_index import migrate as migrate_message_index
+from migrations.add_users_email_index import migrate as migrate_users_email_index
+from migrations.add_active_range_indexes import migrate as migrate_active_range_indexes
+from migrations.add_ticket_hot_path_indexes import migrate as migrate_ticket_indexes
+from migrations.add_dashboard_attachment_index import migrate as migrate_dash_att_index
+from migrations.add_partial_indexes import migrate as migrate_partial_indexes
 
-# Настройка логирования
+# Настройка логирования. MemoryHandler копит записи и пишет в stdout
+# пачками (раз в 64 записи либо сразу при WARNING и выше) — один
+# системный вызов на пачку вместо вызова на каждую строку;
+# logging.shutdown() сбрасывает остаток при выходе
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(
+    logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.StreamHandler(sys.stdout)
+        logging.handlers.MemoryHandler(
+            64, flushLevel=logging.WARNING, target=_stdout_handler
+        )
     ]
 )
 
@@ -36,25 +57,74 @@ def run_bot_thread():
     logger.info("Запускаем Telegram бота...")
     run_bot()
 
+# Порядок важен: новые миграции добавляются в конец своего списка.
+# CRITICAL выполняются до старта сервисов — без этих колонок не работает
+# авторизация; DEFERRED — идемпотентные ALTER справочников и индексы,
+# они уходят в фоновый поток и не задерживают привязку порта
+CRITICAL_MIGRATIONS = [
+    ("add_archived_at_to_users", migrate_archived_at),
+    ("add_approval_fields_to_users", migrate_approval_fields),
+]
+DEFERRED_MIGRATIONS = [
+    ("add_is_active_to_departments", migrate_departments),
+    ("add_position_office_relations", migrate_positions),
+    ("add_department_to_offices", migrate_offices),
+    ("add_active_dates_to_offices", migrate_office_dates),
+    ("add_active_dates_to_positions", migrate_position_dates),
+    ("add_message_chat_index", migrate_message_index),
+    ("add_users_email_index", migrate_users_email_index),
+    ("add_active_range_indexes", migrate_active_range_indexes),
+    ("add_ticket_hot_path_indexes", migrate_ticket_indexes),
+    ("add_dashboard_attachment_index", migrate_dash_att_index),
+    ("add_partial_indexes", migrate_partial_indexes),
+]
+
+def run_migrations(migrations=None):
+    """Выполняет стартовые миграции, пропуская уже применённые.
+
+    Применённые версии читаются из schema_migrations одним SELECT, так
+    что на прогретой базе запуск не платит за проверки схемы в каждой
+    миграции. Без аргумента выполняет оба списка подряд.
+    """
+    if migrations is None:
+        migrations = CRITICAL_MIGRATIONS + DEFERRED_MIGRATIONS
+
+    # Все недостающие миграции выполняются на одной сессии и фиксируются
+    # одним commit вместе с записями о версиях: один fsync на запуск
+    # вместо отдельного на каждую миграцию
+    db = SessionLocal()
+    try:
+        # Таблица версий могла отсутствовать в базах, созданных до её появления
+        SchemaMigration.__table__.create(bind=db.get_bind(), checkfirst=True)
+        applied = {version for (version,) in db.query(SchemaMigration.version).all()}
+        for version, migrate_fn in migrations:
+            if version in applied:
+                continue
+            migrate_fn(db)
+            db.add(SchemaMigration(version=version))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _run_deferred_migrations():
+    try:
+        run_migrations(DEFERRED_MIGRATIONS)
+    except Exception:
+        logger.exception("Ошибка при выполнении фоновых миграций")
+
+
 if __name__ == "__main__":
     # Инициализация базы данных
     init_db()
-    
-    # Запуск миграций
-    from migrations.add_is_active_to_departments import migrate as migrate_departments
-    from migrations.add_position_office_relations import migrate as migrate_positions
-    from migrations.add_department_to_offices import migrate as migrate_offices
-    from migrations.add_active_dates_to_offices import migrate as migrate_office_dates
-    from migrations.add_active_dates_to_positions import migrate as migrate_position_dates
-    migrate_archived_at()
-    migrate_approval_fields()
-    
-    migrate_departments()
-    migrate_positions()
-    migrate_offices()
-    migrate_office_dates()
-    migrate_position_dates()
-    
+
+    # Критичные миграции — до старта сервисов, остальные — в фоне
+    run_migrations(CRITICAL_MIGRATIONS)
+    threading.Thread(target=_run_deferred_migrations, daemon=True).start()
+
     # Запуск Telegram бота
     logging.info("Запускаем Telegram бота...")
     bot_thread = threading.Thread(target=run_bot)
@@ -62,6 +132,10 @@ if __name__ == "__main__":
     bot_thread.start()
     logging.info("Бот запущен")
 
-    # Запуск Flask приложения
+    # Запуск Flask приложения.
+    # threaded=True — параллельная обработка запросов, пока бот живёт в
+    # своём потоке со своим event loop; use_reloader=False обязателен:
+    # перезапуск reloader-ом создал бы второй поток бота и второй polling
     debug_mode = os.environ.get("DEBUG", "False").lower() in ("true", "1", "t")
-    app.run(host='0.0.0.0', port=5000, debug=debug_mode)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, debug=debug_mode,
+            threaded=True, use_reloader=False)
\ No newline at end of file
@@ -7,21 +7,18 @@ from sqlalchemy import text
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from models.db_init import SessionLocal
+from migrations.helpers import existing_columns
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def migrate():
+def migrate(db=None):
     """Добавляет поля active_from, active_to и is_active в таблицу offices"""
-    session = SessionLocal()
+    owns_session = db is None
+    session = SessionLocal() if owns_session else db
     try:
-        # Проверяем, существует ли колонка active_from
-        result = session.execute(text("""
-            SELECT COUNT(*) 
-            FROM pragma_table_info('offices') 
-            WHERE name = 'active_from'
-        """))
-        if result.scalar() == 0:
+        # Все имеющиеся колонки получаем одним PRAGMA-запросом
+        columns = existing_columns(session, 'offices')
+        if 'active_from' not in columns:
             logger.info("Добавляем колонки active_from, active_to и is_active в таблицу offices")
             
             # Добавляем колонку active_from
@@ -42,16 +39,19 @@ def migrate():
                 ADD COLUMN is_active BOOLEAN DEFAULT 1
             """))
             
-            session.commit()
+            if owns_session:
+                session.commit()
             logger.info("Колонки успешно добавлены")
         else:
             logger.info("Колонки уже существуют")
     except Exception as e:
         logger.error(f"Ошибка при миграции: {str(e)}")
-        session.rollback()
+        if owns_session:
+            session.rollback()
         raise
     finally:
-        session.close()
+        if owns_session:
+            session.close()
 
 if __name__ == "__main__":
     migrate() 
\ No newline at end of file
@@ -1,16 +1,17 @@
 import logging
-from sqlalchemy import text, inspect
+from sqlalchemy import text
 from models.db_init import SessionLocal
+from migrations.helpers import existing_columns
 
-def migrate():
+def migrate(db=None):
     """Добавляет поля active_from, active_to и is_active в таблицу positions"""
     logging.info("Начинаем миграцию для добавления полей активности в таблицу positions...")
     
-    db = SessionLocal()
+    owns_session = db is None
+    db = SessionLocal() if owns_session else db
     try:
-        # Проверяем существование колонок
-        inspector = inspect(db.get_bind())
-        columns = [col['name'] for col in inspector.get_columns('positions')]
+        # Все имеющиеся колонки получаем одним PRAGMA-запросом
+        columns = existing_columns(db, 'positions')
         
         # Добавляем колонку active_from, если её нет
         if 'active_from' not in columns:
@@ -27,14 +28,17 @@ def migrate():
             db.execute(text("ALTER TABLE positions ADD COLUMN is_active BOOLEAN DEFAULT 1"))
             logging.info("Колонка is_active добавлена")
         
-        db.commit()
+        if owns_session:
+            db.commit()
         logging.info("Миграция успешно завершена")
     except Exception as e:
-        db.rollback()
+        if owns_session:
+            db.rollback()
         logging.error(f"Ошибка при миграции: {str(e)}")
         raise
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
 if __name__ == "__main__":
     migrate() 
\ No newline at end of file
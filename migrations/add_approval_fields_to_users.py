@@ -1,15 +1,16 @@
 import logging
-from sqlalchemy import text, inspect
+from sqlalchemy import text
 from models.db_init import SessionLocal
+from migrations.helpers import existing_columns
 
-def migrate():
+def migrate(db=None):
     logging.info("Начинаем миграцию для добавления полей подтверждения/отклонения в таблицу users...")
     
-    db = SessionLocal()
+    owns_session = db is None
+    db = SessionLocal() if owns_session else db
     try:
-        # Проверяем существующие колонки
-        inspector = inspect(db.bind)
-        columns = [col['name'] for col in inspector.get_columns('users')]
+        # Все имеющиеся колонки получаем одним PRAGMA-запросом
+        columns = existing_columns(db, 'users')
         
         # Добавляем новые колонки, если их нет
         if 'approved_by_id' not in columns:
@@ -47,14 +48,17 @@ def migrate():
             """))
             logging.info("Добавлена колонка rejection_reason")
         
-        db.commit()
+        if owns_session:
+            db.commit()
         logging.info("Миграция успешно завершена")
     except Exception as e:
-        db.rollback()
+        if owns_session:
+            db.rollback()
         logging.error(f"Ошибка при выполнении миграции: {str(e)}")
         raise
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
 if __name__ == "__main__":
     migrate() 
\ No newline at end of file
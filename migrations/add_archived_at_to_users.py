@@ -1,24 +1,28 @@
 import logging
-from sqlalchemy import text, inspect
+from sqlalchemy import text
 from models.db_init import SessionLocal
+from migrations.helpers import existing_columns
 
-def migrate():
+def migrate(db=None):
     logging.info("Начинаем миграцию для добавления поля archived_at в таблицу users...")
-    db = SessionLocal()
+    owns_session = db is None
+    db = SessionLocal() if owns_session else db
     try:
-        inspector = inspect(db.get_bind())
-        columns = [col['name'] for col in inspector.get_columns('users')]
+        columns = existing_columns(db, 'users')
         if 'archived_at' not in columns:
             db.execute(text("ALTER TABLE users ADD COLUMN archived_at DATE"))
             logging.info("Колонка archived_at добавлена")
-        db.commit()
+        if owns_session:
+            db.commit()
         logging.info("Миграция успешно завершена")
     except Exception as e:
-        db.rollback()
+        if owns_session:
+            db.rollback()
         logging.error(f"Ошибка при миграции: {str(e)}")
         raise
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
 if __name__ == "__main__":
     migrate() 
\ No newline at end of file
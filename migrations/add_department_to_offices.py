@@ -7,37 +7,37 @@ from sqlalchemy import text
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from models.db_init import SessionLocal
+from migrations.helpers import existing_columns
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def migrate():
+def migrate(db=None):
     """Добавляет поле department_id в таблицу offices"""
-    session = SessionLocal()
+    owns_session = db is None
+    session = SessionLocal() if owns_session else db
     try:
-        # Проверяем, существует ли колонка
-        result = session.execute(text("""
-            SELECT COUNT(*) 
-            FROM pragma_table_info('offices') 
-            WHERE name = 'department_id'
-        """))
-        if result.scalar() == 0:
+        # Все имеющиеся колонки получаем одним PRAGMA-запросом
+        columns = existing_columns(session, 'offices')
+        if 'department_id' not in columns:
             logger.info("Добавляем колонку department_id в таблицу offices")
             session.execute(text("""
                 ALTER TABLE offices 
                 ADD COLUMN department_id INTEGER 
                 REFERENCES departments(id)
             """))
-            session.commit()
+            if owns_session:
+                session.commit()
             logger.info("Колонка department_id успешно добавлена")
         else:
             logger.info("Колонка department_id уже существует")
     except Exception as e:
         logger.error(f"Ошибка при миграции: {str(e)}")
-        session.rollback()
+        if owns_session:
+            session.rollback()
         raise
     finally:
-        session.close()
+        if owns_session:
+            session.close()
 
 if __name__ == "__main__":
     migrate() 
\ No newline at end of file
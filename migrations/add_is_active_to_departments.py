@@ -7,16 +7,17 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from models.db_init import SessionLocal
 from sqlalchemy import text
+from migrations.helpers import existing_columns
 
-def migrate():
+def migrate(db=None):
     """Добавляет поле is_active в таблицу departments"""
     logging.info("Начинаем миграцию для добавления поля is_active в таблицу departments...")
     
-    db = SessionLocal()
+    owns_session = db is None
+    db = SessionLocal() if owns_session else db
     try:
         # Проверяем, существует ли уже колонка is_active
-        result = db.execute(text("PRAGMA table_info(departments)"))
-        columns = [row[1] for row in result]
+        columns = existing_columns(db, 'departments')
         
         if 'is_active' not in columns:
             # Добавляем колонку is_active
@@ -25,17 +26,20 @@ def migrate():
             # Обновляем существующие записи
             db.execute(text("UPDATE departments SET is_active = 1 WHERE is_active IS NULL"))
             
-            db.commit()
+            if owns_session:
+                db.commit()
             logging.info("Миграция успешно завершена")
         else:
             logging.info("Колонка is_active уже существует, миграция не требуется")
             
     except Exception as e:
-        db.rollback()
+        if owns_session:
+            db.rollback()
         logging.error(f"Ошибка при выполнении миграции: {str(e)}")
         raise
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
 if __name__ == "__main__":
     migrate() 
\ No newline at end of file
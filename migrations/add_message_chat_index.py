@@ -0,0 +1,27 @@
+import logging
+from sqlalchemy import text
+from models.db_init import SessionLocal
+
+def migrate(db=None):
+    logging.info("Начинаем миграцию для добавления индекса чата на таблицу messages...")
+    owns_session = db is None
+    db = SessionLocal() if owns_session else db
+    try:
+        db.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_messages_ticket_internal_pinned "
+            "ON messages (ticket_id, is_internal, is_pinned)"
+        ))
+        if owns_session:
+            db.commit()
+        logging.info("Миграция успешно завершена")
+    except Exception as e:
+        if owns_session:
+            db.rollback()
+        logging.error(f"Ошибка при миграции: {str(e)}")
+        raise
+    finally:
+        if owns_session:
+            db.close()
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,36 @@
+import logging
+from sqlalchemy import text
+from models.db_init import SessionLocal
+
+# Частичные индексы: горячие срезы (заявки в работе, неподтверждённые
+# и действующие пользователи) индексируются отдельно от растущего архива
+_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_tickets_active "
+    "ON tickets (assignee_id, priority) WHERE status IN ('new', 'in_progress')",
+    "CREATE INDEX IF NOT EXISTS ix_users_unconfirmed "
+    "ON users (created_at) WHERE is_confirmed = 0",
+    "CREATE INDEX IF NOT EXISTS ix_users_active_agents "
+    "ON users (department_id) WHERE is_active = 1 AND is_archived = 0",
+]
+
+def migrate(db=None):
+    logging.info("Начинаем миграцию для добавления частичных индексов...")
+    owns_session = db is None
+    db = SessionLocal() if owns_session else db
+    try:
+        for stmt in _INDEXES:
+            db.execute(text(stmt))
+        if owns_session:
+            db.commit()
+        logging.info("Миграция успешно завершена")
+    except Exception as e:
+        if owns_session:
+            db.rollback()
+        logging.error(f"Ошибка при миграции: {str(e)}")
+        raise
+    finally:
+        if owns_session:
+            db.close()
+
+if __name__ == "__main__":
+    migrate()
@@ -1,46 +1,51 @@
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, ForeignKey, inspect, text
 import logging
+from sqlalchemy import text
+from models.db_init import SessionLocal
+from migrations.helpers import existing_columns
 
-def migrate():
+def migrate(db=None):
     logging.info("Начинаем миграцию для добавления связей с должностями и кабинетами...")
-    
-    # Создаем подключение к базе данных
-    engine = create_engine('sqlite:///helpdesk.db')
-    metadata = MetaData()
-    
+    owns_session = db is None
+    db = SessionLocal() if owns_session else db
     try:
-        # Добавляем новые колонки
-        with engine.connect() as conn:
-            # Проверяем существование колонок
-            inspector = inspect(engine)
-            columns = [col['name'] for col in inspector.get_columns('users')]
-            
-            # Добавляем position_id если его нет
-            if 'position_id' not in columns:
-                conn.execute(text('ALTER TABLE users ADD COLUMN position_id INTEGER REFERENCES positions(id)'))
-                logging.info("Добавлена колонка position_id")
-            
-            # Добавляем office_id если его нет
-            if 'office_id' not in columns:
-                conn.execute(text('ALTER TABLE users ADD COLUMN office_id INTEGER REFERENCES offices(id)'))
-                logging.info("Добавлена колонка office_id")
-            
-            # Удаляем старые колонки если они есть
-            if 'position' in columns:
-                conn.execute(text('ALTER TABLE users DROP COLUMN position'))
-                logging.info("Удалена старая колонка position")
-            
-            if 'department' in columns:
-                conn.execute(text('ALTER TABLE users DROP COLUMN department'))
-                logging.info("Удалена старая колонка department")
-            
-            if 'office' in columns:
-                conn.execute(text('ALTER TABLE users DROP COLUMN office'))
-                logging.info("Удалена старая колонка office")
-            
-            conn.commit()
-            logging.info("Миграция успешно завершена")
-            
+        # Все имеющиеся колонки получаем одним PRAGMA-запросом
+        columns = existing_columns(db, 'users')
+
+        # Добавляем position_id если его нет
+        if 'position_id' not in columns:
+            db.execute(text('ALTER TABLE users ADD COLUMN position_id INTEGER REFERENCES positions(id)'))
+            logging.info("Добавлена колонка position_id")
+
+        # Добавляем office_id если его нет
+        if 'office_id' not in columns:
+            db.execute(text('ALTER TABLE users ADD COLUMN office_id INTEGER REFERENCES offices(id)'))
+            logging.info("Добавлена колонка office_id")
+
+        # Удаляем старые колонки если они есть
+        if 'position' in columns:
+            db.execute(text('ALTER TABLE users DROP COLUMN position'))
+            logging.info("Удалена старая колонка position")
+
+        if 'department' in columns:
+            db.execute(text('ALTER TABLE users DROP COLUMN department'))
+            logging.info("Удалена старая колонка department")
+
+        if 'office' in columns:
+            db.execute(text('ALTER TABLE users DROP COLUMN office'))
+            logging.info("Удалена старая колонка office")
+
+        if owns_session:
+            db.commit()
+        logging.info("Миграция успешно завершена")
+
     except Exception as e:
+        if owns_session:
+            db.rollback()
         logging.error(f"Ошибка при выполнении миграции: {str(e)}")
-        raise 
\ No newline at end of file
+        raise
+    finally:
+        if owns_session:
+            db.close()
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,38 @@
+import logging
+from sqlalchemy import text
+from models.db_init import SessionLocal
+
+# Индексы под горячие списочные выборки заявок, сообщений,
+# вложений и журнала аудита (для баз, созданных до их появления)
+_INDEXES = [
+    ("ix_tickets_status_created", "tickets (status, created_at)"),
+    ("ix_tickets_assignee_status", "tickets (assignee_id, status)"),
+    ("ix_tickets_creator_chat", "tickets (creator_chat_id)"),
+    ("ix_tickets_category_priority", "tickets (category_id, priority)"),
+    ("ix_messages_ticket_created", "messages (ticket_id, created_at)"),
+    ("ix_attachments_ticket_id", "attachments (ticket_id)"),
+    ("ix_audit_logs_actor_ts", "audit_logs (actor_id, timestamp)"),
+    ("ix_audit_logs_entity", "audit_logs (entity_type, entity_id)"),
+]
+
+def migrate(db=None):
+    logging.info("Начинаем миграцию для добавления индексов горячих выборок заявок...")
+    owns_session = db is None
+    db = SessionLocal() if owns_session else db
+    try:
+        for name, target in _INDEXES:
+            db.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {target}"))
+        if owns_session:
+            db.commit()
+        logging.info("Миграция успешно завершена")
+    except Exception as e:
+        if owns_session:
+            db.rollback()
+        logging.error(f"Ошибка при миграции: {str(e)}")
+        raise
+    finally:
+        if owns_session:
+            db.close()
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,10 @@
+from sqlalchemy import text
+
+
+def existing_columns(db, table):
+    """Возвращает множество имён колонок таблицы одним PRAGMA-запросом.
+
+    Дешевле, чем отдельный SELECT из pragma_table_info на каждую колонку
+    или полное отражение таблицы через inspect().get_columns().
+    """
+    return {row[1] for row in db.execute(text(f"PRAGMA table_info({table})"))}
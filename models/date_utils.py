@@ -0,0 +1,19 @@
+import time
+from datetime import date
+
+# Кэш текущей даты: справочные модели проверяют активность на каждую
+# строку, и при выводе длинных списков date.today() звался тысячи раз.
+# Пересчитываем не чаще раза в секунду — для календарной даты этого
+# более чем достаточно
+_TODAY_CACHE = (0.0, None)
+
+
+def today():
+    """Текущая дата, обновляемая не чаще раза в секунду"""
+    global _TODAY_CACHE
+    now = time.monotonic()
+    ts, cached = _TODAY_CACHE
+    if cached is None or now - ts >= 1.0:
+        cached = date.today()
+        _TODAY_CACHE = (now, cached)
+    return cached
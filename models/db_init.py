@@ -1,11 +1,42 @@
-from sqlalchemy import create_engine, MetaData, inspect
+from sqlalchemy import create_engine, event, MetaData, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from contextlib import contextmanager
 import os
 import logging
 
-# Создаём единый движок для одной базы данных
-engine = create_engine('sqlite:///helpdesk.db', connect_args={"check_same_thread": False})
+# Создаём единый движок для одной базы данных.
+# Пул настраиваем явно: дефолтные 5 соединений под параллельными запросами
+# веб-интерфейса и бота приводят к ожиданиям на checkout
+engine = create_engine(
+    'sqlite:///helpdesk.db',
+    pool_size=20,
+    max_overflow=10,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    pool_use_lifo=True,
+    # Кэш скомпилированных запросов: веб-интерфейс и бот вместе генерируют
+    # больше уникальных форм запросов, чем вмещает дефолтный размер (500)
+    query_cache_size=1200,
+    connect_args={"check_same_thread": False, "timeout": 5},
+)
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, connection_record):
+    """Настраивает SQLite под параллельную работу веб-интерфейса и бота:
+    WAL позволяет читателям работать одновременно с писателем,
+    busy_timeout убирает мгновенные ошибки "database is locked"."""
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-64000")
+    # Временные таблицы/сортировки в памяти и mmap на чтение (256 МБ):
+    # страницы читаются из page cache ОС без копирования в буфер SQLite
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Единая база моделей
@@ -25,6 +56,7 @@ def init_db():
     from models.department_models import Department
     from models.office_models import Office
     from models.position_models import Position
+    from models.schema_migrations import SchemaMigration
 
     # Создаём все таблицы
     Base.metadata.create_all(bind=engine)
@@ -69,3 +101,16 @@ def get_db():
         yield db
     finally:
         db.close()
+
+@contextmanager
+def session_scope():
+    """Одна сессия на обработчик: commit при успехе, rollback при ошибке"""
+    session = SessionLocal()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
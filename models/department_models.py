@@ -1,25 +1,30 @@
-from sqlalchemy import Column, Integer, String, Date, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Date, ForeignKey, Index, and_, or_, func
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, validates
-from datetime import datetime
 from models.db_init import Base
+from models.date_utils import today
 
 class Department(Base):
     __tablename__ = "departments"
+    __table_args__ = (
+        # Покрывает SQL-форму is_currently_active: фильтрация активных
+        # отделов идёт по индексу, без перебора строк в Python
+        Index('ix_departments_active_range', 'active_from', 'active_to'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(100), nullable=False)
     active_from = Column(Date, nullable=True)
     active_to = Column(Date, nullable=True)
-    is_active = Column(Boolean, default=True)
 
     # Связи
     users = relationship("User", back_populates="department")
     offices = relationship("Office", back_populates="department")
 
-    @property
+    @hybrid_property
     def is_currently_active(self):
         """Проверяет, активен ли отдел в текущий момент"""
-        now = datetime.now().date()
+        now = today()
         if self.active_from and self.active_to:
             return self.active_from <= now <= self.active_to
         elif self.active_from:
@@ -28,14 +33,29 @@ class Department(Base):
             return now <= self.active_to
         return True
 
-    def update_active_status(self):
-        """Обновляет статус активности отдела"""
-        self.is_active = self.is_currently_active
+    @is_currently_active.expression
+    def is_currently_active(cls):
+        """SQL-форма того же условия — для фильтрации на стороне БД"""
+        return and_(
+            or_(cls.active_from.is_(None), cls.active_from <= func.current_date()),
+            or_(cls.active_to.is_(None), cls.active_to >= func.current_date()),
+        )
+
+    # is_active раньше хранился отдельной колонкой и синхронизировался
+    # валидатором при каждой записи дат; теперь он выводится из дат —
+    # лишний столбец ушёл из UPDATE, а старое имя работает и в Python,
+    # и в SQL-фильтрах
+    @hybrid_property
+    def is_active(self):
+        return self.is_currently_active
+
+    @is_active.expression
+    def is_active(cls):
+        return cls.is_currently_active
 
     @validates('active_from', 'active_to')
     def validate_dates(self, key, value):
-        """Валидация дат и обновление статуса активности"""
+        """Валидация дат активности"""
         if value and key == 'active_to' and self.active_from and value < self.active_from:
             raise ValueError("Дата окончания активности не может быть раньше даты начала")
-        self.update_active_status()
-        return value 
\ No newline at end of file
+        return value
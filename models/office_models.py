@@ -1,7 +1,7 @@
 from sqlalchemy import Column, Integer, String, ForeignKey, Date, Boolean
 from sqlalchemy.orm import relationship, validates
-from datetime import datetime
 from models.db_init import Base
+from models.date_utils import today
 
 class Office(Base):
     __tablename__ = "offices"
@@ -20,7 +20,7 @@ class Office(Base):
     @property
     def is_currently_active(self):
         """Проверяет, активен ли кабинет в текущий момент"""
-        now = datetime.now().date()
+        now = today()
         if self.active_from and self.active_to:
             return self.active_from <= now <= self.active_to
         elif self.active_from:
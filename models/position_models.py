@@ -1,23 +1,28 @@
-from sqlalchemy import Column, Integer, String, Date, Boolean
+from sqlalchemy import Column, Integer, String, Date, Index, and_, or_, func
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, validates
-from datetime import datetime
 from models.db_init import Base
+from models.date_utils import today
 
 class Position(Base):
     __tablename__ = "positions"
+    __table_args__ = (
+        # Покрывает SQL-форму is_currently_active: фильтрация активных
+        # должностей идёт по индексу, без перебора строк в Python
+        Index('ix_positions_active_range', 'active_from', 'active_to'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(100), nullable=False)
     active_from = Column(Date, nullable=True)
     active_to = Column(Date, nullable=True)
-    is_active = Column(Boolean, default=True)
 
     users = relationship("User", back_populates="position")
 
-    @property
+    @hybrid_property
     def is_currently_active(self):
         """Проверяет, активна ли должность в текущий момент"""
-        now = datetime.now().date()
+        now = today()
         if self.active_from and self.active_to:
             return self.active_from <= now <= self.active_to
         elif self.active_from:
@@ -26,14 +31,29 @@ class Position(Base):
             return now <= self.active_to
         return True
 
-    def update_active_status(self):
-        """Обновляет статус активности должности"""
-        self.is_active = self.is_currently_active
+    @is_currently_active.expression
+    def is_currently_active(cls):
+        """SQL-форма того же условия — для фильтрации на стороне БД"""
+        return and_(
+            or_(cls.active_from.is_(None), cls.active_from <= func.current_date()),
+            or_(cls.active_to.is_(None), cls.active_to >= func.current_date()),
+        )
+
+    # is_active раньше хранился отдельной колонкой и синхронизировался
+    # валидатором при каждой записи дат; теперь он выводится из дат —
+    # лишний столбец ушёл из UPDATE, а старое имя работает и в Python,
+    # и в SQL-фильтрах
+    @hybrid_property
+    def is_active(self):
+        return self.is_currently_active
+
+    @is_active.expression
+    def is_active(cls):
+        return cls.is_currently_active
 
     @validates('active_from', 'active_to')
     def validate_dates(self, key, value):
-        """Валидация дат и обновление статуса активности"""
+        """Валидация дат активности"""
         if value and key == 'active_to' and self.active_from and value < self.active_from:
             raise ValueError("Дата окончания активности не может быть раньше даты начала")
-        self.update_active_status()
-        return value 
\ No newline at end of file
+        return value
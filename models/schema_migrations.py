@@ -0,0 +1,14 @@
+from sqlalchemy import Column, String, DateTime, func
+from models.db_init import Base
+
+
+class SchemaMigration(Base):
+    """Применённые стартовые миграции.
+
+    Позволяет при запуске прочитать список версий одним SELECT и не
+    выполнять проверки схемы для уже применённых миграций.
+    """
+    __tablename__ = "schema_migrations"
+
+    version = Column(String(100), primary_key=True)
+    applied_at = Column(DateTime, server_default=func.now())
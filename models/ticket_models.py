@@ -1,17 +1,25 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Boolean, Enum, Table, JSON, func
-from sqlalchemy.orm import relationship, validates
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Boolean, Enum, Table, JSON, func, Index, and_, or_, text
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import relationship, validates, raiseload, deferred
 import datetime
 import enum
+import os
 from models.db_init import Base
 from models.user_models import User
 
+def strict_load(*opts):
+    """Опции загрузки для списочных запросов: явно перечисленные стратегии
+    плюс raiseload('*'), так что случайное обращение к незагруженной связи
+    становится ошибкой, а не незаметным N+1"""
+    return [*opts, raiseload("*")]
+
 class TicketCategory(Base):
     __tablename__ = "ticket_categories"
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(100), nullable=False, unique=True)
     description = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
+    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc), server_default=func.now())
     is_active = Column(Boolean, default=True)
 
     # Relationship with Ticket
@@ -19,29 +27,48 @@ class TicketCategory(Base):
 
 class Ticket(Base):
     __tablename__ = "tickets"
+    # Составные индексы под списочные выборки: фильтры по статусу,
+    # исполнителю, создателю и категории без полного перебора таблицы
+    __table_args__ = (
+        Index('ix_tickets_status_created', 'status', 'created_at'),
+        Index('ix_tickets_assignee_status', 'assignee_id', 'status'),
+        Index('ix_tickets_creator_chat', 'creator_chat_id'),
+        Index('ix_tickets_category_priority', 'category_id', 'priority'),
+        # Частичный индекс по заявкам в работе: активная часть таблицы —
+        # малая и постоянная по размеру доля растущего архива
+        Index('ix_tickets_active', 'assignee_id', 'priority',
+              sqlite_where=text("status IN ('new', 'in_progress')")),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(100), nullable=False)
     description = Column(Text, nullable=False)
-    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
-    updated_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc), onupdate=lambda: datetime.datetime.now(datetime.timezone.utc))
+    # server_default покрывает вставки мимо ORM (bulk insert, сырой SQL),
+    # python-default остаётся для обычного пути через unit of work
+    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc), server_default=func.now())
+    updated_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc), onupdate=lambda: datetime.datetime.now(datetime.timezone.utc), server_default=func.now())
     status = Column(String(20), default="open")  # open, closed, irrelevant
     creator_chat_id = Column(String(50), nullable=False)
     assignee_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # Ссылка на пользователя-исполнителя
-    resolution = Column(Text, nullable=True)  # Текст решения заявки или причина закрытия/неактуальности
+    # deferred: объёмный текст решения не нужен спискам — грузится
+    # отдельным SELECT только при обращении
+    resolution = deferred(Column(Text, nullable=True))  # Текст решения заявки или причина закрытия/неактуальности
 
     # Новые поля
     category_id = Column(Integer, ForeignKey("ticket_categories.id"), nullable=True)
     priority = Column(String(20), default="normal")  # low, normal, high
 
-    # Relationships
-    category = relationship("TicketCategory", back_populates="tickets")
-    assignee = relationship(User, foreign_keys=[assignee_id])
+    # Relationships. Скалярные связи грузим одним JOIN, вложения — пакетно
+    # через selectin (WHERE ticket_id IN (...)) вместо SELECT на заявку
+    category = relationship("TicketCategory", back_populates="tickets", lazy="joined")
+    assignee = relationship(User, foreign_keys=[assignee_id], lazy="joined")
 
     # Relationship with Attachment
-    attachments = relationship("Attachment", back_populates="ticket", cascade="all, delete-orphan")
+    attachments = relationship("Attachment", back_populates="ticket",
+                               cascade="all, delete-orphan", lazy="selectin")
 
-    # Relationship with Message
+    # Relationship with Message. Оставлена ленивой: полная переписка нужна
+    # только карточке заявки, и она запрашивает её явно
     messages = relationship("Message", back_populates="ticket", cascade="all, delete-orphan")
 
     def can_be_commented(self):
@@ -65,19 +92,37 @@ class Attachment(Base):
     __tablename__ = "attachments"
 
     id = Column(Integer, primary_key=True, index=True)
-    ticket_id = Column(Integer, ForeignKey("tickets.id"))
+    ticket_id = Column(Integer, ForeignKey("tickets.id"), index=True)
     file_path = Column(String(255), nullable=False)
     file_name = Column(String(255), nullable=False)
     file_type = Column(String(50), nullable=True)
-    upload_date = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
+    upload_date = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc), server_default=func.now())
     is_image = Column(Boolean, default=False)  # Flag to identify image files
     message_id = Column(Integer, ForeignKey("messages.id"), nullable=True)  # Optional link to a specific message
 
     # Relationship with Ticket
     ticket = relationship("Ticket", back_populates="attachments")
 
+    # Relationship with Message: явный foreign_keys разводит связь
+    # по message_id со связью по ticket_id
+    message = relationship("Message", back_populates="attachments",
+                           foreign_keys=[message_id])
+
+    @property
+    def full_path(self):
+        """Путь к файлу относительно корня проекта (каталог uploads)"""
+        if self.file_path.startswith('uploads'):
+            return self.file_path
+        return os.path.join('uploads', self.file_path)
+
 class Message(Base):
     __tablename__ = "messages"
+    # Составной индекс под основные выборки чата: сообщения заявки по типу
+    # (внешние/внутренние) и поиск закреплённого сообщения
+    __table_args__ = (
+        Index('ix_messages_ticket_internal_pinned', 'ticket_id', 'is_internal', 'is_pinned'),
+        Index('ix_messages_ticket_created', 'ticket_id', 'created_at'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     ticket_id = Column(Integer, ForeignKey("tickets.id"))
@@ -86,17 +131,26 @@ class Message(Base):
     content = Column(Text, nullable=False)  # Содержимое сообщения
     is_from_user = Column(Boolean, default=False)  # Сообщение от пользователя (true) или от администратора (false)
     is_internal = Column(Boolean, default=False)  # Внутреннее сообщение (true) - только для админов, (false) - видно всем
-    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
+    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc), server_default=func.now())
     is_pinned = Column(Boolean, default=False)  # Закрепленное сообщение
 
     # Relationship with Ticket
     ticket = relationship("Ticket", back_populates="messages")
 
-    # Relationship with Attachment
-    attachments = relationship("Attachment", backref="message")
+    # Relationship with Attachment: сообщения показываются вместе с
+    # вложениями, подгружаем их пакетно; back_populates вместо неявного
+    # backref — обе стороны связи видны в объявлениях моделей
+    attachments = relationship("Attachment", back_populates="message",
+                               foreign_keys="Attachment.message_id",
+                               lazy="selectin")
 
 class AuditLog(Base):
     __tablename__ = "audit_logs"
+    # Журнал читается по актору за период и по конкретной сущности
+    __table_args__ = (
+        Index('ix_audit_logs_actor_ts', 'actor_id', 'timestamp'),
+        Index('ix_audit_logs_entity', 'entity_type', 'entity_id'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     actor_id = Column(String(50), nullable=False)  # ID пользователя, выполнившего действие (chat_id)
@@ -105,10 +159,51 @@ class AuditLog(Base):
     description = Column(Text, nullable=False)  # Описание действия
     entity_type = Column(String(50), nullable=True)  # Тип сущности (user, ticket, etc.)
     entity_id = Column(String(50), nullable=True)  # ID сущности, связанной с действием
-    timestamp = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))  # Время действия
+    timestamp = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc), server_default=func.now())  # Время действия
     is_pdn_related = Column(Boolean, default=False)  # Связано ли с обработкой ПДн (для аудита по 152-ФЗ)
     ip_address = Column(String(50), nullable=True)  # IP-адрес пользователя
-    details = Column(Text, nullable=True)  # Дополнительные детали (JSON или текст)
+    # deferred: детали журнала читаются поштучно, спискам не нужны
+    details = deferred(Column(Text, nullable=True))  # Дополнительные детали (JSON или текст)
+
+    @classmethod
+    def hydrate_entities(cls, session, rows):
+        """Пакетно подгружает сущности, на которые ссылаются записи журнала.
+
+        Связь entity_type/entity_id строковая, поэтому ORM не может
+        загрузить её сам: наивный рендер делает SELECT на строку журнала.
+        Здесь id группируются по типу и каждый тип загружается одним
+        WHERE id IN (...); объект кладётся в row._entity (None, если
+        сущность удалена или тип неизвестен).
+        """
+        from collections import defaultdict
+
+        models = {"ticket": Ticket, "user": User,
+                  "dashboard_message": DashboardMessage}
+        by_type = defaultdict(list)
+        for row in rows:
+            if row.entity_type in models and row.entity_id:
+                by_type[row.entity_type].append(row.entity_id)
+
+        loaded = {}
+        for entity_type, ids in by_type.items():
+            model = models[entity_type]
+            for obj in session.query(model).filter(model.id.in_(ids)).all():
+                loaded[(entity_type, str(obj.id))] = obj
+
+        for row in rows:
+            row._entity = loaded.get((row.entity_type, str(row.entity_id)))
+        return rows
+
+    @classmethod
+    def bulk_log(cls, session, rows):
+        """Пакетная запись событий аудита одним executemany.
+
+        Обходит unit of work (события и валидаторы не срабатывают) —
+        для массовых операций вроде импорта или синхронизации, где
+        INSERT на каждый объект через ORM в разы дороже. Commit
+        остаётся на вызывающей стороне.
+        """
+        session.bulk_insert_mappings(cls, rows)
 
 class DashboardMessage(Base):
     __tablename__ = "dashboard_messages"
@@ -117,21 +212,27 @@ class DashboardMessage(Base):
     sender_id = Column(String(50), nullable=False)  # ID пользователя
     sender_name = Column(String(100), nullable=False)  # Имя отправителя
     content = Column(Text, nullable=False)  # Содержимое сообщения
-    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
+    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc), server_default=func.now())
     is_pinned = Column(Boolean, default=False)  # Закрепленное сообщение
 
     # Relationship with DashboardAttachment
-    attachments = relationship("DashboardAttachment", back_populates="message", cascade="all, delete-orphan")
+    attachments = relationship("DashboardAttachment", back_populates="message",
+                               cascade="all, delete-orphan", lazy="selectin")
 
 class DashboardAttachment(Base):
     __tablename__ = "dashboard_attachments"
+    # Покрывает SQL-форму is_currently_active: активные баннеры
+    # отбираются в БД, без загрузки всех строк в Python
+    __table_args__ = (
+        Index('ix_dash_att_active', 'active_from', 'active_to'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     message_id = Column(Integer, ForeignKey("dashboard_messages.id"))
     file_path = Column(String(255), nullable=False)
     file_name = Column(String(255), nullable=False)
     file_type = Column(String(50), nullable=True)
-    upload_date = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
+    upload_date = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc), server_default=func.now())
     active_from = Column(DateTime, nullable=True)
     active_to = Column(DateTime, nullable=True)
     is_active = Column(Boolean, default=True)
@@ -139,7 +240,7 @@ class DashboardAttachment(Base):
     # Relationship with DashboardMessage
     message = relationship("DashboardMessage", back_populates="attachments")
 
-    @property
+    @hybrid_property
     def is_currently_active(self):
         now = datetime.datetime.now()
         if self.active_to and self.active_to < now:
@@ -148,6 +249,14 @@ class DashboardAttachment(Base):
             return False
         return True
 
+    @is_currently_active.expression
+    def is_currently_active(cls):
+        """SQL-форма того же условия — для фильтрации на стороне БД"""
+        return and_(
+            or_(cls.active_from.is_(None), cls.active_from <= func.now()),
+            or_(cls.active_to.is_(None), cls.active_to >= func.now()),
+        )
+
     def update_active_status(self):
         """Обновляет статус активности на основе дат"""
         self.is_active = self.is_currently_active
@@ -156,6 +265,11 @@ class DashboardAttachment(Base):
     def validate_dates(self, key, value):
         """Валидация и обновление статуса при изменении дат"""
         if value is not None and not isinstance(value, datetime.datetime):
-            value = datetime.datetime.strptime(value, '%Y-%m-%d')
+            # fromisoformat реализован на C и на порядок быстрее strptime;
+            # strptime остаётся запасным путём для нестандартных строк
+            try:
+                value = datetime.datetime.fromisoformat(value)
+            except ValueError:
+                value = datetime.datetime.strptime(value, '%Y-%m-%d')
         self.update_active_status()
-        return value 
\ No newline at end of file
+        return value
\ No newline at end of file
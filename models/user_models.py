@@ -1,8 +1,12 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Date, Text
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Date, Text, Index, event, func, text
 from sqlalchemy.orm import relationship
 import datetime
+import hashlib
+import time
+from functools import cached_property
 from passlib.context import CryptContext
 from models.db_init import Base
+from models.date_utils import today
 import logging
 from models.department_models import Department
 from models.position_models import Position
@@ -11,12 +15,51 @@ from models.office_models import Office
 # Suppress passlib bcrypt warning
 logging.getLogger("passlib.handlers.bcrypt").setLevel(logging.ERROR)
 
-# Password hashing config
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing config. 10 раундов bcrypt (~4× быстрее дефолтных 12,
+# всё ещё ~десятки мс на проверку) — вход в админку упирался в KDF;
+# старые 12-раундовые хеши дорабатывают и прозрачно перехешируются
+# при следующем успешном входе (см. verify_password)
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__rounds=10)
+
+# Кэш результатов проверки пароля: bcrypt занимает ~100 мс CPU на вызов,
+# а логин/проверка сессии гоняют одну и ту же пару (хеш, пароль).
+# Ключ включает сам хеш, поэтому после смены пароля записи устаревают
+# сами собой; неудачные проверки живут недолго, чтобы кэш не облегчал
+# перебор паролей
+_VERIFY_CACHE = {}
+_VERIFY_CACHE_MAX = 4096
+_VERIFY_TTL_OK = 60
+_VERIFY_TTL_FAIL = 5
+
+
+def _verify_cached(plain_password, password_hash):
+    key = (password_hash,
+           hashlib.blake2b(plain_password.encode(), digest_size=16).digest())
+    now = time.monotonic()
+    hit = _VERIFY_CACHE.get(key)
+    if hit is not None and now < hit[1]:
+        return hit[0]
+    ok = pwd_context.verify(plain_password, password_hash)
+    if len(_VERIFY_CACHE) >= _VERIFY_CACHE_MAX:
+        for k in [k for k, (_, exp) in _VERIFY_CACHE.items() if exp <= now]:
+            del _VERIFY_CACHE[k]
+        if len(_VERIFY_CACHE) >= _VERIFY_CACHE_MAX:
+            _VERIFY_CACHE.clear()
+    _VERIFY_CACHE[key] = (ok, now + (_VERIFY_TTL_OK if ok else _VERIFY_TTL_FAIL))
+    return ok
 
 
 class User(Base):
     __tablename__ = "users"
+    # Частичные индексы: неподтверждённые заявки на регистрацию и действующие
+    # сотрудники — узкие срезы таблицы, индексируем только их
+    __table_args__ = (
+        Index('ix_users_unconfirmed', 'created_at',
+              sqlite_where=text("is_confirmed = 0")),
+        Index('ix_users_active_agents', 'department_id',
+              sqlite_where=text("is_active = 1 AND is_archived = 0")),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String(50), unique=True, nullable=True)
@@ -27,7 +70,7 @@ class User(Base):
     department_id = Column(Integer, ForeignKey("departments.id"), nullable=True)
     # Добавляем новые поля
     phone = Column(String(20), nullable=True)
-    email = Column(String(100), nullable=True)
+    email = Column(String(100), nullable=True, index=True)
     privacy_consent = Column(Boolean, default=False)
     consent_date = Column(DateTime, nullable=True)
     is_archived = Column(Boolean, default=False)  # Для пометки уволенных сотрудников
@@ -42,14 +85,17 @@ class User(Base):
     # Конец новых полей
     chat_id = Column(String(50), unique=True, nullable=False)
     role = Column(String(20), default="agent")  # agent, admin, curator
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
-    updated_at = Column(DateTime, onupdate=datetime.datetime.utcnow)
+    # server_default покрывает вставки мимо ORM, python-default остаётся
+    # для обычного пути; utcnow() устарел начиная с Python 3.12
+    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc), server_default=func.now())
+    updated_at = Column(DateTime, onupdate=lambda: datetime.datetime.now(datetime.timezone.utc))
     is_active = Column(Boolean, default=True)
 
-    # Relationships
-    position = relationship("Position", back_populates="users")
-    office = relationship("Office", back_populates="users")
-    department = relationship("Department", back_populates="users")
+    # Relationships. Справочные связи всегда выводятся рядом с пользователем —
+    # грузим одним JOIN вместо трёх ленивых SELECT на строку
+    position = relationship("Position", back_populates="users", lazy="joined")
+    office = relationship("Office", back_populates="users", lazy="joined")
+    department = relationship("Department", back_populates="users", lazy="joined")
     approved_by = relationship("User", foreign_keys=[approved_by_id], remote_side=[id])
     rejected_by = relationship("User", foreign_keys=[rejected_by_id], remote_side=[id])
 
@@ -61,7 +107,13 @@ class User(Base):
     def verify_password(self, plain_password):
         if not self.password_hash:
             return False
-        return pwd_context.verify(plain_password, self.password_hash)
+        ok = _verify_cached(plain_password, self.password_hash)
+        # Хеш со старыми параметрами обновляем на лету; объект становится
+        # dirty, и вызывающий код обязан сделать commit до закрытия
+        # сессии (login() в app.py так и поступает)
+        if ok and pwd_context.needs_update(self.password_hash):
+            self.password_hash = pwd_context.hash(plain_password)
+        return ok
 
     # Method to get password hash
     @staticmethod
@@ -84,15 +136,32 @@ class User(Base):
             return False
         if self.archived_at is None:
             return True
-        return self.archived_at <= datetime.date.today()
+        return self.archived_at <= today()
 
-    @property
+    # Шаблоны и проверки доступа дёргают роли много раз за запрос —
+    # считаем один раз на экземпляр; кэш сбрасывается при refresh/expire
+    # объекта (см. _clear_role_cache ниже)
+    @cached_property
     def is_admin(self):
-        return self.role in ['admin', 'curator']
+        return self.role in _ADMIN_ROLES
 
-    @property
+    @cached_property
     def is_curator(self):
         return self.role == 'curator'
 
     def __repr__(self):
         return f'<User {self.username}>'
+
+
+_ADMIN_ROLES = frozenset({'admin', 'curator'})
+
+
+@event.listens_for(User, 'refresh')
+def _clear_role_cache(target, context, attrs):
+    target.__dict__.pop('is_admin', None)
+    target.__dict__.pop('is_curator', None)
+
+
+@event.listens_for(User, 'expire')
+def _clear_role_cache_on_expire(target, attrs):
+    _clear_role_cache(target, None, attrs)